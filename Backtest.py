@@ -6,19 +6,32 @@ Created on Mon Jan 20 08:39:14 2020
 """
 import pandas as pd
 import numpy as np
-import data
-import user
 from datetime import date
 from math import floor, ceil
 # import norgatedata
 from plotly.offline import plot
 import plotly.graph_objects as go
 import pandas_market_calendars as mcal
-from datetime import datetime, timedelta
+from datetime import datetime
 from tqdm import tqdm
 import os
+import ast
+import inspect
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
 import Optimise
 from strategy_stat_functions import *
+from trade_ledger import TradeLedger, PositionLog, TRADE_COLUMNS
+from order_book import OrderBook
+from running_metrics import RunningMetrics
+from accounts import Account, select_account, on_every_account, on_every_account_method, \
+    on_every_holding_account_method
+import checkpoint
+import distributed
+from shared_data import SharedData, attach_context
+import compiled_engine
+from price_panels import PricePanels
+from backtest_context import BacktestContext, get_context, activate
 
 
 class Orders:
@@ -45,6 +58,16 @@ class Orders:
     min_to_enter : int, default 10
         The minimum number of shares you can open in a trade. eg. If value is
         set to 10 and you attempt to order 3, the order will not be placed.
+    context : BacktestContext, default None
+        The backtest to place the order in. If None, the backtest running in
+        this thread is used.
+
+    Notes
+    -----
+    When `run` is given several `accounts`, every order is placed in each
+    account, sized by that account's capital and cash, after being placed in
+    the first account. The attributes of an Orders object, such as
+    `current_number_of_shares`, are those of the first account.
 
     Examples
     -------
@@ -55,12 +78,12 @@ class Orders:
     """
 
     def __init__(self, symbol, open_reason=None, close_reason=None, exec_timing=None,
-                 compound=False, able_to_exceed=True, min_to_enter=10):
+                 compound=False, able_to_exceed=True, min_to_enter=10, context=None):
         """
         Initialising the placement of an order.
 
-        Currently, you must have a file called data.py in the directory for the
-        variables to be stored in.
+        The order is placed in `context`, or in the context of the backtest
+        running in this thread if it is not given.
 
         Parameters
         ----------
@@ -75,25 +98,49 @@ class Orders:
         able_to_exceed : bool, optional
             If set to True, this does not prevent spending more than your
             starting amount (or current wealth if compound is True).
+        context : BacktestContext, optional
+            The backtest to place the order in. The default is the active
+            context, see backtest_context.get_context.
         """
+        self.ctx = ctx = context if context is not None else get_context()
         self.symbol = symbol
-        self.all_open_trade_rows = data.trade_df[(data.trade_df['symbol'] == symbol) & (
-            data.trade_df['close_price'].isnull())]  # Extract open position for symbol
-        self.current_number_of_shares = self.all_open_trade_rows['amount'].sum(axis=0)
-        self.date = data.current_date
+        self._settings = dict(open_reason=open_reason, close_reason=close_reason, exec_timing=exec_timing,
+                              compound=compound, able_to_exceed=able_to_exceed, min_to_enter=min_to_enter)
+        if ctx.account_overrides:
+            compound = ctx.account_overrides.get('compound', compound)
+            able_to_exceed = ctx.account_overrides.get('able_to_exceed', able_to_exceed)
+        lots = ctx.trade_ledger.lots(symbol)  # Extract open position for symbol
+        self.open_trade_numbers = list(lots.trade_numbers)
+        self.current_number_of_shares = lots.shares
+        self.current_open_value = lots.open_value
+        self.date = ctx.current_date
         self.limit_passed = False
         self.open_reason = open_reason
         self.close_reason = close_reason
         self.exec_timing = exec_timing
         self.able_to_exceed = able_to_exceed
-        self.price = data.current_price[symbol]
+        self.column = ctx.price_panels.symbol_columns[symbol]
+        self.price = ctx.current_price[symbol]
         self.min_to_enter = min_to_enter
         if not compound:
-            self.capital = data.starting_amount
+            self.capital = ctx.starting_amount
         else:
             # self.capital = data.wealth_track[-1]
-            self.capital = data.starting_amount + data.profit
+            self.capital = ctx.starting_amount + ctx.profit
+
+    def copy(self):
+        """Returns a new Orders of the same symbol and settings, made in the account selected now."""
+        return Orders(self.symbol, context=self.ctx, **self._settings)
 
+    def _long_or_short(self):
+        return self.ctx.trade_ledger['long_or_short'][self.open_trade_numbers[0]]
+
+    @property
+    def all_open_trade_rows(self):
+        """The open trades of this symbol as a DataFrame, indexed by trade number."""
+        return self.ctx.trade_ledger.to_dataframe(self.open_trade_numbers)
+
+    @on_every_account_method
     def order_amount(self, amount, limit_price=None):
         """
         Places an order for a desired amount of shares. Would not recommend as
@@ -109,9 +156,10 @@ class Orders:
 
         Returns
         -------
-        None. The function will update data.cash and also update data.trade_df
+        None. The function will update data.cash and also update data.trade_ledger
 
         """
+        ctx = self.ctx
         # Checking if the limit order has passed. Possibility to default self.limit_passed to True if no limit order
         # has been placed
         '''
@@ -131,18 +179,18 @@ class Orders:
                 self.limit_passed = True
             elif amount < 0 and self.price > limit_price:
                 self.limit_passed = True
-            elif data.daily_lows[self.symbol].loc[data.current_date] <= limit_price <= data.daily_highs[self.symbol].loc[
-                data.current_date]:
+            elif ctx.price_panels.lows[ctx.current_index, self.column] <= limit_price <= \
+                    ctx.price_panels.highs[ctx.current_index, self.column]:
                 self.price = limit_price
                 self.limit_passed = True
             else:
                 return False
 
-        if data.optimising and data.current_date in data.oos_dates:
+        if ctx.optimising and ctx.current_is_oos:
             return False
 
         value_of_order = amount * self.price
-        value_space = data.starting_amount - data.value_invested  # This is used only if self.able_to_exceed == False
+        value_space = ctx.starting_amount - ctx.value_invested  # This is used only if self.able_to_exceed == False
 
         if amount > 0:
             type_of_order = 'long'
@@ -157,34 +205,31 @@ class Orders:
         if abs(amount) < self.min_to_enter:
             return False
 
-        data.trade_df = data.trade_df.append({
-            'long_or_short': type_of_order,
-            'symbol': self.symbol,
-            'open_date': data.current_date,
-            'open_price': self.price,
-            'open_value': value_of_order,
-            'amount': amount,
-            'open_reason': self.open_reason,
-            'close_reason': self.close_reason,
-            'entry_timing': self.exec_timing,
-            'exit_timing': None},
-            ignore_index=True)  # Updating the trade dataframe for the new order
-
-        data.positions_tracker.at[
-            data.current_date, self.symbol] = self.current_number_of_shares + amount
-        data.current_positions.add(
+        ctx.trade_ledger.append(long_or_short=type_of_order,
+                                symbol=self.symbol,
+                                open_date=ctx.current_date,
+                                open_price=self.price,
+                                open_value=value_of_order,
+                                amount=amount,
+                                open_reason=self.open_reason,
+                                close_reason=self.close_reason,
+                                entry_timing=self.exec_timing)  # Updating the trade ledger for the new order
+        self._record_position()
+
+        ctx.current_positions.add(
             self.symbol)  # NOTE: This will not work if you are using a non-target function to sell shares!
-        data.cash -= abs(
+        ctx.cash -= abs(
             value_of_order)
-        data.value_invested += abs(value_of_order)  # Increasing the value of our total open positions
+        ctx.value_invested += abs(value_of_order)  # Increasing the value of our total open positions
 
         return True
 
+    @on_every_account_method
     def order_value(self, value, limit_price=None):
         """
         Places an order for a set value of shares.
 
-        An order for a given stock is placed and added to data.trade_df. If a
+        An order for a given stock is placed and added to data.trade_ledger. If a
         limit order is entered, then the function will ensure the price hits the
         limit order on this day before entering. The entry price will be the
         limit price in this scenario.
@@ -198,7 +243,7 @@ class Orders:
 
         Returns
         -------
-        None. The function will update data.cash, data.trade_df,
+        None. The function will update data.cash, data.trade_ledger,
         data.current_positions, and data.value_invested.
 
         Examples
@@ -208,6 +253,7 @@ class Orders:
         to represent this.
 
         """
+        ctx = self.ctx
         # Checking if the limit order has passed. Possibility to default self.limit_passed to True if no limit order
         # has been placed
         '''
@@ -227,8 +273,8 @@ class Orders:
                 self.limit_passed = True
             elif value < 0 and self.price > limit_price:
                 self.limit_passed = True
-            elif data.daily_lows[self.symbol].loc[data.current_date] <= limit_price <= data.daily_highs[self.symbol].loc[
-                data.current_date]:
+            elif ctx.price_panels.lows[ctx.current_index, self.column] <= limit_price <= \
+                    ctx.price_panels.highs[ctx.current_index, self.column]:
                 self.price = limit_price
                 self.limit_passed = True
             else:
@@ -243,6 +289,7 @@ class Orders:
             return False
         return self.order_amount(amount)  # Places an order for the calculated number of shares
 
+    @on_every_account_method
     def order_percent(self, percent, limit_price=None):
         """
         Orders a percent of your starting cash.
@@ -263,7 +310,7 @@ class Orders:
 
         Returns
         -------
-        None. The function will update data.cash and also update data.trade_df
+        None. The function will update data.cash and also update data.trade_ledger
 
         Examples
         --------
@@ -277,6 +324,7 @@ class Orders:
         Will place a short order 5% of your current wealth.
 
         """
+        ctx = self.ctx
         # Checking if the limit order has passed. Possibility to default self.limit_passed to True if no limit order
         # has been placed
         '''
@@ -296,8 +344,8 @@ class Orders:
                 self.limit_passed = True
             elif percent < 0 and self.price > limit_price:
                 self.limit_passed = True
-            elif data.daily_lows[self.symbol].loc[data.current_date] <= limit_price <= data.daily_highs[self.symbol].loc[
-                data.current_date]:
+            elif ctx.price_panels.lows[ctx.current_index, self.column] <= limit_price <= \
+                    ctx.price_panels.highs[ctx.current_index, self.column]:
                 self.price = limit_price
                 self.limit_passed = True
             else:
@@ -306,6 +354,7 @@ class Orders:
         value = percent * self.capital  # Calculating the value of the order based on the percent
         return self.order_value(value)
 
+    @on_every_account_method
     def order_target_amount(self, target_amount, limit_price=None):
         """
         Orders a number of shares of a stock.
@@ -322,7 +371,7 @@ class Orders:
 
         Returns
         -------
-        None. The function will update data.cash and also update data.trade_df
+        None. The function will update data.cash and also update data.trade_ledger
 
         Examples
         -------
@@ -341,6 +390,7 @@ class Orders:
         This will ensure you are short 100 shares of SPY if the limit price of
         $101.3 is hit on that day.
         """
+        ctx = self.ctx
         # Checking if the limit order has passed. Possibility to default self.limit_passed to True if no limit order
         # has been placed
         '''
@@ -360,8 +410,8 @@ class Orders:
                 self.limit_passed = True
             elif target_amount < 0 and self.price > limit_price:
                 self.limit_passed = True
-            elif data.daily_lows[self.symbol].loc[data.current_date] <= limit_price <= data.daily_highs[self.symbol].loc[
-                data.current_date]:
+            elif ctx.price_panels.lows[ctx.current_index, self.column] <= limit_price <= \
+                    ctx.price_panels.highs[ctx.current_index, self.column]:
                 self.price = limit_price
                 self.limit_passed = True
             else:
@@ -377,27 +427,28 @@ class Orders:
         elif self.current_number_of_shares > target_amount >= 0 or self.current_number_of_shares < target_amount <= 0:
             amount_to_close = self.current_number_of_shares - target_amount
             amount_left = self.current_number_of_shares - amount_to_close
-            data.positions_tracker.at[data.current_date, self.symbol] = amount_left
             if amount_left == 0:
-                data.current_positions.remove(self.symbol)
-            for index, row in self.all_open_trade_rows.iterrows():
+                ctx.current_positions.remove(self.symbol)
+            row_amounts = ctx.trade_ledger['amount']
+            for index in self.open_trade_numbers:  # Oldest lots are closed first
+                row_amount = row_amounts[index]
                 if amount_to_close == 0:
                     break
-                elif abs(amount_to_close) >= abs(row['amount']):
+                elif abs(amount_to_close) >= abs(row_amount):
                     self._fully_close_row(trade_number=index)
-                    amount_to_close -= row['amount']
-                elif abs(amount_to_close) < abs(row['amount']):
+                    amount_to_close -= row_amount
+                else:
                     self._part_close_row(trade_number=index, amount_to_close=amount_to_close)
-                # elif amount_to_close == 0:
-                #     break
+                    break
             return True
         elif self.current_number_of_shares > 0 > target_amount or self.current_number_of_shares < 0 < target_amount:
-            for index, row in self.all_open_trade_rows.iterrows():
+            for index in self.open_trade_numbers:
                 self._fully_close_row(trade_number=index)
             return self.order_amount(target_amount)
         else:
             return False
 
+    @on_every_account_method
     def order_target_value(self, target_value, limit_price=None):
         """
         Orders a specified value of shares of a stock.
@@ -414,7 +465,7 @@ class Orders:
 
         Returns
         -------
-        None. The function will update data.cash and also update data.trade_df
+        None. The function will update data.cash and also update data.trade_ledger
 
         Examples
         -------
@@ -431,9 +482,10 @@ class Orders:
         >>> Orders('SPY', open_reason='Entry 1').order_target_value(-10000, limit_order=101.3)
 
         This will ensure you are short 100 shares of SPY if the limit price of
-        $101.3 is hit on that day. The open_reason column in data.trade_df will
+        $101.3 is hit on that day. The open_reason column in the trade list will
         say 'Entry 1' for this trade.
         """
+        ctx = self.ctx
 
         # Checking if the limit order has passed. Possibility to default self.limit_passed to True if no limit order
         # has been placed
@@ -454,8 +506,8 @@ class Orders:
                 self.limit_passed = True
             elif target_value < 0 and self.price > limit_price:
                 self.limit_passed = True
-            elif data.daily_lows[self.symbol].loc[data.current_date] <= limit_price <= data.daily_highs[self.symbol].loc[
-                data.current_date]:
+            elif ctx.price_panels.lows[ctx.current_index, self.column] <= limit_price <= \
+                    ctx.price_panels.highs[ctx.current_index, self.column]:
                 self.price = limit_price
                 self.limit_passed = True
             else:
@@ -467,6 +519,7 @@ class Orders:
             target_amount = ceil(target_value / self.price)
         return self.order_target_amount(target_amount)
 
+    @on_every_account_method
     def order_target_percent(self, target_percent, limit_price=None):
         """
         Will put an order in for a target percent of your portfolio. If
@@ -482,7 +535,7 @@ class Orders:
 
         Returns
         -------
-        None. The function will update data.cash and also update data.trade_df
+        None. The function will update data.cash and also update data.trade_ledger
 
         Examples
         --------
@@ -500,8 +553,9 @@ class Orders:
 
         This will ensure you are short in SPY at a value as close to 10% of your
         current wealth if the limit price of $101.3 is hit on that day. The
-        open_reason column in data.trade_df will say 'Entry 1' for this trade.
+        open_reason column in the trade list will say 'Entry 1' for this trade.
         """
+        ctx = self.ctx
         # Checking if the limit order has passed. Possibility to default self.limit_passed to True if no limit order
         # has been placed
         '''
@@ -521,8 +575,8 @@ class Orders:
                 self.limit_passed = True
             elif target_percent < 0 and self.price > limit_price:
                 self.limit_passed = True
-            elif data.daily_lows[self.symbol].loc[data.current_date] <= limit_price <= data.daily_highs[self.symbol].loc[
-                data.current_date]:
+            elif ctx.price_panels.lows[ctx.current_index, self.column] <= limit_price <= \
+                    ctx.price_panels.highs[ctx.current_index, self.column]:
                 self.price = limit_price
                 self.limit_passed = True
             else:
@@ -531,71 +585,42 @@ class Orders:
         target_value = target_percent * self.capital
         return self.order_target_value(target_value)
 
+    def _record_position(self):
+        ctx = self.ctx
+        ctx.position_log.record(ctx.current_index, self.column, ctx.trade_ledger.net_shares[self.column])
+
     def _fully_close_row(self, trade_number):
-        row_to_close = data.trade_df.loc[trade_number]
-        if row_to_close['symbol'] != self.symbol:
+        ctx = self.ctx
+        ledger = ctx.trade_ledger
+        if ledger['symbol'][trade_number] != self.symbol:
             print('ROW NOT CLOSED AS IT WAS A DIFFERENT SYMBOL')
             return
-        amount_before_exit = row_to_close['amount']
-        close_value = amount_before_exit * self.price
-        profit = close_value - row_to_close['open_value']
-        # if data.optimising:
-        #     data.trade_df.drop(trade_number, inplace=True)
-        # else:
-        data.trade_df.at[trade_number, 'close_date'] = data.current_date
-        data.trade_df.at[trade_number, 'close_price'] = self.price
-        data.trade_df.at[trade_number, 'close_value'] = close_value
-        data.trade_df.at[trade_number, 'close_reason'] = self.close_reason
-        data.trade_df.at[trade_number, 'profit'] = profit
-        data.trade_df.at[trade_number, 'profit%'] = (profit / row_to_close['open_value']) * 100
-        data.trade_df.at[trade_number, 'exit_timing'] = self.exec_timing
-
-        data.cash += profit + abs(row_to_close['open_value'])
-        data.value_invested -= abs(row_to_close['open_value'])
+        open_value = ledger['open_value'][trade_number]
+        profit = ledger.close_row(trade_number,
+                                  close_date=ctx.current_date,
+                                  close_price=self.price,
+                                  close_reason=self.close_reason,
+                                  exit_timing=self.exec_timing)
+        self._record_position()
 
-    def _part_close_row(self, trade_number, amount_to_close):
-        row_to_close = data.trade_df.loc[trade_number]
-        amount_remaining = row_to_close['amount'] - amount_to_close
-        # row_to_add = pd.Series({
-        #     'long_or_short': row_to_close['long_or_short'],
-        #     'symbol': row_to_close['symbol'],
-        #     'open_date': row_to_close['open_date'],
-        #     'open_price': row_to_close['open_price'],
-        #     'amount': amount_remaining,
-        #     'open_value': row_to_close['open_price'] * amount_remaining,
-        #     },
-        #     name=data.trade_df.index[-1]+1)
-        # data.trade_df = data.trade_df.append(row_to_add)
-        new_open_value = row_to_close['open_price'] * amount_to_close
-        profit = (amount_to_close * self.price) - new_open_value
-        # if data.optimising:
-        #     data.trade_df.drop(trade_number, inplace=True)
-        # else:
-        data.trade_df.at[trade_number, 'amount'] = amount_to_close
-        data.trade_df.at[trade_number, 'open_value'] = new_open_value
-        data.trade_df.at[trade_number, 'close_date'] = data.current_date
-        data.trade_df.at[trade_number, 'close_price'] = self.price
-        data.trade_df.at[trade_number, 'close_value'] = amount_to_close * self.price
-        data.trade_df.at[trade_number, 'close_reason'] = self.close_reason
-        data.trade_df.at[trade_number, 'profit'] = profit
-        data.trade_df.at[trade_number, 'profit%'] = (profit / new_open_value) * 100
-        data.trade_df.at[trade_number, 'exit_timing'] = self.exec_timing
-
-        data.cash += profit + abs(new_open_value)
-        data.value_invested -= abs(new_open_value)
-
-        data.trade_df = data.trade_df.append({
-            'long_or_short': row_to_close['long_or_short'],
-            'symbol': row_to_close['symbol'],
-            'open_date': row_to_close['open_date'],
-            'open_price': row_to_close['open_price'],
-            'amount': amount_remaining,
-            'open_value': row_to_close['open_price'] * amount_remaining,
-            'open_reason': row_to_close['open_reason'],
-            'entry_timing': row_to_close['entry_timing']
-        },
-            ignore_index=True)
+        ctx.cash += profit + abs(open_value)
+        ctx.value_invested -= abs(open_value)
 
+    def _part_close_row(self, trade_number, amount_to_close):
+        ctx = self.ctx
+        profit, _ = ctx.trade_ledger.part_close_row(trade_number,
+                                                    amount_to_close=amount_to_close,
+                                                    close_date=ctx.current_date,
+                                                    close_price=self.price,
+                                                    close_reason=self.close_reason,
+                                                    exit_timing=self.exec_timing)
+        self._record_position()
+        new_open_value = ctx.trade_ledger['open_value'][trade_number]
+
+        ctx.cash += profit + abs(new_open_value)
+        ctx.value_invested -= abs(new_open_value)
+
+    @on_every_holding_account_method
     def check_stop_loss(self,
                         stop_loss_percent,
                         close_if_hit=True,
@@ -633,12 +658,13 @@ class Orders:
         True (if the value of your positions in SPY drop by 5% in this day)
 
         """
+        ctx = self.ctx
         if eod:
-            todays_close = data.daily_closes[self.symbol].loc[data.current_date]
+            todays_close = ctx.price_panels.closes[ctx.current_index, self.column]
             if trade_number is None:
-                entry_value = self.all_open_trade_rows['open_value'].sum()
+                entry_value = self.current_open_value
                 eod_value = self.current_number_of_shares * todays_close
-                if self.all_open_trade_rows['long_or_short'].iloc[0] == 'long':
+                if self._long_or_short() == 'long':
                     stop_value = (1 - stop_loss_percent) * entry_value
                 else:
                     stop_value = (1 + stop_loss_percent) * entry_value
@@ -649,7 +675,7 @@ class Orders:
                 else:
                     return False
             else:
-                trade_row = data.trade_df.loc[trade_number]
+                trade_row = ctx.trade_ledger.row(trade_number)
                 entry_value = trade_row['open_value']
                 number_of_shares = trade_row['amount']
                 eod_value = number_of_shares * todays_close
@@ -665,11 +691,11 @@ class Orders:
                 else:
                     return False
         elif sod:
-            todays_open = data.daily_opens[self.symbol].loc[data.current_date]
+            todays_open = ctx.price_panels.opens[ctx.current_index, self.column]
             if trade_number is None:
-                entry_value = self.all_open_trade_rows['open_value'].sum()
+                entry_value = self.current_open_value
                 sod_value = self.current_number_of_shares * todays_open
-                if self.all_open_trade_rows['long_or_short'].iloc[0] == 'long':
+                if self._long_or_short() == 'long':
                     stop_value = (1 - stop_loss_percent) * entry_value
                 else:
                     stop_value = (1 + stop_loss_percent) * entry_value
@@ -680,7 +706,7 @@ class Orders:
                 else:
                     return False
             else:
-                trade_row = data.trade_df.loc[trade_number]
+                trade_row = ctx.trade_ledger.row(trade_number)
                 entry_value = trade_row['open_value']
                 number_of_shares = trade_row['amount']
                 eod_value = number_of_shares * todays_close
@@ -696,12 +722,12 @@ class Orders:
                 else:
                     return False
         else:
-            todays_low = data.daily_lows[self.symbol].loc[data.current_date]
-            todays_high = data.daily_highs[self.symbol].loc[data.current_date]
-            todays_open = data.daily_opens[self.symbol].loc[data.current_date]
+            todays_low = ctx.price_panels.lows[ctx.current_index, self.column]
+            todays_high = ctx.price_panels.highs[ctx.current_index, self.column]
+            todays_open = ctx.price_panels.opens[ctx.current_index, self.column]
             if trade_number is None:
-                symbol_long_or_short = self.all_open_trade_rows['long_or_short'].iloc[0]
-                entry_value = self.all_open_trade_rows['open_value'].sum()
+                symbol_long_or_short = self._long_or_short()
+                entry_value = self.current_open_value
                 # stop_value = (1 - stop_loss_percent) * entry_value
                 if symbol_long_or_short == 'long':
                     min_value_today = self.current_number_of_shares * todays_low
@@ -729,7 +755,7 @@ class Orders:
                     return False
 
             else:
-                trade_row = data.trade_df.loc[trade_number]
+                trade_row = ctx.trade_ledger.row(trade_number)
                 entry_value = trade_row['open_value']
                 number_of_shares = trade_row['amount']
                 symbol_long_or_short = trade_row['long_or_short']
@@ -760,6 +786,7 @@ class Orders:
                 else:
                     return False
 
+    @on_every_holding_account_method
     def check_take_profit(self,
                           floor_pct,
                           giveback_pct,
@@ -768,30 +795,30 @@ class Orders:
                           first_trade=False,
                           eod=False,
                           sod=False):
+        ctx = self.ctx
+        ledger = ctx.trade_ledger
         if trade_number is None:
+            # The highest high (or lowest low) since entry of each open trade is kept up to date in the ledger, so
+            # only today's prices need to be added to it
             if first_trade:
-                entry_value = self.all_open_trade_rows['open_value'].iloc[0]
-                grouped_trades = self.all_open_trade_rows.iloc[0:1].reset_index()[['open_date', 'open_price', 'amount']]
+                trades = self.open_trade_numbers[:1]
+                entry_value = ledger['open_value'][trades[0]]
             else:
-                entry_value = self.all_open_trade_rows['open_value'].sum()
-                grouped_trades = self.all_open_trade_rows.groupby(['open_date',
-                                                               'open_price']).agg({'amount': 'sum'}).reset_index()
-            if self.all_open_trade_rows['long_or_short'].iloc[0] == 'long':
-                max_value = 0
-                todays_min_value = 0
-                end_date = data.current_date #+ timedelta(days=1)
-                for row in grouped_trades.itertuples():
-                    open_date = row[1]
-                    max_price = max(data.daily_highs[self.symbol].loc[open_date:end_date])
-                    max_value += row[3] * max_price
-                    todays_min_value += row[3] * data.daily_lows[self.symbol].loc[data.current_date]
+                trades = self.open_trade_numbers
+                entry_value = self.current_open_value
+            amounts = ledger['amount'][trades]
+            todays_high = ctx.price_panels.highs[ctx.current_index, self.column]
+            todays_low = ctx.price_panels.lows[ctx.current_index, self.column]
+            if self._long_or_short() == 'long':
+                max_value = amounts @ np.fmax(ledger['max_high'][trades], todays_high)
+                todays_min_value = amounts.sum() * todays_low
                 max_profit_pct = (max_value - entry_value) / entry_value
                 todays_min_profit_pct = (todays_min_value - entry_value) / entry_value
                 floor_hit = max_profit_pct > floor_pct
                 if floor_hit:
                     if todays_min_profit_pct <= max_profit_pct * (1 - giveback_pct):
                         # tp_price = ((max_profit * (1 - giveback_pct)) + entry_value) / grouped_trades['amount'].sum()
-                        tp_price = ((max_profit_pct * (1 - giveback_pct) + 1) * entry_value) / grouped_trades['amount'].sum()
+                        tp_price = ((max_profit_pct * (1 - giveback_pct) + 1) * entry_value) / amounts.sum()
                         if self.price < tp_price:
                             tp_price = self.price
                         if close_if_hit:
@@ -800,22 +827,16 @@ class Orders:
                 else:
                     return False
 
-            elif self.all_open_trade_rows['long_or_short'].iloc[0] == 'short':
-                max_value = 0
-                todays_min_value = 0
-                end_date = data.current_date + timedelta(days=1)
-                for row in grouped_trades.itertuples():
-                    open_date = row[1]
-                    min_price = min(data.daily_lows[self.symbol].loc[open_date:end_date])
-                    max_value += row[3] * min_price
-                    todays_min_value += row[3] * data.daily_highs[self.symbol].loc[data.current_date]
+            elif self._long_or_short() == 'short':
+                max_value = amounts @ np.fmin(ledger['min_low'][trades], todays_low)
+                todays_min_value = amounts.sum() * todays_high
                 max_profit_pct = (max_value - entry_value) / abs(entry_value)
                 todays_min_profit_pct = (todays_min_value - entry_value) / abs(entry_value)
                 floor_hit = max_profit_pct > floor_pct
                 if floor_hit:
                     if todays_min_profit_pct <= max_profit_pct * (1 - giveback_pct):
                         # tp_price = ((max_profit * (1 - giveback_pct)) + abs(entry_value)) / grouped_trades['amount'].sum()
-                        tp_price = (1 - (max_profit_pct * (1 - giveback_pct)) * entry_value) / grouped_trades['amount'].sum()
+                        tp_price = (1 - max_profit_pct * (1 - giveback_pct)) * entry_value / amounts.sum()
                         if self.price > tp_price:
                             tp_price = self.price
                         if close_if_hit:
@@ -827,6 +848,433 @@ class Orders:
 
         return False
 
+    @on_every_account_method
+    def place_order(self, amount, limit_price=None, stop_price=None, good_for=None):
+        """
+        Places a resting limit, stop or stop-limit order in data.order_book.
+
+        Unlike the `limit_price` of the other order functions, which is only
+        checked against the current day, a resting order is checked against
+        every following day until it fills or expires. Resting orders are
+        matched each day between the open and close callbacks. When an order
+        fills, the position is changed by `amount` at the fill price as if
+        `order_target_amount` was called, using the reasons, timing,
+        `able_to_exceed` and `min_to_enter` of this Orders object.
+
+        Parameters
+        ----------
+        amount : int
+            The number of shares to buy (positive) or sell (negative). Selling
+            reduces a long position before opening a short one.
+        limit_price : float, default None
+            The limit price of a limit or stop-limit order.
+        stop_price : float, default None
+            The stop price of a stop or stop-limit order.
+        good_for : int, default None
+            The number of days the order rests for. If None, the order rests
+            until it fills, is cancelled or the backtest ends.
+
+        Returns
+        -------
+        int
+            The id of the order, which can be passed to `cancel_orders`.
+
+        Examples
+        --------
+        >>> Orders('SPY', open_reason='Breakout').place_order(100, stop_price=data.current_price['SPY'] * 1.02,
+        ...                                                   good_for=5)
+
+        Buys 100 shares of SPY if the price rises 2% in the next five days.
+
+        """
+        ctx = self.ctx
+        if ctx.price_panels.highs is None or ctx.price_panels.lows is None:
+            raise ValueError('Resting orders need High and Low data')
+        return ctx.order_book.place(self.column,
+                                    amount,
+                                    placed_index=ctx.current_index,
+                                    limit_price=limit_price,
+                                    stop_price=stop_price,
+                                    good_for=good_for,
+                                    symbol=self.symbol,
+                                    open_reason=self.open_reason,
+                                    close_reason=self.close_reason,
+                                    exec_timing=self.exec_timing,
+                                    able_to_exceed=self.able_to_exceed,
+                                    min_to_enter=self.min_to_enter)
+
+    @on_every_account_method
+    def cancel_orders(self, order_ids=None):
+        """
+        Cancels resting orders of this symbol.
+
+        Parameters
+        ----------
+        order_ids : int or list, default None
+            The orders to cancel. Every resting order of the symbol is
+            cancelled if None.
+
+        """
+        book = self.ctx.order_book
+        if order_ids is None:
+            order_ids = book.orders_of(self.column)
+        book.cancel(order_ids)
+
+
+@on_every_account
+def fill_resting_orders(context=None):
+    """
+    Fills the resting orders of data.order_book which are hit on the current day.
+
+    All resting orders are matched against the day's prices at once by
+    `OrderBook.match`, then each filled order is traded at its fill price.
+    This is called by `run` every day between the open and close callbacks.
+
+    Parameters
+    ----------
+    context : BacktestContext, default None
+        The backtest to fill the orders of. If None, the active context is
+        used.
+
+    Returns
+    -------
+    numpy-array
+        The ids of the orders which were filled.
+
+    """
+    ctx = context if context is not None else get_context()
+    book = ctx.order_book
+    panels = ctx.price_panels
+    day = ctx.current_index
+    order_ids, fill_prices = book.match(day, panels.opens[day], panels.highs[day], panels.lows[day])
+    for order_id, fill_price in zip(order_ids, fill_prices):
+        details = book.details[order_id]
+        order = Orders(details['symbol'],
+                       open_reason=details['open_reason'],
+                       close_reason=details['close_reason'],
+                       exec_timing=details['exec_timing'],
+                       able_to_exceed=details['able_to_exceed'],
+                       min_to_enter=details['min_to_enter'],
+                       context=ctx)
+        order.price = fill_price
+        order.order_target_amount(order.current_number_of_shares + book['amount'][order_id])
+    return order_ids
+
+
+@on_every_account
+def rebalance_portfolio(targets,
+                        target_type='percent',
+                        open_reason=None,
+                        close_reason=None,
+                        exec_timing=None,
+                        compound=False,
+                        able_to_exceed=True,
+                        min_to_enter=10,
+                        context=None):
+    """
+    Orders many symbols to their targets in one step.
+
+    This does the same as calling `Orders(symbol).order_target_percent` (or
+    `order_target_value` or `order_target_amount`) for every symbol, but the
+    whole portfolio is sized and traded with array operations instead of
+    creating an Orders object for each symbol. All the closes are made before
+    any of the opens, so cash freed by selling can be used by the new orders
+    when `able_to_exceed` is False. Oldest lots are closed first and orders
+    smaller than `min_to_enter` are not placed, as with Orders.
+
+    Parameters
+    ----------
+    targets : pandas-series or dict or array-like
+        The target of each symbol. A Series or dict is indexed by symbol and
+        symbols not given are left unchanged. An array has an entry for every
+        column of data.daily_closes. A NaN target leaves the position
+        unchanged.
+    target_type : str, default 'percent'
+        'percent' for a percent of capital, 'value' for a value in dollars or
+        'amount' for a number of shares.
+    open_reason, close_reason, exec_timing, compound, able_to_exceed, min_to_enter
+        See `Orders`.
+    context : BacktestContext, default None
+        The backtest to place the orders in. If None, the backtest running in
+        this thread is used.
+
+    Returns
+    -------
+    pandas-series
+        The number of shares bought (positive) or sold (negative) of each
+        symbol which was traded.
+
+    Examples
+    --------
+    >>> weights = pd.Series(0.1, index=top_ten_symbols)
+    >>> rebalance_portfolio(weights.reindex(data.current_positions | set(top_ten_symbols), fill_value=0))
+
+    Holds 10% of the starting amount in each of the top ten symbols and
+    closes every other position.
+
+    """
+    if target_type not in ('percent', 'value', 'amount'):
+        raise ValueError('target_type must be either "percent", "value" or "amount"')
+    ctx = context if context is not None else get_context()
+    compound = ctx.account_overrides.get('compound', compound)
+    able_to_exceed = ctx.account_overrides.get('able_to_exceed', able_to_exceed)
+    ledger = ctx.trade_ledger
+    panels = ctx.price_panels
+    if isinstance(targets, (pd.Series, dict)):
+        targets = pd.Series(targets, dtype=np.float64).reindex(panels.symbols).to_numpy()
+    else:
+        targets = np.asarray(targets, dtype=np.float64)
+    prices = np.asarray(ctx.current_price.values, dtype=np.float64)
+    if target_type == 'percent':
+        capital = ctx.starting_amount + ctx.profit if compound else ctx.starting_amount
+        targets = targets * capital
+    if target_type != 'amount':
+        targets = np.where(targets >= 0, np.floor(targets / prices), np.ceil(targets / prices))
+
+    current = ledger.net_shares.copy()
+    change = targets - current
+    valid = (change != 0) & ~np.isnan(change) & ~np.isnan(prices)
+    flipping = valid & (current * targets < 0)
+    reducing = valid & ~flipping & (np.abs(targets) < np.abs(current))
+    adding = valid & ~flipping & ~reducing
+
+    # Closes. Whole lots are closed together and at most one lot of each symbol is part closed
+    to_close = np.where(flipping, current, np.where(reducing, current - targets, 0))
+    amounts = ledger['amount']
+    full_rows, full_columns, part_closes = [], [], []
+    for column in np.flatnonzero(to_close):
+        trade_numbers = np.fromiter(ledger.open_lots[panels.symbols[column]].trade_numbers, dtype=np.int64)
+        closed_amounts = np.cumsum(amounts[trade_numbers])
+        n_full = np.searchsorted(np.abs(closed_amounts), abs(to_close[column]), side='right')
+        full_rows.append(trade_numbers[:n_full])
+        full_columns.append(np.full(n_full, column))
+        amount_left = to_close[column] - (closed_amounts[n_full - 1] if n_full else 0)
+        if n_full < len(trade_numbers) and amount_left != 0:
+            part_closes.append((trade_numbers[n_full], amount_left, column))
+    if full_rows:
+        full_columns = np.concatenate(full_columns)
+        _close_trades(np.concatenate(full_rows), prices[full_columns], close_reason, exec_timing, ctx)
+    for trade_number, amount_to_close, column in part_closes:
+        profit, _ = ledger.part_close_row(trade_number,
+                                          amount_to_close=amount_to_close,
+                                          close_date=ctx.current_date,
+                                          close_price=prices[column],
+                                          close_reason=close_reason,
+                                          exit_timing=exec_timing)
+        closed_value = abs(ledger['open_value'][trade_number])
+        ctx.cash += profit + closed_value
+        ctx.value_invested -= closed_value
+
+    # Opens
+    to_open = np.where(flipping, targets, np.where(adding, change, 0))
+    to_open[np.abs(to_open) < min_to_enter] = 0
+    if ctx.optimising and ctx.current_is_oos:
+        to_open[:] = 0
+    if not able_to_exceed:
+        open_values = np.abs(to_open * prices)
+        value_space = ctx.starting_amount - ctx.value_invested
+        fits = np.cumsum(open_values) <= value_space
+        if not fits.all():
+            # Orders are placed in column order, so everything after the first order which does not fit is cut
+            # down to the space left, one order at a time
+            first = int(np.argmin(fits))
+            value_space -= open_values[:first].sum()
+            for column in np.flatnonzero(to_open[first:]) + first:
+                if open_values[column] > value_space:
+                    if value_space <= 0:
+                        amount = 0
+                    elif to_open[column] > 0:
+                        amount = floor(value_space / prices[column])
+                    else:
+                        amount = ceil(-value_space / prices[column])
+                    to_open[column] = amount if abs(amount) >= min_to_enter else 0
+                value_space -= abs(to_open[column] * prices[column])
+    opening = np.flatnonzero(to_open)
+    if len(opening):
+        open_amounts = to_open[opening]
+        open_values = open_amounts * prices[opening]
+        ledger.extend(long_or_short=np.where(open_amounts > 0, 'long', 'short').astype(object),
+                      symbol=np.asarray(panels.symbols[opening], dtype=object),
+                      open_date=ctx.current_date,
+                      open_price=prices[opening],
+                      open_value=open_values,
+                      amount=open_amounts,
+                      open_reason=open_reason,
+                      close_reason=close_reason,
+                      entry_timing=exec_timing)
+        ctx.cash -= np.abs(open_values).sum()
+        ctx.value_invested += np.abs(open_values).sum()
+
+    traded = np.flatnonzero((to_close != 0) | (to_open != 0))
+    _record_positions(traded, ctx)
+    return pd.Series(ledger.net_shares[traded] - current[traded], index=panels.symbols[traded])
+
+
+@on_every_account
+def check_stop_losses(stop_loss_percent,
+                      close_if_hit=True,
+                      by_trade=False,
+                      eod=False,
+                      sod=False,
+                      symbols=None,
+                      close_reason=None,
+                      exec_timing=None,
+                      context=None):
+    """
+    Checks the stop losses of every open position at once.
+
+    This does the same checks as calling `Orders(symbol).check_stop_loss` for
+    every open position, but the stop prices of all positions are worked out
+    and compared to the day's prices with array operations, and every position
+    which is hit is closed in one pass.
+
+    Parameters
+    ----------
+    stop_loss_percent : float or pandas-series
+        The stop-loss, usually between 0 and 1. A Series indexed by symbol
+        sets a different stop for each symbol, and symbols missing from it are
+        not checked.
+    close_if_hit : bool, default True
+        If the stop loss is hit, the trades are automatically closed.
+    by_trade : bool, default False
+        Set to True to check each open trade against its own open value, as
+        with the `trade_number` argument of `check_stop_loss`. Otherwise all
+        the open trades of a symbol are checked together.
+    eod : bool, default False
+        Only check for a hit stop loss on close data. Hit positions are closed
+        at data.current_price.
+    sod : bool, default False
+        Only check the stop loss on open data. Hit positions are closed at
+        data.current_price.
+    symbols : list-like, default None
+        The symbols to check. All open positions are checked if None.
+    close_reason, exec_timing : str, default None
+        See `Orders`.
+    context : BacktestContext, default None
+        The backtest to check. If None, the backtest running in this thread is
+        used.
+
+    Returns
+    -------
+    pandas-index
+        The symbols which were hit, or the trade numbers which were hit if
+        `by_trade` is True.
+
+    Notes
+    -----
+    If neither `eod` nor `sod` is set the stop is checked against the day's
+    high and low. A hit position is closed at the open if the price gapped
+    through the stop, otherwise at the stop price, and is not closed if that
+    price is outside the day's range. Unlike `check_stop_loss` with a
+    `trade_number`, trades checked `by_trade` are also closed at this price.
+
+    Examples
+    --------
+    >>> def trade_every_day_close(user, data):
+    ...     check_stop_losses(0.05, close_reason='stop-loss')
+
+    """
+    ctx = context if context is not None else get_context()
+    ledger = ctx.trade_ledger
+    panels = ctx.price_panels
+    day = ctx.current_index
+    if by_trade:
+        trade_numbers = ledger.open_rows()
+        columns = np.fromiter((ledger.symbol_columns[symbol] for symbol in ledger['symbol'][trade_numbers]),
+                              dtype=np.int64, count=len(trade_numbers))
+        shares = ledger['amount'][trade_numbers]
+        entry_value = ledger['open_value'][trade_numbers]
+    else:
+        columns = ledger.held_columns()
+        shares = ledger.net_shares[columns]
+        entry_value = ledger.net_open_value[columns]
+    if isinstance(stop_loss_percent, pd.Series):
+        stop_loss_percent = stop_loss_percent.reindex(panels.symbols).to_numpy(dtype=np.float64)[columns]
+    checked = ~np.isnan(stop_loss_percent * shares)
+    if symbols is not None:
+        checked &= panels.symbols[columns].isin(symbols)
+
+    long = shares > 0
+    stop_value = np.where(long, 1 - stop_loss_percent, 1 + stop_loss_percent) * entry_value
+    if eod or sod:
+        prices = (panels.closes if eod else panels.opens)[day, columns]
+        hit = checked & (shares * prices < stop_value)
+        exit_prices = np.asarray(ctx.current_price.values, dtype=np.float64)[columns]
+        closing = hit
+    else:
+        lows = panels.lows[day, columns]
+        highs = panels.highs[day, columns]
+        opens = panels.opens[day, columns]
+        hit = checked & (shares * np.where(long, lows, highs) < stop_value)
+        stop_prices = stop_value / shares
+        gapped = np.where(long, opens <= stop_prices, opens >= stop_prices)
+        exit_prices = np.where(gapped, opens, stop_prices)
+        closing = hit & (lows <= exit_prices) & (exit_prices <= highs)  # As with a limit order at the exit price
+
+    closing = np.flatnonzero(closing)
+    if close_if_hit and len(closing):
+        if by_trade:
+            rows = trade_numbers[closing]
+            row_prices = exit_prices[closing]
+        else:
+            lots = [ledger.open_rows(panels.symbols[column]) for column in columns[closing]]
+            rows = np.concatenate(lots)
+            row_prices = np.repeat(exit_prices[closing], [len(x) for x in lots])
+        _close_trades(rows, row_prices, close_reason, exec_timing, ctx)
+        _record_positions(np.unique(columns[closing]), ctx)
+    hit_positions = np.flatnonzero(hit)
+    if by_trade:
+        return pd.Index(trade_numbers[hit_positions])
+    return panels.symbols[columns[hit_positions]]
+
+
+@on_every_account
+def close_all_positions(close_reason=None, exec_timing='close', context=None):
+    """
+    Closes every open position at the current price.
+
+    Parameters
+    ----------
+    close_reason : str, default None
+        Populates the 'close_reason' column of the closed trades.
+    exec_timing : str, default 'close'
+        Populates the 'exit_timing' column of the closed trades.
+    context : BacktestContext, default None
+        The backtest to close the positions of. If None, the active context is
+        used.
+
+    Returns
+    -------
+    None.
+
+    """
+    ctx = context if context is not None else get_context()
+    for symbol in list(ctx.current_positions):
+        Orders(symbol, close_reason=close_reason, exec_timing=exec_timing, context=ctx).order_target_amount(0)
+
+
+def _close_trades(trade_numbers, close_prices, close_reason, exec_timing, ctx):
+    ledger = ctx.trade_ledger
+    closed_values = np.abs(ledger['open_value'][trade_numbers])
+    profits = ledger.close_rows(trade_numbers,
+                                close_date=ctx.current_date,
+                                close_prices=close_prices,
+                                close_reason=close_reason,
+                                exit_timing=exec_timing)
+    ctx.cash += profits.sum() + closed_values.sum()
+    ctx.value_invested -= closed_values.sum()
+
+
+def _record_positions(columns, ctx):
+    ledger = ctx.trade_ledger
+    symbols = ctx.price_panels.symbols
+    ctx.position_log.record_many(ctx.current_index, columns, ledger.net_shares[columns])
+    for column in columns:
+        if ledger.net_shares[column] != 0:
+            ctx.current_positions.add(symbols[column])
+        else:
+            ctx.current_positions.discard(symbols[column])
+
 
 def get_norgatedata(symbol_list,
                     start_date=date(2000, 1, 1),
@@ -835,7 +1283,8 @@ def get_norgatedata(symbol_list,
                     start_when_all_are_in=False,
                     forward_fill_prices=True,
                     adjustment='TotalReturn',
-                    progress_desc='Downloading Norgate Data'):
+                    progress_desc='Downloading Norgate Data',
+                    context=None):
     """
     Downloads data from NorgateData.
 
@@ -865,6 +1314,8 @@ def get_norgatedata(symbol_list,
     progress_desc : str, default 'Downloading Norgate Data'
         The message you would like to appear in the progress bar while data is
         downloading.
+    context : BacktestContext, default None
+        Where to store the data. If None, the active context is used.
 
     Returns
     -------
@@ -874,6 +1325,7 @@ def get_norgatedata(symbol_list,
     Examples
     --------
     """
+    ctx = context if context is not None else get_context()
     import norgatedata
     all_dates = pd.date_range(start=start_date, end=end_date)
     if adjustment == 'TotalReturn':
@@ -952,7 +1404,7 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_closes = daily_closes.dropna(how='any')
         daily_closes.index = pd.to_datetime(daily_closes.index, format='%Y-%m-%d')
-        data.daily_closes = daily_closes
+        ctx.daily_closes = daily_closes
 
     if need_open:
         daily_opens = daily_opens.reindex(all_valid_dates.date)
@@ -962,7 +1414,7 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_opens = daily_opens.dropna(how='any')
         daily_opens.index = pd.to_datetime(daily_opens.index, format='%Y-%m-%d')
-        data.daily_opens = daily_opens
+        ctx.daily_opens = daily_opens
 
     if need_high:
         daily_highs = daily_highs.reindex(all_valid_dates.date)
@@ -972,7 +1424,7 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_highs = daily_highs.dropna(how='any')
         daily_highs.index = pd.to_datetime(daily_highs.index, format='%Y-%m-%d')
-        data.daily_highs = daily_highs
+        ctx.daily_highs = daily_highs
 
     if need_low:
         daily_lows = daily_lows.reindex(all_valid_dates.date)
@@ -982,7 +1434,7 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_lows = daily_lows.dropna(how='any')
         daily_lows.index = pd.to_datetime(daily_lows.index, format='%Y-%m-%d')
-        data.daily_lows = daily_lows
+        ctx.daily_lows = daily_lows
 
     if need_volume:
         daily_volumes = daily_volumes.reindex(all_valid_dates.date)
@@ -992,7 +1444,7 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_volumes = daily_volumes.dropna(how='any')
         daily_volumes.index = pd.to_datetime(daily_volumes.index, format='%Y-%m-%d')
-        data.daily_volumes = daily_volumes
+        ctx.daily_volumes = daily_volumes
 
     if need_turnover:
         daily_turnovers = daily_turnovers.reindex(all_valid_dates.date)
@@ -1002,7 +1454,7 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_turnovers = daily_turnovers.dropna(how='any')
         daily_turnovers.index = pd.to_datetime(daily_turnovers.index, format='%Y-%m-%d')
-        data.daily_turnovers = daily_turnovers
+        ctx.daily_turnovers = daily_turnovers
 
     if need_unadjustedclose:
         daily_unadjustedcloses = daily_unadjustedcloses.reindex(all_valid_dates.date)
@@ -1013,20 +1465,20 @@ def get_norgatedata(symbol_list,
         if start_when_all_are_in:
             daily_unadjustedcloses = daily_unadjustedcloses.dropna(how='any')
         daily_unadjustedcloses.index = pd.to_datetime(daily_unadjustedcloses.index, format='%Y-%m-%d')
-        data.daily_unadjustedcloses = daily_unadjustedcloses
+        ctx.daily_unadjustedcloses = daily_unadjustedcloses
 
     if need_close:
-        data.all_dates = daily_closes.index
+        ctx.all_dates = daily_closes.index
     elif need_open:
-        data.all_dates = daily_opens.index
+        ctx.all_dates = daily_opens.index
     elif need_high:
-        data.all_dates = daily_highs.index
+        ctx.all_dates = daily_highs.index
     elif need_low:
-        data.all_dates = daily_lows.index
+        ctx.all_dates = daily_lows.index
     elif need_volume:
-        data.all_dates = daily_volumes.index
+        ctx.all_dates = daily_volumes.index
     elif need_turnover:
-        data.all_dates = daily_turnovers.index
+        ctx.all_dates = daily_turnovers.index
     else:
         print('The error occured because no OHL or C was selected')
 
@@ -1035,7 +1487,8 @@ def get_csv_data(folder_path,
                  data_format='combined',
                  start_date=date(2000, 1, 1),
                  end_date=datetime.now().date(),
-                 start_when_all_are_in=True):
+                 start_when_all_are_in=True,
+                 context=None):
     """Short summary.
 
     Parameters
@@ -1050,6 +1503,8 @@ def get_csv_data(folder_path,
         Description of parameter `end_date`.
     start_when_all_are_in : type
         Description of parameter `start_when_all_are_in`.
+    context : BacktestContext, default None
+        Where to store the data. If None, the active context is used.
 
     Returns
     -------
@@ -1057,6 +1512,7 @@ def get_csv_data(folder_path,
         Description of returned object.
 
     """
+    ctx = context if context is not None else get_context()
     all_files = {fname[:-4]: pd.read_csv(folder_path + '\\' + fname, index_col=0, parse_dates=True) for fname in
                  os.listdir(folder_path)}
     if data_format == 'combined':
@@ -1066,9 +1522,9 @@ def get_csv_data(folder_path,
                 daily_data.dropna(how='any')
             else:
                 daily_data.dropna(how='all')
-            exec('data.{} = daily_data'.format(fname))
+            setattr(ctx, fname, daily_data)
         try:
-            data.all_dates = data.daily_closes.index
+            ctx.all_dates = ctx.daily_closes.index
         except AttributeError:
             raise NameError('ensure there is a daily_closes.csv in the source path.')
 
@@ -1078,7 +1534,8 @@ def get_valid_dates(max_lookback=200,
                     start_trading=None,
                     end_trading=None,
                     offset=0,
-                    use_data=True):
+                    use_data=True,
+                    context=None):
     """
     Generates a date list containing the dates you wish to trade on. Considers
     the NYSE trading calendar.
@@ -1094,6 +1551,8 @@ def get_valid_dates(max_lookback=200,
         The date the first trade could happen.
     end_trading : datetime, default None
         The end of the backtest.
+    context : BacktestContext, default None
+        The backtest whose dates are used. If None, the active context is used.
 
     Raises
     ------
@@ -1107,8 +1566,9 @@ def get_valid_dates(max_lookback=200,
         rebalance frequency.
 
     """
+    ctx = context if context is not None else get_context()
     if use_data:
-        all_dates = data.all_dates[max_lookback:]
+        all_dates = ctx.all_dates[max_lookback:]
 
         if start_trading is not None:
             start = start_trading
@@ -1136,6 +1596,8 @@ def get_valid_dates(max_lookback=200,
             dates_df['Month'] = all_valid_dates.month
             grouped_dates = dates_df.groupby(['Year', 'Month'])
         elif 'week' in rebalance:
+            # Weeks are grouped by their ISO year, so the days of week 1 in late December are not grouped with January
+            dates_df['Year'] = all_valid_dates.isocalendar().year.values
             dates_df['Week'] = all_valid_dates.isocalendar().week.values
             grouped_dates = dates_df.groupby(['Year', 'Week'])
         else:
@@ -1171,91 +1633,294 @@ def get_valid_dates(max_lookback=200,
     #     new_date_list.append(new_date)
 
     if end_trading is not None and use_data:
-        final_index = data.all_dates.get_loc(date_list[-1])
-        data.all_dates = data.all_dates[:final_index+1]
+        final_index = ctx.all_dates.get_loc(date_list[-1])
+        ctx.all_dates = ctx.all_dates[:final_index+1]
 
     return date_list
 
 
-def initialise():
+def build_day_schedule(trading_dates, context=None):
+    """
+    Works out once, before any backtest, what needs to happen on each date.
+
+    Parameters
+    ----------
+    trading_dates : pandas-datetimeindex
+        The rebalance dates returned by `get_valid_dates`.
+    context : BacktestContext, default None
+        The backtest to build the schedule for. If None, the active context is
+        used.
+
+    Returns
+    -------
+    None. Sets data.rebalance_days and data.oos_days to boolean arrays with an
+    entry for each date in data.all_dates. They are True on the dates
+    `trade_open` and `trade_close` are called, and on the out of sample dates
+    where no orders can be opened when optimising. Sets data.day_indices to the
+    row of each date in data.price_panels and data.next_rebalance to the
+    position of the next rebalance date on or after each date, or the number
+    of dates if there is none.
+
+    """
+    ctx = context if context is not None else get_context()
+    ctx.rebalance_days = ctx.all_dates.isin(trading_dates)
+    if ctx.optimising:
+        ctx.oos_days = ctx.all_dates.isin(ctx.oos_dates)
+    else:
+        ctx.oos_days = np.zeros(len(ctx.all_dates), dtype=bool)
+    number_of_bars = len(ctx.all_dates)
+    ctx.day_indices = ctx.price_panels.dates.get_indexer(ctx.all_dates)
+    rebalance_bars = np.flatnonzero(ctx.rebalance_days)
+    ctx.next_rebalance = np.append(rebalance_bars, number_of_bars)[np.searchsorted(rebalance_bars,
+                                                                                   np.arange(number_of_bars))]
+
+
+_NO_OP_CALLS = {'get_loc'}
+_NO_OP_NODES = (ast.Name, ast.Attribute, ast.Constant, ast.Subscript, ast.Slice, ast.expr_context,
+                getattr(ast, 'Index', ast.Slice))
+
+
+def callback_does_nothing(func):
+    """
+    Checks whether a callback has no effect, so the backtest can skip calling it.
+
+    A callback has no effect if its body only contains a docstring, `pass`,
+    `return` and assignments to local variables, where the assigned values only
+    read attributes or call `get_loc`. Nothing can use those variables, so the
+    callback has no effect other than any error it raises. The empty
+    callbacks in TEMPLATE.py are of this form. A callback whose source can not
+    be read is assumed to do something.
+
+    Parameters
+    ----------
+    func : function
+        The callback to check.
+
+    Returns
+    -------
+    bool
+        True if calling the callback can be skipped.
+
+    """
+    try:
+        tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+    except (OSError, TypeError, SyntaxError):
+        return False
+    func_def = tree.body[0]
+    if not isinstance(func_def, ast.FunctionDef) or func_def.decorator_list:
+        return False
+
+    for statement in func_def.body:
+        if isinstance(statement, ast.Pass):
+            continue
+        elif isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant):
+            continue
+        elif isinstance(statement, ast.Return) and (statement.value is None or (
+                isinstance(statement.value, ast.Constant) and statement.value.value is None)):
+            continue
+        elif isinstance(statement, ast.Assign) and all(isinstance(t, ast.Name) for t in statement.targets):
+            for node in ast.walk(statement.value):
+                if isinstance(node, ast.Call):
+                    if not (isinstance(node.func, ast.Attribute) and node.func.attr in _NO_OP_CALLS):
+                        return False
+                elif not isinstance(node, _NO_OP_NODES):
+                    return False
+            continue
+        return False
+    return True
+
+
+@on_every_account
+def initialise(context=None):
     """
     Resets all variables before beginning a new backtest.
 
     Sets data.start_date to the first tradeable data based on data.daily_closes
     and max_lookback.
-    Sets data.positions_tracker to an empty dataframe with column headers equal
-    to all stocks in the universe in use.
-    Sets data.current_date to data.start_date.
+    Sets data.position_log to an empty PositionLog. The positions held on
+    each date are only built from it by `positions_track`.
+    Sets data.current_date to data.start_date and data.current_index to its
+    row number in data.price_panels.
     Sets data.current_price to data.daily_closes on the current date.
     Sets data.wealth track to an empty list.
     Sets data.date_track to an empty list.
+    Sets data.running_metrics to an empty RunningMetrics in a lean
+    optimisation, otherwise to None.
     Sets data.cash to data.starting_amount.
     Sets data.wealth to data.starting_amount.
     Sets data.value_invested to 0
-    Recreates data.trade_df with the appropriate column headers.
+    Recreates data.trade_ledger as an empty trade ledger. data.trade_df is only
+    built from the ledger at the end of each backtest.
+    Recreates data.order_book with no resting orders.
 
+    Parameters
+    ----------
+    context : BacktestContext, default None
+        The backtest to reset. If None, the active context is used.
 
     Returns
     -------
     None.
 
     """
-    data.start_date = data.all_dates[0]
-    data.positions_tracker = pd.DataFrame(index=data.daily_closes.index, columns=data.daily_closes.columns)
-    data.current_date = data.start_date
-    data.current_price = data.daily_closes.loc[data.current_date]
-
-    data.wealth_track = []
-    data.date_track = []
-    data.current_positions = set()
+    ctx = context if context is not None else get_context()
+    ctx.start_date = ctx.all_dates[0]
+    ctx.position_log = PositionLog()
+    ctx.current_date = ctx.start_date
+    ctx.current_index = ctx.price_panels.dates.get_loc(ctx.current_date)
+    ctx.current_price = ctx.price_panels.row('closes', ctx.current_index)
+    ctx.current_phase = 'close'
+    ctx.current_is_oos = False
+
+    ctx.wealth_track = []
+    ctx.date_track = []
+    ctx.running_metrics = RunningMetrics() if ctx.lean else None
+    ctx.current_positions = set()
     # data.starting_amount = 100000
-    data.cash = data.starting_amount
-    data.wealth = data.starting_amount
-    data.value_invested = 0
-    data.profit = 0
+    ctx.cash = ctx.starting_amount
+    ctx.wealth = ctx.starting_amount
+    ctx.value_invested = 0
+    ctx.profit = 0
 
-    columns = ['long_or_short', 'symbol', 'open_date', 'open_price', 'amount',
-               'open_value', 'open_reason', 'close_date', 'close_price',
-               'close_value', 'close_reason', 'profit', 'profit%', 'entry_timing', 'exit_timing']
-    data.trade_df = pd.DataFrame(columns=columns)
+    ctx.trade_ledger = TradeLedger(symbols=ctx.price_panels.symbols)
+    ctx.order_book = OrderBook()
+    ctx.trade_df = None
 
-    data.number_of_trades = 0
-    data.number_winning_trades = 0
-    data.profit_percent_array = np.array([])
+    ctx.number_of_trades = 0
+    ctx.number_winning_trades = 0
+    ctx.profit_percent_array = np.array([])
 
 
-def update():
+@on_every_account
+def update(context=None):
     """
     Call this function at the end of each day of the backtest to calculate the
-    current equity of that day.
+    current equity of that day, which is added to data.wealth_track, or to
+    data.running_metrics in a lean optimisation. Open positions are valued from the running
+    share counts in data.trade_ledger and data.profit is set to the realised
+    profit of all closed trades. The day's high and low are added to the
+    highest high and lowest low of each open trade used by `check_take_profit`.
+
+    Parameters
+    ----------
+    context : BacktestContext, default None
+        The backtest to update. If None, the active context is used.
 
     Returns
     -------
     None.
 
     """
-    total_wealth = data.cash
-    all_open_trade_rows = data.trade_df[data.trade_df['close_price'].isnull()]
-    current_position_value = 0
-    for index, row in all_open_trade_rows.iterrows():
-        current_value = row['amount'] * data.current_price[row['symbol']]
-        if row['long_or_short'] == 'long':
-            current_position_value += current_value
-        else:
-            current_position_value -= (2 * row['open_value']) - current_value
-    total_wealth += current_position_value
-    data.wealth_track.append(total_wealth)
-    data.date_track.append(data.current_date)
-    if data.optimising:
-        all_closed_rows = data.trade_df[~data.trade_df['close_price'].isnull()]
-        data.number_of_trades += len(all_closed_rows)
-        data.number_winning_trades += len(all_closed_rows[all_closed_rows['profit'] > 0])
-        data.profit_percent_array = np.append(data.profit_percent_array, all_closed_rows['profit%'])
-        data.trade_df.drop(all_closed_rows.index, inplace=True)
-        data.trade_df.reset_index(drop=True, inplace=True)
-        data.profit += all_closed_rows['profit'].sum()
+    ctx = context if context is not None else get_context()
+    ledger = ctx.trade_ledger
+    total_wealth = ctx.cash + ledger.open_position_value(ctx.current_price.values)
+    if ctx.lean:
+        ctx.running_metrics.add(ctx.current_date, total_wealth)
+    else:
+        ctx.wealth_track.append(total_wealth)
+        ctx.date_track.append(ctx.current_date)
+    ctx.profit = ledger.realised_profit
+    panels = ctx.price_panels
+    if panels.highs is not None and panels.lows is not None:
+        ledger.update_extremes(panels.highs[ctx.current_index], panels.lows[ctx.current_index])
+
+
+@on_every_account
+def update_idle_bars(start, stop, context=None):
+    """
+    Does what `update` does for every date from data.all_dates[start] up to
+    data.all_dates[stop], on which nothing is traded.
+
+    As the positions do not change, the equity of all the dates is worked out
+    at once from the shares held and the close prices, and the highs and lows
+    of all the dates are added to the open trades in one step.
+
+    Parameters
+    ----------
+    start, stop : int
+        The positions in data.all_dates of the first date and of the date
+        after the last date.
+    context : BacktestContext, default None
+        The backtest to update. If None, the active context is used.
+
+    Returns
+    -------
+    None.
+
+    """
+    ctx = context if context is not None else get_context()
+    if stop <= start:
+        return
+    ledger = ctx.trade_ledger
+    panels = ctx.price_panels
+    dates = ctx.all_dates[start:stop]
+    rows = panels.dates.get_indexer(dates)
+    held = ledger.held_columns()
+    open_value = panels.closes[rows][:, held] @ ledger.net_shares[held] - 2 * ledger.short_open_value
+    if ctx.lean:
+        ctx.running_metrics.add_many(dates, ctx.cash + open_value)
     else:
-        data.profit = data.trade_df['profit'].sum()
+        ctx.wealth_track.extend(ctx.cash + open_value)
+        ctx.date_track.extend(dates)
+    ctx.current_date = dates[-1]
+    ctx.current_index = rows[-1]
+    ctx.current_price = panels.row('closes', rows[-1])
+    ctx.profit = ledger.realised_profit
+    if len(held) and panels.highs is not None and panels.lows is not None:
+        ledger.update_extremes(np.fmax.reduce(panels.highs[rows], axis=0), np.fmin.reduce(panels.lows[rows], axis=0))
+
+
+def positions_track(context=None):
+    """
+    Builds the number of shares held of each symbol on each date.
+
+    The positions are built from data.position_log, so only symbols which
+    were held at some point in the backtest are included. Rows start on the
+    date of the first trade and positions are carried forward to the last date
+    of the price data.
+
+    Parameters
+    ----------
+    context : BacktestContext, default None
+        The backtest to build the positions of. If None, the active context is
+        used.
+
+    Returns
+    -------
+    pandas-dataframe
+        The shares held, indexed by date with a column for each symbol held.
+
+    """
+    ctx = context if context is not None else get_context()
+    panels = ctx.price_panels
+    days, columns, track = ctx.position_log.positions(len(panels.dates))
+    return pd.DataFrame(track, index=panels.dates[days], columns=panels.symbols[columns])
+
+
+def value_track(context=None):
+    """
+    Builds the value of each position held on each date at the close.
+
+    Parameters
+    ----------
+    context : BacktestContext, default None
+        The backtest to value the positions of. If None, the active context is
+        used.
+
+    Returns
+    -------
+    pandas-dataframe
+        The value of each position, indexed by date with a column for each
+        symbol held and a 'Total' column of the value of all positions.
+
+    """
+    ctx = context if context is not None else get_context()
+    panels = ctx.price_panels
+    days, columns, track = ctx.position_log.positions(len(panels.dates))
+    values = pd.DataFrame(track * panels.closes[days][:, columns], index=panels.dates[days],
+                          columns=panels.symbols[columns])
+    values.loc[:, 'Total'] = values.sum(axis=1)
+    return values
 
 
 def plot_results(benchmark=None,
@@ -1263,7 +1928,8 @@ def plot_results(benchmark=None,
                  end_date=datetime.now().date(),
                  title=None,
                  date_format='%d/%m/%Y',
-                 equity_label='OpenEquity'):
+                 equity_label='OpenEquity',
+                 context=None):
     """
     Produces a plotly plot that automatically opens in the default browser.
 
@@ -1283,6 +1949,8 @@ def plot_results(benchmark=None,
         The format that the dates are in the benchmark data.
     equity_label : str, default 'OpenEquity'
         The column header of the equity column of the benchmark file provided.
+    context : BacktestContext, default None
+        The backtest to plot. If None, the active context is used.
 
     Notes
     -----
@@ -1290,9 +1958,10 @@ def plot_results(benchmark=None,
     tradestation for various useful graphs.
 
     """
-    wealth_list = [x - data.starting_amount for x in data.wealth_track]
+    ctx = context if context is not None else get_context()
+    wealth_list = [x - ctx.starting_amount for x in ctx.wealth_track]
     equity_df = pd.DataFrame(columns=['date', 'equity'])
-    equity_df['date'] = data.date_track
+    equity_df['date'] = ctx.date_track
     equity_df['equity'] = wealth_list
     equity_df.set_index('date', inplace=True)
     equity_df = equity_df.loc[start_date:end_date]
@@ -1341,6 +2010,11 @@ def run(stock_data,
         in_out_sampling=None,
         opt_results_save_loc='',
         opt_params=None,
+        opt_constraints=(),
+        opt_chunk_size=100000,
+        opt_budget=None,
+        opt_objective='Rate / StdDev',
+        opt_seed=None,
         data_fields=('Open', 'High', 'Low', 'Close'),
         data_adjustment='TotalReturn',
         start_when_all_in=False,
@@ -1352,15 +2026,30 @@ def run(stock_data,
         data_source='Norgate',
         start_date=date(2000, 1, 1),
         end_date=datetime.now().date(),
+        every_day_callbacks='always',
+        checkpoint_every=None,
+        checkpoint_path=None,
+        checkpoint_user_state=(),
+        resume_from=None,
+        save_state_to=None,
+        lean=False,
+        replay_top=0,
+        replay_by='Rate / StdDev',
+        accounts=None,
+        workers=None,
+        coordinate_at=None,
+        work_for=None,
         auto_plot=True,
-        plot_title='Backtest'):
+        plot_title='Backtest',
+        context=None):
     """
     The function used to run a backtest or exhaustive optimisation.
 
     Call this function at the end of your code which contains five functions: before_backtest_start,
     trade_every_day_open, trade_open, trade_close, and trade_every_day_close. These functions will be called at the
     appropriate times for the backtest to take place. Advisable to calculate all indicator dataframes in
-    before_backtest_start, and store in `user`. These can then be called in the other functions.
+    before_backtest_start, and store in `user`. These can then be called in the other functions. Daily callbacks which
+    do nothing, such as the empty functions in TEMPLATE.py, are detected before the backtest and never called.
 
     Parameters
     ----------
@@ -1378,7 +2067,8 @@ def run(stock_data,
         trade_open.
     trade_open : function
         A function which will be called at the frequency defined by rebalance. At this point data.current price will be
-        the open price of all the stocks on data.current_date.
+        the open price of all the stocks on data.current_date. data.current_index is the row number of
+        data.current_date in the arrays of data.price_panels.
     trade_close : function
         A function which will be called at the frequency defined by rebalance. At this point data.current price will be
         the close price of all the stocks on data.current_date.
@@ -1389,13 +2079,33 @@ def run(stock_data,
     after_backtest_finish : function
         A function that is called at the end of the backtest. Here you can record any extra desired data or make your
         own adjustments to any of the results. It is also possible to use `Backtest.plot_results` to use the function
-        to its full potential.
+        to its full potential. The trade list is in data.trade_df, also after each test of an optimisation.
     opt_results_save_loc : str, default ''
         The path to the directory you would like to save the optimisation report to. Will be unused if running a single
         backtest.
+    optimise_type : str, default 'combination'
+        How the combinations of `opt_params` are tested. 'combination' tests every combination of the values and
+        'fixed' tests the first value of every parameter, then the second and so on. 'random', 'latin_hypercube' and
+        'bayesian' test `opt_budget` combinations of the grid of 'combination': picked at random, spread evenly over
+        the values of every parameter, or picked one after another from the results so far to maximise
+        `opt_objective`. Their test numbers are their numbers in the full grid. See `Optimise.CombinationSource`.
     opt_params : dict, default None
         The parameters that need to be optimised. Put the name of the variable as the key and the value to be the tuple
         of values that you wish to optimise over.
+    opt_constraints : tuple, default ()
+        Functions which are passed a dict of the parameters of a combination, keyed by their names in `opt_params`, and
+        return False if it should not be tested, eg. (lambda p: p['fast'] < p['slow'],). The test numbers of the
+        combinations skipped are left out of the optimisation report. See `Optimise.CombinationSource`.
+    opt_chunk_size : int, default 100000
+        The number of combinations made at once. The combinations are made as they are needed, so grids of any size
+        can be optimised, and data.combination_df only holds the combinations of the tests being run.
+    opt_budget : int, default None
+        The number of tests run by the search types of `optimise_type`.
+    opt_objective : str, default 'Rate / StdDev'
+        The column of the optimisation report a 'bayesian' search maximises.
+    opt_seed : int, default None
+        Seeds the combinations picked by a search, so the same tests are run each time. Needed to resume a 'random'
+        or 'latin_hypercube' search from a checkpoint.
     data_fields : tuple, default ('Open', 'High', 'Low', 'Close')
         The fields needed for the backtest to take place. As a minimum you need 'Open' and 'Close'
     data_adjustment : str, default 'TotalReturn'
@@ -1420,16 +2130,85 @@ def run(stock_data,
         in the `after_backtest_finish` function.
     plot_title : str, default 'Backtest'
         The title for the plotly plot. This will only be used if `auto_plot` is set to True.
+    every_day_callbacks : str, default 'always'
+        When `trade_every_day_open` and `trade_every_day_close` are needed on dates which are not rebalance dates.
+        'always' calls them every date. 'when_holding' only calls them while a position or resting order is open,
+        which suits callbacks that only check stop losses. 'never' only calls them on rebalance dates. Dates on which
+        nothing is called, including every date between rebalances if both callbacks do nothing, are skipped and their
+        equity is filled in at once by `update_idle_bars`.
+    checkpoint_every : int, default None
+        Save the state of the backtest to `checkpoint_path` every `checkpoint_every` dates, see
+        `checkpoint.save_checkpoint`. No checkpoints are saved if None.
+    checkpoint_path : str, default None
+        The file to save checkpoints to. It can contain the fields {test} and {date}, the test number and the last date
+        run, eg. 'checkpoints/test{test}_{date:%Y%m%d}.ckpt' keeps every checkpoint. Otherwise each checkpoint replaces
+        the last.
+    checkpoint_user_state : tuple, default ()
+        The names of the attributes of `user` which the strategy changes from date to date and so are saved in each
+        checkpoint, eg. ('days_in_trade',). Anything set in `before_backtest_start` is set again on resume.
+    resume_from : str, default None
+        A checkpoint file to carry on from. The other arguments must be the same as the run which saved it. The tests
+        before the saved test are skipped and the saved test carries on from the date after the checkpoint, calling
+        `before_backtest_start` first so indicators are recalculated. If the checkpoint was saved by `save_state_to`,
+        only the dates after it are loaded from `data_source` and added to the saved data, so a backtest can be brought
+        up to `end_date` by running just the new dates.
+    save_state_to : str, default None
+        The file to save the state of a single backtest to after its last date, before the positions still open are
+        closed, including all the data loaded. Pass it as `resume_from` to a later run to carry the backtest on.
+        Adjusted prices saved are not updated for dividends or splits after the save, so run the full backtest again
+        from time to time.
+    lean : bool, default False
+        When optimising, keep only what the optimisation report needs: the trade statistics and running drawdown and
+        yearly profit figures in data.running_metrics. No wealth track is kept, so `Optimise.plot_tests` cannot be
+        used, and trade lists are never built.
+    replay_top : int, default 0
+        When optimising, run the best `replay_top` tests by `replay_by` again after the optimisation with full results.
+        The results of each are stored in data.replay_results by test number, in the same form as the results of a
+        single backtest, and are plotted if `auto_plot` is True.
+    replay_by : str, default 'Rate / StdDev'
+        The column of the optimisation report the best tests are chosen by, highest first.
+    accounts : list, default None
+        Run a single backtest in several accounts at once, given as a list of dicts of the arguments of
+        `accounts.Account`: 'starting_cash', and optionally 'compound' and 'able_to_exceed' to override those arguments
+        of every order. The callbacks run once, in the first account, and every order they place is also placed in
+        each other account with its own sizing and cash, so the accounts can only differ in the number of shares held.
+        `starting_cash` is not used. The results of each account are stored in data.account_results, and the results
+        of the first account are returned.
+    workers : int, default None
+        When optimising, run the tests in a pool of `workers` processes. Each process is sent the data and `user` once,
+        after `before_everything_starts`, and runs `before_backtest_start`, the backtest and `after_backtest_finish` of
+        each test it is given. The price data, and any data frames of numbers stored in `user` by
+        `before_everything_starts`, are published once in shared memory which every process reads without a copy, see
+        `shared_data.SharedData`, so they are read-only in the tests. The results are recorded in test order, so the
+        optimisation report and wealth tracks are the same as running the tests one after another, as long as no test
+        depends on anything left by the test before it, eg. seed random numbers in `before_backtest_start`. The
+        callbacks and `user` must be picklable, and on Windows the script must call `run` under
+        `if __name__ == '__main__':`. Cannot be used with checkpoints. The tests are run in this process if None.
+    coordinate_at : tuple, default None
+        When optimising, hand the tests out to workers on any number of machines instead of running them, and record
+        their results in test order, see `distributed.coordinate`. The (host, port) to listen on, eg. ('0.0.0.0',
+        5050). Start each worker by running the same script, with the same data and parameters, with `work_for` set to
+        the address of this machine. Tests of a worker which stops are given to the others. Cannot be used with
+        checkpoints.
+    work_for : tuple, default None
+        When optimising, run tests for the coordinator at this (host, port) until it has none left, instead of running
+        the optimisation. Only the list of the test numbers run is returned. Start one worker for each core to be used.
+    context : BacktestContext, default None
+        The context to run the backtest in. The callbacks are passed `context.user` and `context` as `user` and `data`.
+        If None, the active context is used, which outside of another backtest is the default context that the `data`
+        module reads from. Pass a new BacktestContext to run backtests side by side, for example in threads.
 
     Returns
     -------
     If you are optimising:
         data.optimisation_report : pandas-dataframe
             The optimisation report from all the backtests. This will also be exported to the directory if provided.
+            The results of the tests replayed because of `replay_top` are in data.replay_results.
 
     If you are running a single backtest:
         data.trade_df : A trade list of the backtest.
         positions_track : A dataframe containing data about how many stocks were held of each stock on each date.
+                          Only stocks which were held at some point are included.
         value_track : A dataframe containing data about the value of each position held on each day, including the
                       the total value of all held positions.
 
@@ -1439,11 +2218,659 @@ def run(stock_data,
     >>>Please see Nick for help
 
     """
-    if opt_params is None or not optimise:
-        opt_params = {}
-    data.starting_amount = starting_cash
+    ctx = context if context is not None else get_context()
+    with activate(ctx):
+        if opt_params is None or not optimise:
+            opt_params = {}
+        if accounts is not None:
+            ctx.accounts = [Account(**account) for account in accounts]
+            ctx.account_overrides = ctx.accounts[0].overrides
+            starting_cash = ctx.accounts[0].starting_cash
+        else:
+            ctx.accounts = None
+            ctx.account_overrides = {}
+        ctx.active_account = 0
+        ctx.starting_amount = starting_cash
+        resume_state = checkpoint.load_checkpoint(resume_from) if resume_from is not None else None
+
+        trading_dates = _run_load_data(stock_data,
+                                       data_source,
+                                       start_date,
+                                       end_date,
+                                       max_lookback,
+                                       data_fields,
+                                       data_adjustment,
+                                       start_when_all_in,
+                                       ffill_prices,
+                                       rebalance,
+                                       offset,
+                                       saved_prices=resume_state.get('prices') if resume_state is not None else None,
+                                       context=ctx)
+        Optimise.create_variable_combinations_dict(opt_params, optimise_type, constraints=opt_constraints,
+                                                   chunk_size=opt_chunk_size, budget=opt_budget,
+                                                   objective=opt_objective, seed=opt_seed, batch_size=workers or 1,
+                                                   context=ctx)
+        number_of_rows = ctx.combinations.count()
+        print('Total number of tests:', number_of_rows)
+        if number_of_rows == 0:
+            raise ValueError('No combination of opt_params meets the opt_constraints')
+
+        if number_of_rows == 1:
+            ctx.optimising = False
+        else:
+            if accounts is not None:
+                raise ValueError('accounts can only be used to run a single backtest')
+            ctx.optimising = True
+            if in_out_sampling is not None:
+                ctx.is_dates, ctx.oos_dates = get_in_out_sample_dates(in_out_sampling, context=ctx)
+            else:
+                ctx.is_dates = ctx.all_dates
+                ctx.oos_dates = pd.DatetimeIndex([])
+        build_day_schedule(trading_dates, context=ctx)
+        daily_callbacks = [None if callback_does_nothing(func) else func
+                           for func in (trade_open, trade_every_day_open, trade_close, trade_every_day_close)]
+        if callback_does_nothing(after_backtest_finish):
+            after_backtest_finish = None
+        if every_day_callbacks not in ('always', 'when_holding', 'never'):
+            raise ValueError('every_day_callbacks must be either "always", "when_holding" or "never"')
+        if checkpoint_every and checkpoint_path is None:
+            raise ValueError('A checkpoint_path is needed to save a checkpoint every {} dates'.format(checkpoint_every))
+        if ctx.optimising and (checkpoint_every or resume_state is not None) and \
+                (workers is not None or coordinate_at is not None or work_for is not None):
+            raise ValueError('An optimisation run by workers cannot save or resume from checkpoints')
+        if ctx.combinations.optimise_type == 'bayesian' and \
+                (checkpoint_every or resume_state is not None or coordinate_at is not None):
+            raise ValueError('A bayesian search cannot use checkpoints or be coordinated, use workers instead')
+        skip_idle_bars = every_day_callbacks == 'never' or (daily_callbacks[1] is None and daily_callbacks[3] is None)
+        skip_flat_bars = every_day_callbacks == 'when_holding'
+        ctx.lean = lean and ctx.optimising
+
+        before_everything_starts(ctx.user, ctx)
+
+        first_test = resume_state['test_number'] if resume_state is not None else 0
+
+        test_args = (before_backtest_start, *daily_callbacks, after_backtest_finish, skip_idle_bars, skip_flat_bars)
+        if work_for is not None and ctx.optimising:
+            return distributed.work(work_for, lambda i: _measure_test(i, test_args, context=ctx), context=ctx)
+        elif coordinate_at is not None and ctx.optimising:
+            distributed.coordinate(coordinate_at, opt_results_save_loc=opt_results_save_loc, context=ctx)
+        elif workers is not None and ctx.optimising:
+            _run_tests_in_pool(workers, test_args, opt_results_save_loc, context=ctx)
+        else:
+            with tqdm(total=number_of_rows, position=0) as pbar:
+                for chunk in Optimise.combination_chunks(context=ctx):
+                    if chunk[-1] < first_test:
+                        pbar.update(len(chunk))
+                        continue
+                    Optimise.load_combinations(chunk, context=ctx)
+                    for i in chunk:
+                        if i < first_test:
+                            pbar.update(1)
+                            continue
+                        _run_test(i,
+                                  before_backtest_start,
+                                  *daily_callbacks,
+                                  after_backtest_finish,
+                                  skip_idle_bars,
+                                  skip_flat_bars,
+                                  pbar,
+                                  resume_state=resume_state,
+                                  checkpoint_every=checkpoint_every,
+                                  checkpoint_path=checkpoint_path,
+                                  checkpoint_user_state=checkpoint_user_state,
+                                  save_state_to=save_state_to,
+                                  context=ctx)
+                        resume_state = None
+
+                        if ctx.optimising:
+                            Optimise.record_backtest(combination_row=i, context=ctx)
+                            if opt_results_save_loc != '':
+                                ctx.optimisation_report.to_csv('{}\\temp.csv'.format(opt_results_save_loc),
+                                                               index=True, index_label='Test_Number')
+                        pbar.update(1)
+
+        if ctx.optimising:
+            if opt_results_save_loc != '':
+                ctx.optimisation_report.to_csv(
+                    '{}\\Results_{}.csv'.format(opt_results_save_loc, datetime.now().strftime('%d%m%y %H%M')),
+                    index=True, index_label='Test_Number')
+            if replay_top:
+                ctx.lean = False
+                ctx.replay_results = {}
+                best_tests = ctx.optimisation_report[replay_by].astype(float).nlargest(replay_top).index
+                with tqdm(best_tests, position=0, desc='Replaying best tests') as pbar:
+                    for i in pbar:
+                        _run_test(i,
+                                  before_backtest_start,
+                                  *daily_callbacks,
+                                  after_backtest_finish,
+                                  skip_idle_bars,
+                                  skip_flat_bars,
+                                  pbar,
+                                  full_results=True,
+                                  context=ctx)
+                        ctx.replay_results[i] = _run_single_results(data_source, auto_plot, start_date, end_date,
+                                                                    '{} Test {}'.format(plot_title, i), context=ctx)
+            return ctx.optimisation_report
+
+        elif ctx.accounts is not None:
+            ctx.account_results = []
+            for number, account in enumerate(ctx.accounts):
+                select_account(number, context=ctx)
+                ctx.trade_df = ctx.trade_ledger.to_dataframe()
+                ctx.account_results.append(_run_single_results(data_source, auto_plot, start_date, end_date,
+                                                               '{} {}'.format(plot_title, account), context=ctx))
+            select_account(0, context=ctx)
+            return ctx.account_results[0]
 
-    if data_source == 'Norgate':
+        else:
+            return _run_single_results(data_source, auto_plot, start_date, end_date, plot_title, context=ctx)
+
+
+def _run_test(i,
+              before_backtest_start,
+              trade_open,
+              trade_every_day_open,
+              trade_close,
+              trade_every_day_close,
+              after_backtest_finish,
+              skip_idle_bars,
+              skip_flat_bars,
+              pbar,
+              full_results=False,
+              resume_state=None,
+              checkpoint_every=None,
+              checkpoint_path=None,
+              checkpoint_user_state=(),
+              save_state_to=None,
+              context=None):
+    # Runs the backtest of test number i of data.combinations. Callbacks which do nothing are passed as None
+    ctx = context if context is not None else get_context()
+    for variable, value in ctx.combinations.combination(i).items():
+        if variable[:5] == 'user.':
+            variable = variable[5:]
+        setattr(ctx.user, variable, value)
+
+    before_backtest_start(ctx.user, ctx)
+    initialise(context=ctx)
+    # pbar = tqdm(total=len(data.all_dates), desc='Test {}'.format(str(i + 1)), position=0, leave=True)
+    number_of_bars = len(ctx.all_dates)
+    progress = 0
+    n = 0
+    if resume_state is not None:
+        checkpoint.restore_checkpoint(resume_state, context=ctx)
+        n = resume_state['bar']
+        progress = 100 * n
+    last_checkpoint = n
+    while n < number_of_bars:
+        if checkpoint_every and n - last_checkpoint >= checkpoint_every:
+            checkpoint.save_checkpoint(checkpoint_path.format(test=i, date=ctx.all_dates[n - 1]), n,
+                                       test_number=i, user_state=checkpoint_user_state, context=ctx)
+            last_checkpoint = n
+        rebalance_today = ctx.rebalance_days[n]
+        if not rebalance_today and not ctx.order_book and \
+                (skip_idle_bars or (skip_flat_bars and not ctx.trade_ledger.open_lots)):
+            # Nothing can trade until the next rebalance, so jump straight to it
+            next_bar = ctx.next_rebalance[n]
+            update_idle_bars(n, next_bar, context=ctx)
+            progress += 100 * (next_bar - n)
+            n = next_bar
+            continue
+        d = ctx.all_dates[n]
+        day_index = ctx.day_indices[n]
+        ctx.current_date = d
+        ctx.current_index = day_index
+        ctx.current_is_oos = ctx.oos_days[n]
+
+        ctx.current_price = ctx.price_panels.row('opens', day_index)
+        ctx.current_phase = 'open'
+
+        if rebalance_today and trade_open is not None:
+            trade_open(ctx.user, ctx)
+
+        if trade_every_day_open is not None:
+            trade_every_day_open(ctx.user, ctx)
+        ctx.current_price = ctx.price_panels.row('closes', day_index)
+        ctx.current_phase = 'close'
+
+        if ctx.order_book:
+            fill_resting_orders(context=ctx)
+
+        if rebalance_today and trade_close is not None:
+            trade_close(ctx.user, ctx)
+
+        if trade_every_day_close is not None:
+            trade_every_day_close(ctx.user, ctx)
+
+        update(context=ctx)
+        # pbar.update(1)
+        progress += 100
+        if pbar is not None:
+            pbar.set_postfix(inner_loop=int(progress/number_of_bars), refresh=True)
+        n += 1
+    if save_state_to is not None and not ctx.optimising:
+        checkpoint.save_checkpoint(save_state_to, n, test_number=i, user_state=checkpoint_user_state,
+                                   include_prices=True, context=ctx)
+    close_all_positions(close_reason='End of Backtest', exec_timing='close', context=ctx)
+
+    if ctx.optimising and not full_results:
+        closed_rows = ctx.trade_ledger.closed_rows()
+        ctx.number_of_trades = len(closed_rows)
+        ctx.number_winning_trades = int((ctx.trade_ledger['profit'][closed_rows] > 0).sum())
+        ctx.profit_percent_array = ctx.trade_ledger['profit%'][closed_rows]
+    if not ctx.optimising or full_results or after_backtest_finish is not None:
+        # When optimising, the trade list is only built for an after_backtest_finish to read
+        ctx.trade_df = ctx.trade_ledger.to_dataframe()
+
+    if after_backtest_finish is not None:
+        after_backtest_finish(ctx.user, ctx)
+
+
+# The context and test arguments of a process running tests for `_run_tests_in_pool`
+_pool_worker = {}
+
+
+def _start_worker(context, test_args):
+    # Runs once in each process of the pool, which keeps its copy of the context for every test it is given
+    _pool_worker['context'] = attach_context(context)
+    _pool_worker['test_args'] = test_args
+
+
+def _run_worker_test(i):
+    ctx = _pool_worker['context']
+    with activate(ctx):
+        return _measure_test(i, _pool_worker['test_args'], context=ctx)
+
+
+def _measure_test(i, test_args, context=None):
+    # Runs test i of an optimisation recorded by another process and returns its results
+    ctx = context if context is not None else get_context()
+    _run_test(i, *test_args, None, context=ctx)
+    return Optimise.backtest_results(i, context=ctx)
+
+
+def _run_tests_in_pool(workers, test_args, opt_results_save_loc, context=None):
+    # Runs every test of data.combinations in a pool of processes and records the results in test order, a chunk at a
+    # time. The data is published once in shared memory, which is freed when the pool has finished, even if a test
+    # raises
+    ctx = context if context is not None else get_context()
+    with SharedData(ctx) as shared, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_start_worker, initargs=(shared.context, test_args)) \
+            as pool, tqdm(total=ctx.combinations.count(), position=0) as pbar:
+        for chunk in Optimise.combination_chunks(context=ctx):
+            Optimise.load_combinations(chunk, context=ctx)
+            for i, results in zip(chunk, pool.map(_run_worker_test, chunk)):
+                Optimise.record_backtest(combination_row=i, results=results, context=ctx)
+                if opt_results_save_loc != '':
+                    ctx.optimisation_report.to_csv('{}\\temp.csv'.format(opt_results_save_loc),
+                                                   index=True, index_label='Test_Number')
+                pbar.update(1)
+
+
+def run_target_weights(stock_data,
+                       targets,
+                       target_type='percent',
+                       exec_timing='close',
+                       compound=False,
+                       able_to_exceed=True,
+                       min_to_enter=10,
+                       open_reason=None,
+                       close_reason=None,
+                       data_fields=('Open', 'High', 'Low', 'Close'),
+                       data_adjustment='TotalReturn',
+                       start_when_all_in=False,
+                       ffill_prices=True,
+                       rebalance='daily',
+                       offset=0,
+                       max_lookback=200,
+                       starting_cash=100000,
+                       data_source='Norgate',
+                       start_date=date(2000, 1, 1),
+                       end_date=datetime.now().date(),
+                       auto_plot=True,
+                       plot_title='Backtest',
+                       context=None):
+    """
+    Runs a backtest which holds a matrix of target weights, without callbacks.
+
+    This is a faster alternative to `run` for strategies which only work out
+    what to hold. On each rebalance date every symbol is ordered to its target
+    as if `Orders(symbol).order_target_percent(weight)` (or
+    `order_target_amount` for share targets) was called for each symbol in
+    column order, so trades, `min_to_enter` and `able_to_exceed` behave exactly
+    as in `run`. The targets of all symbols are sized at once with array
+    operations and only symbols whose position changes are ordered. Nothing is
+    done on the dates between rebalances, and the equity of every date is
+    worked out at the end from the position log.
+
+    Parameters
+    ----------
+    stock_data : str or list
+        See `run`.
+    targets : pandas-dataframe or callable
+        The target of each symbol on each date, with a row for each date and a
+        column for each symbol. A NaN target, or a symbol or date which is not
+        in `targets`, leaves the position unchanged. Only the targets on
+        rebalance dates are used, and they are traded on that date, so any lag
+        needs to be built in to `targets`. If a function is given, it is called
+        as `targets(user, data)` once the data is loaded and must return the
+        dataframe, so the targets can be worked out from data.daily_closes.
+    target_type : str, default 'percent'
+        'percent' if `targets` are the percent of capital to hold, as in
+        `order_target_percent`, or 'amount' if they are numbers of shares.
+    exec_timing : str, default 'close'
+        Whether orders are placed at the 'open' or the 'close' of the
+        rebalance date.
+    compound, able_to_exceed, min_to_enter
+        Passed to each order, see `Orders`.
+    open_reason, close_reason : str, default None
+        Populates the 'open_reason' and 'close_reason' columns of the trade
+        list.
+    data_fields, data_adjustment, start_when_all_in, ffill_prices, rebalance, offset, max_lookback, starting_cash,
+    data_source, start_date, end_date, auto_plot, plot_title
+        See `run`.
+    context : BacktestContext, default None
+        The context to run the backtest in. If None, the active context is
+        used.
+
+    Returns
+    -------
+    dict
+        The same results as a single backtest of `run`.
+
+    Examples
+    --------
+    >>> def momentum_weights(user, data):
+    ...     ranks = data.daily_closes.pct_change(120).rank(axis=1, ascending=False)
+    ...     return (ranks <= 10).astype(float).shift(1) * 0.1
+    >>> results = run_target_weights(['Liquid_500'], momentum_weights, rebalance='month-end')
+
+    """
+    if target_type not in ('percent', 'amount'):
+        raise ValueError('target_type must be either "percent" or "amount"')
+    ctx = context if context is not None else get_context()
+    with activate(ctx):
+        ctx.starting_amount = starting_cash
+        trading_dates = _run_load_data(stock_data,
+                                       data_source,
+                                       start_date,
+                                       end_date,
+                                       max_lookback,
+                                       data_fields,
+                                       data_adjustment,
+                                       start_when_all_in,
+                                       ffill_prices,
+                                       rebalance,
+                                       offset,
+                                       context=ctx)
+        ctx.optimising = False
+        build_day_schedule(trading_dates, context=ctx)
+        if callable(targets):
+            targets = targets(ctx.user, ctx)
+        panels = ctx.price_panels
+        targets = targets.reindex(index=panels.dates, columns=panels.symbols).to_numpy(dtype=np.float64)
+        price_field = 'opens' if exec_timing == 'open' else 'closes'
+
+        initialise(context=ctx)
+        ledger = ctx.trade_ledger
+        day_indices = panels.dates.get_indexer(ctx.all_dates)
+        rebalance_indices = day_indices[ctx.rebalance_days]
+        cash_after = np.empty(len(rebalance_indices))
+        short_value_after = np.empty(len(rebalance_indices))
+        for n, day_index in enumerate(rebalance_indices):
+            ctx.current_date = panels.dates[day_index]
+            ctx.current_index = day_index
+            ctx.current_price = panels.row(price_field, day_index)
+            target = targets[day_index]
+            if target_type == 'percent':
+                capital = ctx.starting_amount + ledger.realised_profit if compound else ctx.starting_amount
+                target_value = target * capital
+                prices = ctx.current_price.values
+                target = np.where(target_value >= 0, np.floor(target_value / prices), np.ceil(target_value / prices))
+            current = ledger.net_shares
+            change = target - current
+            adding = ((target > current) & (current >= 0)) | ((target < current) & (current <= 0))
+            to_order = (change != 0) & ~np.isnan(change) & ~(adding & (np.abs(change) < min_to_enter))
+            for column in np.flatnonzero(to_order):
+                Orders(panels.symbols[column],
+                       open_reason=open_reason,
+                       close_reason=close_reason,
+                       exec_timing=exec_timing,
+                       compound=compound,
+                       able_to_exceed=able_to_exceed,
+                       min_to_enter=min_to_enter,
+                       context=ctx).order_target_amount(target[column])
+            cash_after[n] = ctx.cash
+            short_value_after[n] = ledger.short_open_value
+
+        # Positions only change on rebalance dates, so each date is valued with the cash and positions held after
+        # the last rebalance on or before it
+        step = np.searchsorted(rebalance_indices, day_indices, side='right') - 1
+        cash = np.where(step >= 0, cash_after[step], ctx.starting_amount)
+        short_value = np.where(step >= 0, short_value_after[step], 0)
+        log_days, log_columns, shares = ctx.position_log.positions(len(panels.dates))
+        held_value = np.zeros(len(day_indices))
+        if len(log_days):
+            logged = day_indices >= log_days[0]
+            held_shares = np.nan_to_num(shares[day_indices[logged] - log_days[0]])
+            held_prices = panels.closes[day_indices[logged]][:, log_columns]
+            held_value[logged] = np.where(held_shares != 0, held_shares * held_prices, 0).sum(axis=1)
+        ctx.wealth_track = list(cash + (held_value - 2 * short_value))
+        ctx.date_track = list(ctx.all_dates)
+        ctx.profit = ledger.realised_profit
+
+        ctx.current_date = ctx.all_dates[-1]
+        ctx.current_index = day_indices[-1]
+        ctx.current_price = panels.row('closes', day_indices[-1])
+        for x in list(ctx.current_positions):
+            Orders(x, close_reason='End of Backtest', exec_timing='close', context=ctx).order_target_amount(0)
+        ctx.trade_df = ledger.to_dataframe()
+
+        return _run_single_results(data_source, auto_plot, start_date, end_date, plot_title, context=ctx)
+
+
+def run_signals(stock_data,
+                entries,
+                exits,
+                size=0.1,
+                stop_loss=None,
+                take_profit=None,
+                exec_timing='close',
+                compound=False,
+                able_to_exceed=True,
+                min_to_enter=10,
+                open_reason=None,
+                close_reason=None,
+                data_fields=('Open', 'High', 'Low', 'Close'),
+                data_adjustment='TotalReturn',
+                start_when_all_in=False,
+                ffill_prices=True,
+                rebalance='daily',
+                offset=0,
+                max_lookback=200,
+                starting_cash=100000,
+                data_source='Norgate',
+                start_date=date(2000, 1, 1),
+                end_date=datetime.now().date(),
+                auto_plot=True,
+                plot_title='Backtest',
+                context=None):
+    """
+    Runs a rule based backtest from entry and exit signals in a compiled loop.
+
+    The strategy is given as arrays instead of callbacks, so the whole bar loop,
+    including the fills, stop losses, take profits and equity, runs in
+    `compiled_engine.bar_loop`. The loop is compiled with Numba if it is
+    installed, and otherwise runs as plain Python with the same results.
+
+    The rules are those of a callback strategy which on each rebalance date
+    calls `Orders(symbol).order_target_amount(0)` for every held symbol whose
+    exit signal is True and `Orders(symbol).order_target_percent(size)` for
+    every symbol not held whose entry signal is True, in column order, and at
+    the close of every date calls `check_stop_loss(stop_loss)` and then
+    `check_take_profit(*take_profit)` for every held symbol. Only one trade of
+    each symbol is open at a time.
+
+    Parameters
+    ----------
+    stock_data : str or list
+        See `run`.
+    entries, exits : pandas-dataframe or callable
+        Boolean signals with a row for each date and a column for each symbol.
+        If a function is given, it is called as `entries(user, data)` once the
+        data is loaded and must return the dataframe.
+    size : float or pandas-dataframe or callable, default 0.1
+        The percent of capital to enter with, negative to sell short. Either
+        one value for every trade or a dataframe (or function returning one)
+        of the size on each date. A NaN size does not enter.
+    stop_loss : float, default None
+        The stop loss percent of `check_stop_loss`, checked against the day's
+        high and low. No stop loss is used if None.
+    take_profit : tuple, default None
+        The `floor_pct` and `giveback_pct` of `check_take_profit`. No take
+        profit is used if None.
+    exec_timing : str, default 'close'
+        Whether entries and exits are made at the 'open' or the 'close' of the
+        rebalance date. Stop losses and take profits are checked at the close.
+    compound, able_to_exceed, min_to_enter, open_reason, close_reason
+        See `Orders`. `close_reason` is used for exits on a signal.
+    data_fields, data_adjustment, start_when_all_in, ffill_prices, rebalance, offset, max_lookback, starting_cash,
+    data_source, start_date, end_date, auto_plot, plot_title
+        See `run`.
+    context : BacktestContext, default None
+        The context to run the backtest in. If None, the active context is
+        used.
+
+    Returns
+    -------
+    dict
+        The same results as a single backtest of `run`.
+
+    Examples
+    --------
+    >>> def entries(user, data):
+    ...     return data.daily_closes > data.daily_closes.rolling(200).mean()
+    >>> def exits(user, data):
+    ...     return data.daily_closes < data.daily_closes.rolling(200).mean()
+    >>> results = run_signals(['Liquid_500'], entries, exits, size=0.02, stop_loss=0.1, take_profit=(0.2, 0.5))
+
+    """
+    ctx = context if context is not None else get_context()
+    with activate(ctx):
+        ctx.starting_amount = starting_cash
+        trading_dates = _run_load_data(stock_data,
+                                       data_source,
+                                       start_date,
+                                       end_date,
+                                       max_lookback,
+                                       data_fields,
+                                       data_adjustment,
+                                       start_when_all_in,
+                                       ffill_prices,
+                                       rebalance,
+                                       offset,
+                                       context=ctx)
+        ctx.optimising = False
+        build_day_schedule(trading_dates, context=ctx)
+        initialise(context=ctx)
+        panels = ctx.price_panels
+        day_indices = panels.dates.get_indexer(ctx.all_dates)
+
+        def to_array(frame, dtype, fill_value):
+            if callable(frame):
+                frame = frame(ctx.user, ctx)
+            if not isinstance(frame, pd.DataFrame):
+                return np.full((len(day_indices), len(panels.symbols)), frame, dtype=dtype)
+            frame = frame.reindex(index=ctx.all_dates, columns=panels.symbols).fillna(fill_value)
+            return np.ascontiguousarray(frame.to_numpy(dtype=dtype))
+
+        entry_array = to_array(entries, np.bool_, False)
+        exit_array = to_array(exits, np.bool_, False)
+        size_array = to_array(size, np.float64, np.nan)
+        if (stop_loss is not None or take_profit is not None) and (panels.highs is None or panels.lows is None):
+            raise ValueError('Stop losses and take profits need High and Low data')
+        closes = np.ascontiguousarray(panels.closes[day_indices])
+        opens = np.ascontiguousarray(panels.opens[day_indices])
+        highs = np.ascontiguousarray(panels.highs[day_indices]) if panels.highs is not None else closes
+        lows = np.ascontiguousarray(panels.lows[day_indices]) if panels.lows is not None else closes
+        tp_floor, tp_giveback = take_profit if take_profit is not None else (np.nan, np.nan)
+        capacity = max(int(entry_array[ctx.rebalance_days].sum()), 1)
+        (wealth, t_column, t_open_row, t_open_price, t_amount, t_close_row, t_close_price, t_reason,
+         n_trades) = compiled_engine.bar_loop(opens, highs, lows, closes,
+                                              np.asarray(ctx.rebalance_days, dtype=np.bool_),
+                                              entry_array, exit_array, size_array,
+                                              exec_timing == 'open',
+                                              np.nan if stop_loss is None else float(stop_loss),
+                                              float(tp_floor), float(tp_giveback),
+                                              float(starting_cash), compound, able_to_exceed, min_to_enter,
+                                              capacity)
+
+        trades = slice(0, n_trades)
+        amount = t_amount[trades]
+        open_price = t_open_price[trades]
+        close_price = t_close_price[trades]
+        open_value = amount * open_price
+        close_value = amount * close_price
+        reasons = np.array([close_reason, 'Stop Loss', 'Take Profit', 'End of Backtest'], dtype=object)
+        timings = np.array([exec_timing, None, None, 'close'], dtype=object)
+        ctx.trade_df = pd.DataFrame({'long_or_short': np.where(amount > 0, 'long', 'short').astype(object),
+                                     'symbol': np.asarray(panels.symbols[t_column[trades]], dtype=object),
+                                     'open_date': ctx.all_dates[t_open_row[trades]],
+                                     'open_price': open_price,
+                                     'amount': amount,
+                                     'open_value': open_value,
+                                     'open_reason': open_reason,
+                                     'close_date': ctx.all_dates[t_close_row[trades]],
+                                     'close_price': close_price,
+                                     'close_value': close_value,
+                                     'close_reason': reasons[t_reason[trades]],
+                                     'profit': close_value - open_value,
+                                     'profit%': (close_value - open_value) / open_value * 100,
+                                     'entry_timing': exec_timing,
+                                     'exit_timing': timings[t_reason[trades]]},
+                                    columns=TRADE_COLUMNS)
+        ctx.wealth_track = list(wealth)
+        ctx.date_track = list(ctx.all_dates)
+        ctx.profit = ctx.trade_df['profit'].sum()
+
+        # Each trade changes the position on its open and close dates. A trade closed on the day it opened is
+        # recorded after its open
+        event_days = np.concatenate([t_open_row[trades], t_close_row[trades]])
+        event_order = np.concatenate([np.zeros(n_trades), np.ones(n_trades)])
+        order = np.lexsort((event_order, event_days))
+        event_columns = np.concatenate([t_column[trades], t_column[trades]])[order]
+        event_amounts = np.concatenate([amount, np.zeros(n_trades)])[order]
+        for day, column, held in zip(day_indices[event_days[order]], event_columns, event_amounts):
+            ctx.position_log.record(day, column, held)
+
+        return _run_single_results(data_source, auto_plot, start_date, end_date, plot_title, context=ctx)
+
+
+def _run_load_data(stock_data,
+                   data_source,
+                   start_date,
+                   end_date,
+                   max_lookback,
+                   data_fields,
+                   data_adjustment,
+                   start_when_all_in,
+                   ffill_prices,
+                   rebalance,
+                   offset,
+                   saved_prices=None,
+                   context=None):
+    ctx = context if context is not None else get_context()
+    if saved_prices is not None:
+        _run_append_new_data(saved_prices,
+                             stock_data,
+                             data_source,
+                             end_date,
+                             data_fields,
+                             data_adjustment,
+                             start_when_all_in,
+                             ffill_prices,
+                             context=ctx)
+    elif data_source == 'Norgate':
         _run_download_data_norgate(stock_data,
                                    start_date,
                                    end_date,
@@ -1451,149 +2878,90 @@ def run(stock_data,
                                    data_fields,
                                    data_adjustment,
                                    start_when_all_in,
-                                   ffill_prices)
+                                   ffill_prices,
+                                   context=ctx)
     elif data_source == 'local_csv':
         _run_import_local_csv(stock_data,
                               start_date,
                               end_date,
-                              max_lookback)
+                              max_lookback,
+                              context=ctx)
     trading_dates = get_valid_dates(max_lookback=max_lookback,
                                     rebalance=rebalance,
                                     start_trading=start_date,
                                     end_trading=end_date,
-                                    offset=offset)
-    Optimise.create_variable_combinations_dict(opt_params, optimise_type)
-    number_of_rows = len(data.combination_df)
-    print('Total number of tests:', number_of_rows)
-
-    if number_of_rows == 1:
-        data.optimising = False
-    else:
-        data.optimising = True
-        if in_out_sampling is not None:
-            data.is_dates, data.oos_dates = get_in_out_sample_dates(in_out_sampling)
-        else:
-            data.is_dates = data.all_dates
-            data.oos_dates = pd.DatetimeIndex([])
-
-
-    before_everything_starts(user, data)
-
-    with tqdm(range(number_of_rows), position=0) as pbar:
-        for i in pbar:
-            for j in range(len(data.combination_df.columns)):
-                variable = data.combination_df.columns[j]
-                value = data.combination_df.iat[i, j]
-                if variable[:5] == 'user.':
-                    exec('{} = {}'.format(variable, value))
-                else:
-                    exec('user.{} = {}'.format(variable, value))
-
-            before_backtest_start(user, data)
-            initialise()
-            # pbar = tqdm(total=len(data.all_dates), desc='Test {}'.format(str(i + 1)), position=0, leave=True)
-            progress = 0
-            number_of_bars = len(data.all_dates)
-            for d in data.all_dates:
-                data.current_date = d
-
-                data.current_price = data.daily_opens.loc[d]
-
-                if d in trading_dates:
-                    trade_open(user, data)
-
-                trade_every_day_open(user, data)
-                data.current_price = data.daily_closes.loc[d]
-
-                if d in trading_dates:
-                    trade_close(user, data)
-
-                trade_every_day_close(user, data)
-
-                update()
-                # pbar.update(1)
-                progress += 100
-                pbar.set_postfix(inner_loop=int(progress/number_of_bars), refresh=True)
-            for x in list(data.current_positions):
-                Orders(x, close_reason='End of Backtest', exec_timing='close').order_target_amount(0)
-
-            after_backtest_finish(user, data)
-
-            if data.optimising:
-                Optimise.record_backtest(combination_row=i)
-                if opt_results_save_loc != '':
-                    data.optimisation_report.to_csv('{}\\temp.csv'.format(opt_results_save_loc),
-                                                index=True, index_label='Test_Number')
-
-    if not data.optimising:
-        data.trade_df['close_date'] = pd.to_datetime(data.trade_df['close_date'])
-        data.trade_df['open_date'] = pd.to_datetime(data.trade_df['open_date'])
-        equity = [x - data.starting_amount for x in data.wealth_track]
-        equity = pd.Series(index=data.date_track, data=equity)
-        data.number_of_trades = len(data.trade_df)
-        data.number_winning_trades = len(data.trade_df[data.trade_df['profit'] > 0])
-        percent_profitable = 100 * (data.number_winning_trades / data.number_of_trades)
-        av_trade_profit = equity[-1] / data.number_of_trades
-        av_trade_profit_perc = data.trade_df['profit%'].mean()
-        trades_per_year = data.trade_df['close_date'].dt.year.value_counts().sort_index()
-        total_profit_percent = 100 * (equity[-1]) / data.starting_amount
-        dd, dd_stats = drawdown_stats(equity, data.starting_amount)
-        month_returns = monthly_returns(equity, data.starting_amount, False)
-        # trade_list = data.trade_df
-        bus_dates = pd.bdate_range(data.trade_df['open_date'].min(), data.trade_df['close_date'].max())
-        holidays = bus_dates.drop(data.daily_closes.index, errors='ignore').values.astype('datetime64[D]')
-        # trade_list['days_in_trade'] = trade_list['close_date'] - trade_list['open_date']
-        data.trade_df['days_in_trade'] = np.busday_count(data.trade_df['open_date'].values.astype('datetime64[D]'),
-                                                         data.trade_df['close_date'].values.astype('datetime64[D]'),
-                                                         holidays=holidays)
-
-        summary_report_data = {'Total Profit': total_profit_percent,
-                               'Max Drawdown': dd_stats['Max Drawdown'],
-                               'Max Drawdown %': dd_stats['Max Drawdown %'],
-                               'Length of Max Drawdown': dd_stats['Length of Max Drawdown'],
-                               'Total Number of Trades': data.number_of_trades,
-                               'Average Profit per Trade': av_trade_profit,
-                               'Average %Profit per trade': av_trade_profit_perc,
-                               'Percent Winning Trades': percent_profitable,
-                               'Average Bars in Trade': data.trade_df['days_in_trade'].mean(),
-                               'Max Bars in Trade': data.trade_df['days_in_trade'].max(),
-                               'Min Bars in Trade': data.trade_df['days_in_trade'].min()}
-        summary_report = pd.DataFrame(data=summary_report_data, index=[0])
-
-    if data.optimising:
-        if opt_results_save_loc != '':
-            data.optimisation_report.to_csv(
-                '{}\\Results_{}.csv'.format(opt_results_save_loc, datetime.now().strftime('%d%m%y %H%M')),
-                index=True, index_label='Test_Number')
-        return data.optimisation_report
-
-    else:
-        if auto_plot:
-            plot_results(start_date=start_date,
-                         end_date=end_date,
-                         title=plot_title)
-        trade_list = data.trade_df
-        # bus_dates = pd.bdate_range(trade_list['open_date'].min(), trade_list['close_date'].max())
-        # holidays = bus_dates.drop(data.daily_closes.index, errors='ignore').astype('str')
-        # trade_list['days_in_trade'] = trade_list['close_date'] - trade_list['open_date']
-        # trade_list['days_in_trade'] = np.busday_count(trade_list['open_date'].astype('str'),
-        #                                               trade_list['close_date'].astype('str'),
-        #                                               holidays=holidays)
-        positions_track = data.positions_tracker.fillna(method='ffill').dropna(how='all')
-        value_track = positions_track.mul(data.daily_closes)
-        if data_source == 'Norgate':
-            import norgatedata
-            trade_list['symbol'] = [norgatedata.symbol(asset_id) for asset_id in trade_list['symbol']]
-            positions_track.columns = [norgatedata.symbol(x) for x in positions_track.columns]
-            value_track.columns = [norgatedata.symbol(x) for x in value_track.columns]
-        value_track.loc[:, 'Total'] = value_track.sum(axis=1)
-        results = {'Trade List': trade_list,
-                   'Positions Track': positions_track,
-                   'Value Track': value_track,
-                   'Summary': summary_report,
-                   'Yearly Trades': trades_per_year,
-                   'Monthly Returns': month_returns}
-        return results
+                                    offset=offset,
+                                    context=ctx)
+    ctx.price_panels = PricePanels(ctx.daily_closes,
+                                   daily_opens=ctx.daily_opens,
+                                   daily_highs=getattr(ctx, 'daily_highs', None),
+                                   daily_lows=getattr(ctx, 'daily_lows', None))
+    return trading_dates
+
+
+def _run_single_results(data_source, auto_plot, start_date, end_date, plot_title, context=None):
+    ctx = context if context is not None else get_context()
+    ctx.trade_df['close_date'] = pd.to_datetime(ctx.trade_df['close_date'])
+    ctx.trade_df['open_date'] = pd.to_datetime(ctx.trade_df['open_date'])
+    equity = [x - ctx.starting_amount for x in ctx.wealth_track]
+    equity = pd.Series(index=ctx.date_track, data=equity)
+    ctx.number_of_trades = len(ctx.trade_df)
+    ctx.number_winning_trades = len(ctx.trade_df[ctx.trade_df['profit'] > 0])
+    percent_profitable = 100 * (ctx.number_winning_trades / ctx.number_of_trades)
+    av_trade_profit = equity[-1] / ctx.number_of_trades
+    av_trade_profit_perc = ctx.trade_df['profit%'].mean()
+    trades_per_year = ctx.trade_df['close_date'].dt.year.value_counts().sort_index()
+    total_profit_percent = 100 * (equity[-1]) / ctx.starting_amount
+    dd, dd_stats = drawdown_stats(equity, ctx.starting_amount)
+    month_returns = monthly_returns(equity, ctx.starting_amount, False)
+    # trade_list = data.trade_df
+    bus_dates = pd.bdate_range(ctx.trade_df['open_date'].min(), ctx.trade_df['close_date'].max())
+    holidays = bus_dates.drop(ctx.daily_closes.index, errors='ignore').values.astype('datetime64[D]')
+    # trade_list['days_in_trade'] = trade_list['close_date'] - trade_list['open_date']
+    ctx.trade_df['days_in_trade'] = np.busday_count(ctx.trade_df['open_date'].values.astype('datetime64[D]'),
+                                                    ctx.trade_df['close_date'].values.astype('datetime64[D]'),
+                                                    holidays=holidays)
+
+    summary_report_data = {'Total Profit': total_profit_percent,
+                           'Max Drawdown': dd_stats['Max Drawdown'],
+                           'Max Drawdown %': dd_stats['Max Drawdown %'],
+                           'Length of Max Drawdown': dd_stats['Length of Max Drawdown'],
+                           'Total Number of Trades': ctx.number_of_trades,
+                           'Average Profit per Trade': av_trade_profit,
+                           'Average %Profit per trade': av_trade_profit_perc,
+                           'Percent Winning Trades': percent_profitable,
+                           'Average Bars in Trade': ctx.trade_df['days_in_trade'].mean(),
+                           'Max Bars in Trade': ctx.trade_df['days_in_trade'].max(),
+                           'Min Bars in Trade': ctx.trade_df['days_in_trade'].min()}
+    summary_report = pd.DataFrame(data=summary_report_data, index=[0])
+
+    if auto_plot:
+        plot_results(start_date=start_date,
+                     end_date=end_date,
+                     title=plot_title,
+                     context=ctx)
+    trade_list = ctx.trade_df
+    # bus_dates = pd.bdate_range(trade_list['open_date'].min(), trade_list['close_date'].max())
+    # holidays = bus_dates.drop(data.daily_closes.index, errors='ignore').astype('str')
+    # trade_list['days_in_trade'] = trade_list['close_date'] - trade_list['open_date']
+    # trade_list['days_in_trade'] = np.busday_count(trade_list['open_date'].astype('str'),
+    #                                               trade_list['close_date'].astype('str'),
+    #                                               holidays=holidays)
+    positions_track_df = positions_track(context=ctx)
+    value_track_df = value_track(context=ctx)
+    if data_source == 'Norgate':
+        import norgatedata
+        trade_list['symbol'] = [norgatedata.symbol(asset_id) for asset_id in trade_list['symbol']]
+        positions_track_df.columns = [norgatedata.symbol(x) for x in positions_track_df.columns]
+        value_track_df.columns = [norgatedata.symbol(x) if x != 'Total' else x
+                                  for x in value_track_df.columns]
+    results = {'Trade List': trade_list,
+               'Positions Track': positions_track_df,
+               'Value Track': value_track_df,
+               'Summary': summary_report,
+               'Yearly Trades': trades_per_year,
+               'Monthly Returns': month_returns}
+    return results
 
 
 def _run_download_data_norgate(stock_data,
@@ -1603,7 +2971,9 @@ def _run_download_data_norgate(stock_data,
                                data_fields,
                                data_adjustment,
                                start_when_all_in,
-                               ffill_prices):
+                               ffill_prices,
+                               context=None):
+    ctx = context if context is not None else get_context()
     import norgatedata
     data_start = start_date - pd.tseries.offsets.BDay(max_lookback + 10)
 
@@ -1634,8 +3004,8 @@ def _run_download_data_norgate(stock_data,
             syms = set()
             for col in unique_universes.columns:
                 syms = syms.union(unique_universes[col].unique())
-            data.daily_universes = daily_universes
-            exec('data.{} = daily_universes'.format(s.replace(' ', '_').replace('&', '')))
+            ctx.daily_universes = daily_universes
+            setattr(ctx, s.replace(' ', '_').replace('&', ''), daily_universes)
             symbols = symbols.union(syms)
     symbols = {int(x) for x in symbols if x==x}
     get_norgatedata(symbols,
@@ -1644,13 +3014,55 @@ def _run_download_data_norgate(stock_data,
                     end_date=end_date,
                     start_when_all_are_in=start_when_all_in,
                     adjustment=data_adjustment,
-                    forward_fill_prices=ffill_prices)
+                    forward_fill_prices=ffill_prices,
+                    context=ctx)
+
+
+def _run_append_new_data(saved_prices,
+                         stock_data,
+                         data_source,
+                         end_date,
+                         data_fields,
+                         data_adjustment,
+                         start_when_all_in,
+                         ffill_prices,
+                         context=None):
+    ctx = context if context is not None else get_context()
+    last_saved = saved_prices['daily_closes'].index[-1]
+    new_data = BacktestContext()
+    with activate(new_data):
+        if data_source == 'Norgate':
+            _run_download_data_norgate(stock_data,
+                                       last_saved + pd.tseries.offsets.BDay(1),
+                                       end_date,
+                                       0,
+                                       data_fields,
+                                       data_adjustment,
+                                       start_when_all_in,
+                                       ffill_prices,
+                                       context=new_data)
+        elif data_source == 'local_csv':
+            _run_import_local_csv(stock_data,
+                                  last_saved + pd.tseries.offsets.BDay(1),
+                                  end_date,
+                                  0,
+                                  context=new_data)
+    # Only dates after the saved data are added, for the saved symbols so the trade ledger's columns do not move
+    for name, saved in saved_prices.items():
+        new_rows = getattr(new_data, name, None)
+        if new_rows is not None:
+            new_rows = new_rows.loc[new_rows.index > last_saved].reindex(columns=saved.columns)
+            saved = pd.concat([saved, new_rows])
+        setattr(ctx, name, saved)
+    ctx.all_dates = ctx.daily_closes.index
 
 
 def _run_import_local_csv(stock_data,
                           start_date,
                           end_date,
-                          max_lookback):
+                          max_lookback,
+                          context=None):
+    ctx = context if context is not None else get_context()
     data_start = start_date - pd.tseries.offsets.BDay(max_lookback + 10)
 
     # print('Before going further, ensure there are at least two files in the director you will provide\n\
@@ -1671,25 +3083,26 @@ def _run_import_local_csv(stock_data,
         daily_data = daily_data.loc[data_start:end_date]
         daily_data = daily_data.reindex(trading_dates, method='ffill')
         daily_data.dropna(how='all')
-        exec('data.{} = daily_data'.format(fname))
+        setattr(ctx, fname, daily_data)
 
     # data.daily_closes.dropna(inplace=True)
     # data.daily_closes.dropna(inplace=True)
 
-    data.all_dates = data.daily_closes.index
+    ctx.all_dates = ctx.daily_closes.index
 
 
-def get_in_out_sample_dates(sampling_param_dict):
+def get_in_out_sample_dates(sampling_param_dict, context=None):
     import random
+    ctx = context if context is not None else get_context()
 
     trim_off_end = sampling_param_dict['end_trim_percent']
     random_month_remove_pct = sampling_param_dict['random_month_percent']
 
-    all_dates = data.all_dates.copy()
+    all_dates = ctx.all_dates.copy()
     num_to_trim = ceil(len(all_dates) * trim_off_end / 100)
 
     trimmed_dates = all_dates[:-num_to_trim]
-    data.all_dates = trimmed_dates.copy() # Stops all trading from happening at the end of the backtest
+    ctx.all_dates = trimmed_dates.copy() # Stops all trading from happening at the end of the backtest
     all_years = trimmed_dates.year.unique()
 
     is_dates = pd.DatetimeIndex([])
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 20:31:58 2026
+
+@author: Nick Elmer
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from Backtest import initialise, update, fill_resting_orders, close_all_positions, callback_does_nothing
+from backtest_context import get_context, activate
+from price_panels import PricePanels
+from running_metrics import RunningMetrics
+from trade_ledger import PositionLog, TRADE_COLUMNS
+
+
+BAR_COLUMNS = ('datetime', 'symbol', 'open', 'high', 'low', 'close')
+
+
+def _bar_files(bar_source):
+    if isinstance(bar_source, str):
+        if os.path.isdir(bar_source):
+            return [os.path.join(bar_source, fname) for fname in sorted(os.listdir(bar_source))
+                    if fname.endswith('.csv')]
+        return [bar_source]
+    return list(bar_source)
+
+
+def find_symbols(bar_source, chunk_rows=1000000):
+    """
+    Reads every symbol in a set of bar files, one chunk at a time.
+
+    Parameters
+    ----------
+    bar_source : str or list
+        A csv file, a folder of csv files or a list of csv files, see
+        `run_intraday`.
+    chunk_rows : int, default 1000000
+        The number of rows read at a time.
+
+    Returns
+    -------
+    list
+        The symbols, sorted.
+
+    """
+    symbols = set()
+    for path in _bar_files(bar_source):
+        for chunk in pd.read_csv(path, usecols=['symbol'], chunksize=chunk_rows):
+            symbols.update(chunk['symbol'].unique())
+    return sorted(symbols)
+
+
+def read_bar_chunks(bar_source, chunk_rows=1000000):
+    """
+    Reads bars from csv files in time order, a chunk at a time.
+
+    The rows of a timestamp are never split between chunks, so each chunk
+    holds every symbol's bar of each of its timestamps.
+
+    Parameters
+    ----------
+    bar_source : str or list
+        A csv file, a folder of csv files or a list of csv files, see
+        `run_intraday`.
+    chunk_rows : int, default 1000000
+        The number of rows read at a time.
+
+    Yields
+    ------
+    pandas-dataframe
+        The bars of the chunk in the columns of BAR_COLUMNS.
+
+    Raises
+    ------
+    ValueError
+        If the bars are not in time order.
+
+    """
+    carry = None
+    for path in _bar_files(bar_source):
+        for chunk in pd.read_csv(path, usecols=list(BAR_COLUMNS), parse_dates=['datetime'], chunksize=chunk_rows):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            times = chunk['datetime']
+            if not times.is_monotonic_increasing:
+                raise ValueError('The bars in {} are not in time order'.format(path))
+            # The last timestamp may carry on in the next chunk, so it is held back until then
+            complete = (times < times.iloc[-1]).to_numpy()
+            carry = chunk[~complete]
+            if complete.any():
+                yield chunk[complete]
+    if carry is not None and len(carry):
+        yield carry
+
+
+def _chunk_panels(bars, symbols, previous, lookback_bars):
+    wide = bars.pivot(index='datetime', columns='symbol')
+    frames = {field: wide[field].reindex(columns=symbols) for field in ('open', 'high', 'low', 'close')}
+    if previous is not None:
+        # A symbol with no bar at a timestamp keeps the last close from before it
+        last_close = pd.DataFrame([previous.closes[-1]], columns=symbols)
+        closes = pd.concat([last_close, frames['close']]).ffill().iloc[1:]
+    else:
+        closes = frames['close'].ffill()
+    closes.index = wide.index
+    frames = {field: frames[field].fillna(closes) for field in ('open', 'high', 'low')}
+    frames['close'] = closes
+    overlap = 0
+    if previous is not None and lookback_bars:
+        # The last bars of the previous chunk are kept in front so data.history can look back over them
+        overlap = min(lookback_bars, len(previous.dates))
+        kept = slice(len(previous.dates) - overlap, None)
+        for field, panel in zip(('open', 'high', 'low', 'close'),
+                                (previous.opens, previous.highs, previous.lows, previous.closes)):
+            frames[field] = pd.concat([pd.DataFrame(panel[kept], index=previous.dates[kept], columns=symbols),
+                                       frames[field]])
+    panels = PricePanels(frames['close'], daily_opens=frames['open'], daily_highs=frames['high'],
+                         daily_lows=frames['low'])
+    return panels, overlap
+
+
+def run_intraday(bar_source,
+                 before_everything_starts,
+                 before_backtest_start,
+                 trade_open,
+                 trade_bar,
+                 trade_close,
+                 after_backtest_finish,
+                 symbols=None,
+                 starting_cash=100000,
+                 chunk_rows=1000000,
+                 lookback_bars=0,
+                 output_folder=None,
+                 context=None):
+    """
+    Runs a backtest over intraday bars streamed from disk.
+
+    The bars are read a chunk at a time, so the whole history never has to fit
+    in memory. The equity of each bar and every closed trade are written to
+    csv files in `output_folder` as the backtest goes, and only the bars of
+    the chunk being run, the open trades and the resting orders are kept.
+
+    Each bar is run like a day of `Backtest.run`. `trade_open` is called at the
+    open of the first bar of each session (date) and `trade_close` at the
+    close of the last bar of each session, with data.current_price the bar's
+    open or close prices. `trade_bar` is called at the close of every bar,
+    after resting orders are filled. Orders, `rebalance_portfolio`,
+    `check_stop_losses` and `data.history` all work on the bars as they do on
+    days.
+
+    Parameters
+    ----------
+    bar_source : str or list
+        A csv file, a folder of csv files read in name order, or a list of csv
+        files read in that order. Each has a row for each bar of each symbol,
+        with the columns 'datetime', 'symbol', 'open', 'high', 'low' and
+        'close', in time order. A symbol without a bar at a time has its prices
+        filled with its last close.
+    before_everything_starts, before_backtest_start, after_backtest_finish : function
+        As for `Backtest.run`. The price data is not loaded when
+        `before_backtest_start` is called, so indicators need to be worked out
+        from `data.history` as the bars are run.
+    trade_open, trade_bar, trade_close : function
+        The functions called at the start of each session, at every bar and at
+        the end of each session. Functions which do nothing are never called.
+    symbols : list, default None
+        Every symbol which can be traded. The bar files are read once to find
+        them if None.
+    starting_cash : int, default 100000
+        The cash the backtest starts with.
+    chunk_rows : int, default 1000000
+        The number of rows of the bar files read at a time.
+    lookback_bars : int, default 0
+        The number of bars of the previous chunk kept in front of each chunk,
+        the longest window `data.history` can be asked for.
+    output_folder : str, default None
+        Where to write 'equity.csv' and 'trades.csv'. A new temporary folder is
+        made if None.
+    context : BacktestContext, default None
+        The context to run the backtest in. If None, the active context is
+        used.
+
+    Returns
+    -------
+    dict
+        'Summary', a one row DataFrame of the results, 'Equity File', the path
+        of the csv of the wealth at the close of each bar, and 'Trade File', the
+        path of the csv of the trade list.
+
+    Notes
+    -----
+    Trade numbers and resting order ids are renumbered between chunks as the
+    closed trades and finished orders are dropped, so they should not be kept
+    in `user` from one bar to the next. data.all_dates and data.price_panels
+    only hold the bars of the chunk being run.
+
+    Examples
+    --------
+    >>> results = run_intraday('minute_bars', before_everything_starts, before_backtest_start, trade_open,
+    ...                        trade_bar, trade_close, after_backtest_finish, lookback_bars=60)
+    >>> pd.read_csv(results['Equity File'], index_col=0, parse_dates=True)
+
+    """
+    ctx = context if context is not None else get_context()
+    with activate(ctx):
+        if symbols is None:
+            symbols = find_symbols(bar_source, chunk_rows)
+        if output_folder is None:
+            output_folder = tempfile.mkdtemp(prefix='intraday_')
+        equity_path = os.path.join(output_folder, 'equity.csv')
+        trades_path = os.path.join(output_folder, 'trades.csv')
+        pd.DataFrame(columns=['wealth'], index=pd.DatetimeIndex([], name='datetime')).to_csv(equity_path)
+        pd.DataFrame(columns=TRADE_COLUMNS, index=pd.Index([], name='trade_number')).to_csv(trades_path)
+
+        ctx.symbols = list(symbols)
+        ctx.starting_amount = starting_cash
+        ctx.optimising = False
+        ctx.lean = False
+        ctx.accounts = None
+        ctx.account_overrides = {}
+        trade_open = None if callback_does_nothing(trade_open) else trade_open
+        trade_bar = None if callback_does_nothing(trade_bar) else trade_bar
+        trade_close = None if callback_does_nothing(trade_close) else trade_close
+        metrics = RunningMetrics()
+        trade_stats = {'number': 0, 'winning': 0, 'profit%': 0.0}
+
+        def write_out():
+            # Moves the equity and the closed trades of the chunk from memory to the output files
+            if ctx.date_track:
+                pd.Series(ctx.wealth_track, index=pd.DatetimeIndex(ctx.date_track, name='datetime'),
+                          name='wealth').to_csv(equity_path, mode='a', header=False)
+                metrics.add_many(ctx.date_track, ctx.wealth_track)
+                ctx.wealth_track = []
+                ctx.date_track = []
+            closed = ctx.trade_ledger.remove_closed()
+            if len(closed):
+                closed.index = pd.RangeIndex(trade_stats['number'], trade_stats['number'] + len(closed))
+                closed.to_csv(trades_path, mode='a', header=False)
+                trade_stats['number'] += len(closed)
+                trade_stats['winning'] += int((closed['profit'] > 0).sum())
+                trade_stats['profit%'] += closed['profit%'].sum()
+            ctx.position_log = PositionLog()
+
+        before_everything_starts(ctx.user, ctx)
+        before_backtest_start(ctx.user, ctx)
+
+        chunks = read_bar_chunks(bar_source, chunk_rows)
+        bars = next(chunks, None)
+        panels = None
+        with tqdm(position=0, unit=' bars') as pbar:
+            while bars is not None:
+                next_bars = next(chunks, None)
+                previous = panels
+                panels, overlap = _chunk_panels(bars, ctx.symbols, previous, lookback_bars)
+                ctx.price_panels = panels
+                ctx.all_dates = panels.dates
+                if previous is None:
+                    initialise(context=ctx)
+                else:
+                    ctx.order_book.rebase(len(previous.dates) - overlap)
+
+                times = panels.dates
+                sessions = times.normalize()
+                next_session = sessions[1:].append(pd.DatetimeIndex(
+                    [next_bars['datetime'].iloc[0].normalize()] if next_bars is not None else [pd.NaT]))
+                before_first = previous.dates[-1:].normalize() if previous is not None and not overlap else \
+                    pd.DatetimeIndex([pd.NaT])
+                previous_session = before_first.append(sessions[:-1])
+                session_starts = np.asarray(sessions != previous_session)
+                session_ends = np.asarray(sessions != next_session)
+
+                for row in range(overlap, len(times)):
+                    ctx.current_date = times[row]
+                    ctx.current_index = row
+                    ctx.current_price = panels.row('opens', row)
+                    ctx.current_phase = 'open'
+                    if session_starts[row] and trade_open is not None:
+                        trade_open(ctx.user, ctx)
+
+                    ctx.current_price = panels.row('closes', row)
+                    ctx.current_phase = 'close'
+                    if ctx.order_book:
+                        fill_resting_orders(context=ctx)
+                    if trade_bar is not None:
+                        trade_bar(ctx.user, ctx)
+                    if session_ends[row] and trade_close is not None:
+                        trade_close(ctx.user, ctx)
+                    update(context=ctx)
+
+                pbar.update(len(times) - overlap)
+                if next_bars is None:
+                    close_all_positions(close_reason='End of Backtest', exec_timing='close', context=ctx)
+                write_out()
+                bars = next_bars
+
+        ctx.trade_df = None
+        ctx.number_of_trades = trade_stats['number']
+        ctx.number_winning_trades = trade_stats['winning']
+        after_backtest_finish(ctx.user, ctx)
+
+        number_of_trades = max(trade_stats['number'], 1)
+        total_profit = metrics.last_wealth - ctx.starting_amount
+        summary = pd.DataFrame({'Total Profit': 100 * total_profit / ctx.starting_amount,
+                                'Max Drawdown': metrics.max_drawdown,
+                                'Max Drawdown %': 100 * metrics.max_drawdown / ctx.starting_amount,
+                                'Length of Max Drawdown': metrics.max_drawdown_length(),
+                                'Total Number of Trades': trade_stats['number'],
+                                'Average Profit per Trade': total_profit / number_of_trades,
+                                'Average %Profit per trade': trade_stats['profit%'] / number_of_trades,
+                                'Percent Winning Trades': 100 * trade_stats['winning'] / number_of_trades,
+                                'Number of Bars': metrics.number_of_dates},
+                               index=[0])
+        return {'Summary': summary, 'Equity File': equity_path, 'Trade File': trades_path}
@@ -7,13 +7,15 @@ Created on Tue Jan 21 11:57:21 2020
 
 import pandas as pd
 import itertools
-import data
+import math
+import random
+from backtest_context import get_context
 from plotly.offline import plot
 import plotly.graph_objects as go
 import numpy as np
 
 
-def create_variable_combinations(list_of_series):
+def create_variable_combinations(list_of_series, context=None):
     """
     Creates a dataframe with column headers that are the names of the variables
     to be optimised on. The rows contain every possible combination of the
@@ -25,6 +27,9 @@ def create_variable_combinations(list_of_series):
         A list containing series that have the name of the variable as the
         series name, and the values that are the differnt values to be
         optimised for.
+    context : BacktestContext, default None
+        The context to store the combinations in. If None, the active context
+        is used.
 
     Returns
     -------
@@ -33,6 +38,7 @@ def create_variable_combinations(list_of_series):
     list to store lists of wealth tracks in data.optimisation_wealth_tracks.
 
     """
+    ctx = context if context is not None else get_context()
     variable_names = []
     list_of_lists = []
     for series in list_of_series:
@@ -49,45 +55,470 @@ def create_variable_combinations(list_of_series):
         combo = combo_list[i]
         combo_df.iloc[i] = combo
 
-    data.combination_df = combo_df
+    ctx.combination_df = combo_df
 
-    data.optimisation_report = pd.DataFrame(index=range(len(combo_df)),
-                                            columns=combo_df.columns)
-    data.optimisation_wealth_tracks = []
-    data.length_of_backtest = 0
+    ctx.optimisation_report = pd.DataFrame(index=range(len(combo_df)),
+                                           columns=combo_df.columns)
+    ctx.optimisation_wealth_tracks = []
+    ctx.length_of_backtest = 0
 
 
-def create_variable_combinations_dict(param_dict, optimise_type):
-    variable_names = []
-    list_of_tuples = []
-    for variable, params in param_dict.items():
-        variable_names.append(variable)
-        list_of_tuples.append(params)
+# The values of optimise_type which test a sample of the grid of combinations
+SEARCH_TYPES = ('random', 'latin_hypercube', 'bayesian')
+
+
+class CombinationSource:
+    """
+    The parameter combinations of an optimisation, made when they are needed
+    instead of all at once.
+
+    Each combination has a test number, its position in the full grid: the
+    order of `itertools.product` of the values for 'combination', or the
+    position in the tuples of values for 'fixed'. The combination of any test
+    number is worked out from its number, so nothing is stored per test.
+    Combinations which fail a constraint are never scheduled and their test
+    numbers are skipped.
+
+    The search types test `budget` combinations of the grid of 'combination'
+    instead of all of them, keeping their test numbers in the grid:
+
+    - 'random' picks them at random.
+    - 'latin_hypercube' spreads them evenly over the values of every
+      parameter, so each part of the range of each parameter is tested.
+    - 'bayesian' starts with a Latin hypercube and then picks each next
+      combination from the results so far. A Gaussian process is fitted to
+      the `objective` column of the report against the position of each
+      parameter in its values, and the combination with the highest expected
+      improvement is tested next. Combinations next to the best so far are
+      always considered.
+
+    If the grid is no larger than the budget, every combination is tested.
+
+    Parameters
+    ----------
+    param_dict : dict
+        The values of each parameter, as `opt_params` of `run`.
+    optimise_type : str, default 'combination'
+        'combination' for every combination of the values, 'fixed' for the
+        first value of every parameter, then the second and so on, or one of
+        the search types 'random', 'latin_hypercube' or 'bayesian'.
+    constraints : tuple, default ()
+        Functions which are passed a dict of the parameters of a combination,
+        keyed by their names in `param_dict`, and return False if the
+        combination should not be tested. They are only kept in the process
+        which schedules the tests and are not pickled.
+    budget : int, default None
+        The number of combinations tested by a search.
+    objective : str, default 'Rate / StdDev'
+        The column of the optimisation report a bayesian search maximises.
+    seed : int, default None
+        Seeds the choices of a search, so the same combinations are tested
+        each time.
+    batch_size : int, default 1
+        The number of combinations a bayesian search picks at once, eg. the
+        number of processes running the tests.
+
+    Attributes
+    ----------
+    names : list
+        The names of the parameters.
+    size : int
+        The number of combinations in the full grid, before the constraints.
+    sample : list
+        The test numbers chosen by a 'random' or 'latin_hypercube' search, in
+        order, or None.
+
+    Examples
+    --------
+    >>> source = CombinationSource({'fast': (5, 10, 20), 'slow': (10, 20, 50)},
+    ...                            constraints=(lambda p: p['fast'] < p['slow'],))
+    >>> list(source.test_numbers())
+    [0, 1, 2, 4, 5, 8]
+    >>> source.combination(5)
+    {'fast': 10, 'slow': 50}
+    """
+
+    def __init__(self, param_dict, optimise_type='combination', constraints=(), budget=None,
+                 objective='Rate / StdDev', seed=None, batch_size=1):
+        self.names = list(param_dict)
+        self.values = [tuple(values) for values in param_dict.values()]
+        if optimise_type in ('combination',) + SEARCH_TYPES or param_dict == {}:
+            self.optimise_type = optimise_type if param_dict != {} else 'combination'
+            self.size = math.prod(len(values) for values in self.values)
+        elif optimise_type == 'fixed':
+            self.optimise_type = 'fixed'
+            self.size = len(self.values[0])
+        else:
+            raise ValueError("optimise_type must be either 'combination', 'fixed', 'random', 'latin_hypercube' or "
+                             "'bayesian'")
+        self.constraints = tuple(constraints)
+        self.budget = budget
+        self.objective = objective
+        self.batch_size = batch_size
+        self._random = random.Random(seed)
+        self._count = None
+        self.sample = None
+        if self.optimise_type in SEARCH_TYPES:
+            if budget is None:
+                raise ValueError('A {} search needs a budget of tests'.format(self.optimise_type))
+            if self.size <= budget:
+                self.optimise_type = 'combination'
+            elif self.optimise_type == 'random':
+                self.sample = sorted(self._random_test_numbers(budget))
+            elif self.optimise_type == 'latin_hypercube':
+                self.sample = sorted(self._latin_hypercube(budget))
+
+    def __getstate__(self):
+        # Constraints are often lambdas, and are only needed where the tests are scheduled
+        state = dict(self.__dict__)
+        state['constraints'] = None
+        return state
+
+    def _positions(self, test_number):
+        # The position of the value of each parameter of a test of 'combination'
+        positions = []
+        for values in reversed(self.values):
+            test_number, position = divmod(test_number, len(values))
+            positions.append(position)
+        return positions[::-1]
+
+    def _test_number(self, positions):
+        test_number = 0
+        for values, position in zip(self.values, positions):
+            test_number = test_number * len(values) + position
+        return test_number
+
+    def combination(self, test_number):
+        """Returns the parameters of a test as a dict."""
+        if self.optimise_type == 'fixed':
+            return {name: values[test_number] for name, values in zip(self.names, self.values)}
+        return {name: values[position]
+                for name, values, position in zip(self.names, self.values, self._positions(test_number))}
+
+    def _meets_constraints(self, test_number):
+        return not self.constraints or all(constraint(self.combination(test_number))
+                                           for constraint in self.constraints)
+
+    def test_numbers(self):
+        """Yields the test number of every combination which meets all the constraints, in order."""
+        if self.sample is not None:
+            yield from self.sample
+            return
+        if self.optimise_type == 'bayesian':
+            raise ValueError('A bayesian search picks each test from the results before it, see `chunks`')
+        if self.constraints is None:
+            raise ValueError('The constraints of a CombinationSource are not pickled, so it cannot schedule tests')
+        if self.optimise_type == 'fixed':
+            combinations = (tuple(values[i] for values in self.values) for i in range(self.size))
+        else:
+            combinations = itertools.product(*self.values)
+        for test_number, combination in enumerate(combinations):
+            if self.constraints:
+                parameters = dict(zip(self.names, combination))
+                if not all(constraint(parameters) for constraint in self.constraints):
+                    continue
+            yield test_number
+
+    def count(self):
+        """Returns the number of tests, the combinations which meet all the constraints or the budget of a search."""
+        if self._count is None:
+            if self.sample is not None:
+                self._count = len(self.sample)
+            elif self.optimise_type == 'bayesian':
+                self._count = self.budget
+            else:
+                self._count = self.size if not self.constraints else sum(1 for _ in self.test_numbers())
+        return self._count
+
+    def chunks(self, chunk_size, report=None):
+        """
+        Yields the test numbers of `test_numbers` in lists of up to `chunk_size`.
+
+        A bayesian search yields its first Latin hypercube, then `batch_size`
+        test numbers at a time, picked from the results of the tests before.
+        `report` is a function returning the optimisation report, which must
+        hold the results of every chunk yielded before the next is asked for.
+        """
+        if self.optimise_type == 'bayesian':
+            yield from self._bayesian_chunks(report)
+            return
+        test_numbers = self.test_numbers()
+        while True:
+            chunk = list(itertools.islice(test_numbers, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def frame(self, test_numbers):
+        """Returns the combinations of `test_numbers` as a dataframe indexed by test number."""
+        return pd.DataFrame(data=[tuple(self.combination(i).values()) for i in test_numbers], index=test_numbers,
+                            columns=self.names, dtype=object)
+
+    def _random_test_numbers(self, number, exclude=()):
+        # Gives up after many tries, when few of the combinations meet the constraints
+        chosen = []
+        seen = set(exclude)
+        for _ in range(100 * number):
+            if len(chosen) == number:
+                break
+            test_number = self._random.randrange(self.size)
+            if test_number in seen:
+                continue
+            seen.add(test_number)
+            if self._meets_constraints(test_number):
+                chosen.append(test_number)
+        return chosen
+
+    def _latin_hypercube(self, number):
+        strata = []
+        for values in self.values:
+            order = list(range(number))
+            self._random.shuffle(order)
+            strata.append([int((k + self._random.random()) * len(values) / number) for k in order])
+        chosen = {}
+        for positions in zip(*strata):
+            test_number = self._test_number(positions)
+            if test_number not in chosen and self._meets_constraints(test_number):
+                chosen[test_number] = None
+        # Points which repeat or fail a constraint are replaced by random ones
+        return list(chosen) + self._random_test_numbers(number - len(chosen), exclude=chosen)
+
+    def _features(self, test_numbers):
+        # The position of each parameter in its values, scaled from 0 to 1
+        return np.array([[position / (len(values) - 1) if len(values) > 1 else 0.0
+                          for values, position in zip(self.values, self._positions(i))] for i in test_numbers])
+
+    def _bayesian_chunks(self, report):
+        first = self._latin_hypercube(min(self.budget, max(5, 2 * len(self.names))))
+        tested = list(first)
+        yield first
+        while len(tested) < self.budget:
+            results = report()
+            if self.objective not in results.columns:
+                raise KeyError('The objective {} is not a column of the optimisation report'.format(self.objective))
+            observed = results[self.objective].reindex(tested).astype(float)
+            chunk = self._propose(observed, min(self.batch_size, self.budget - len(tested)))
+            if not chunk:
+                return
+            tested.extend(chunk)
+            yield chunk
+
+    def _candidates(self, observed):
+        tested = set(observed.index)
+        candidates = set(self._random_test_numbers(1000, exclude=tested))
+        for test_number in observed.nlargest(5).index:
+            positions = self._positions(test_number)
+            for d, values in enumerate(self.values):
+                for step in (-1, 1):
+                    moved = list(positions)
+                    moved[d] += step
+                    if 0 <= moved[d] < len(values):
+                        neighbour = self._test_number(moved)
+                        if neighbour not in tested and self._meets_constraints(neighbour):
+                            candidates.add(neighbour)
+        return sorted(candidates)
+
+    def _propose(self, observed, number):
+        finite = np.isfinite(observed.to_numpy())
+        if not finite.any():
+            return self._random_test_numbers(number, exclude=observed.index)
+        # Results which are not numbers, such as a Rate / StdDev with no deviation, count as the worst
+        observed = observed.where(finite, observed[finite].min())
+        candidates = self._candidates(observed)
+        x = self._features(observed.index)
+        y = observed.to_numpy()
+        candidate_x = self._features(candidates)
+        chosen = []
+        while candidates and len(chosen) < number:
+            mean, deviation = y.mean(), y.std() or 1.0
+            model = _fit_gaussian_process(x, (y - mean) / deviation)
+            predicted, uncertainty = _predict(model, candidate_x)
+            best = int(np.argmax(_expected_improvement(predicted, uncertainty, ((y - mean) / deviation).max())))
+            chosen.append(candidates.pop(best))
+            # Take the prediction at the chosen combination as its result, so the rest of the batch looks elsewhere
+            x = np.vstack([x, candidate_x[best]])
+            y = np.append(y, mean + predicted[best] * deviation)
+            candidate_x = np.delete(candidate_x, best, axis=0)
+        return chosen
+
+
+def _squared_exponential(a, b, length_scale):
+    distances = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+    return np.exp(-0.5 * distances / length_scale ** 2)
+
+
+def _fit_gaussian_process(x, y):
+    # Picks the length scale and noise with the highest marginal likelihood from a small grid
+    best = None
+    for length_scale in (0.05, 0.1, 0.2, 0.35, 0.5, 1.0):
+        for noise in (1e-6, 1e-3, 1e-2, 1e-1):
+            covariance = _squared_exponential(x, x, length_scale) + noise * np.eye(len(x))
+            try:
+                cholesky = np.linalg.cholesky(covariance)
+            except np.linalg.LinAlgError:
+                continue
+            alpha = np.linalg.solve(cholesky.T, np.linalg.solve(cholesky, y))
+            log_likelihood = -0.5 * y @ alpha - np.log(np.diag(cholesky)).sum()
+            if best is None or log_likelihood > best[0]:
+                best = (log_likelihood, x, length_scale, cholesky, alpha)
+    return best[1:]
+
+
+def _predict(model, candidate_x):
+    x, length_scale, cholesky, alpha = model
+    covariance = _squared_exponential(candidate_x, x, length_scale)
+    mean = covariance @ alpha
+    v = np.linalg.solve(cholesky, covariance.T)
+    variance = np.maximum(1 - (v ** 2).sum(axis=0), 1e-12)
+    return mean, np.sqrt(variance)
+
+
+def _expected_improvement(mean, deviation, best, xi=0.01):
+    z = (mean - best - xi) / deviation
+    cdf = 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+    pdf = np.exp(-0.5 * z ** 2) / math.sqrt(2 * math.pi)
+    return (mean - best - xi) * cdf + deviation * pdf
+
+
+def create_variable_combinations_dict(param_dict, optimise_type, constraints=(), chunk_size=100000, budget=None,
+                                      objective='Rate / StdDev', seed=None, batch_size=1, context=None):
+    """
+    Sets up the combinations of parameters of an optimisation.
+
+    No combination is made until it is run. `run` takes the tests in chunks
+    from `combination_chunks`, and `load_combinations` puts the combinations
+    of each chunk in data.combination_df and adds its rows to the
+    optimisation report.
+
+    Parameters
+    ----------
+    param_dict : dict
+        The values of each parameter, as `opt_params` of `run`.
+    optimise_type : str
+        'combination', 'fixed', 'random', 'latin_hypercube' or 'bayesian', see
+        `CombinationSource`.
+    constraints : tuple, default ()
+        Functions which return False for combinations not to test, see
+        `CombinationSource`.
+    chunk_size : int, default 100000
+        The number of tests to load at once.
+    budget, objective, seed, batch_size
+        The settings of a search, see `CombinationSource`.
+    context : BacktestContext, default None
+        The context to store the combinations in. If None, the active context
+        is used.
 
-    if optimise_type == 'combination' or param_dict == {}:
-        combinations = itertools.product(*list_of_tuples)
-        combo_list = []
-        for combo in combinations:
-            combo_list.append(combo)
-    elif optimise_type == 'fixed':
-        combo_list = []
-        for i in range(len(list_of_tuples[0])):
-            combo_list.append([tup[i] for tup in list_of_tuples])
+    Returns
+    -------
+    None. Creates the CombinationSource in data.combinations, an empty
+    data.combination_df and data.optimisation_report, and an empty list for
+    the wealth tracks in data.optimisation_wealth_tracks.
 
-    combo_df = pd.DataFrame(data=combo_list, columns=variable_names, dtype=object)
-    # for i in range(len(combo_list)):
-    #     combo = combo_list[i]
-    #     combo_df.iloc[i] = combo
+    """
+    ctx = context if context is not None else get_context()
+    ctx.combinations = CombinationSource(param_dict, optimise_type, constraints, budget=budget, objective=objective,
+                                         seed=seed, batch_size=batch_size)
+    ctx.combination_chunk_size = chunk_size
+    ctx.combination_df = ctx.combinations.frame([])
+    ctx.optimisation_report = pd.DataFrame(index=pd.RangeIndex(0), columns=ctx.combinations.names)
+    ctx.optimisation_wealth_tracks = []
+    ctx.length_of_backtest = 0
 
-    data.combination_df = combo_df
 
-    data.optimisation_report = pd.DataFrame(index=range(len(combo_df)),
-                                            columns=combo_df.columns)
-    data.optimisation_wealth_tracks = []
-    data.length_of_backtest = 0
+def combination_chunks(context=None):
+    """
+    Yields the test numbers of an optimisation a chunk at a time. Each chunk
+    must be recorded in data.optimisation_report before the next is asked for,
+    as a bayesian search picks its tests from the results before.
+    """
+    ctx = context if context is not None else get_context()
+    return ctx.combinations.chunks(ctx.combination_chunk_size, report=lambda: ctx.optimisation_report)
 
 
-def record_backtest(combination_row):
+def load_combinations(test_numbers, extend_report=True, context=None):
+    """
+    Makes data.combination_df the combinations of `test_numbers`, the tests
+    about to be run or recorded.
+
+    Parameters
+    ----------
+    test_numbers : list
+        The test numbers, in order.
+    extend_report : bool, default True
+        Also add an empty row to data.optimisation_report for each test which
+        does not have one yet.
+    context : BacktestContext, default None
+        The optimisation. If None, the active context is used.
+
+    Returns
+    -------
+    None.
+
+    """
+    ctx = context if context is not None else get_context()
+    ctx.combination_df = ctx.combinations.frame(test_numbers)
+    if extend_report:
+        report = ctx.optimisation_report
+        new_rows = pd.Index([i for i in test_numbers if i not in report.index])
+        if len(new_rows):
+            ctx.optimisation_report = report.reindex(report.index.append(new_rows))
+
+
+def backtest_results(combination_row, context=None):
+    """
+    Works out the results of the backtest just run which `record_backtest`
+    stores in the optimisation report.
+
+    Parameters
+    ----------
+    combination_row : int
+        The test number of the optimisation.
+    context : BacktestContext, default None
+        The backtest just run. If None, the active context is used.
+
+    Returns
+    -------
+    dict
+        The total profit, number of dates, maximum drawdown and its length,
+        yearly profits and trade statistics of the backtest, and its wealth
+        track unless the optimisation is lean. It only holds plain numbers and
+        small pandas objects, so it can be sent back from another process.
+
+    """
+    ctx = context if context is not None else get_context()
+    if ctx.lean:
+        metrics = ctx.running_metrics
+        total_profit = metrics.last_wealth - ctx.starting_amount
+        number_of_dates = metrics.number_of_dates
+        max_dd = metrics.max_drawdown
+        max_dd_length = metrics.max_drawdown_length()
+        yearly_profits = metrics.yearly_profits()
+        wealth_track_df = None
+    else:
+        total_profit = ctx.wealth_track[-1] - ctx.starting_amount
+        wealth_track_df = pd.Series(data=ctx.wealth_track, index=ctx.date_track, name=combination_row)
+        number_of_dates = len(ctx.wealth_track)
+        equity = wealth_track_df - ctx.starting_amount
+        drawdown = equity - equity.cummax()
+        max_dd = drawdown.min()
+        max_dd_date = drawdown.idxmin()
+        max_dd_start = drawdown.where(drawdown==0, np.nan).loc[:max_dd_date].last_valid_index()
+        max_dd_end = drawdown.where(drawdown==0, np.nan).loc[max_dd_date:].first_valid_index()
+        max_dd_length = len(drawdown[max_dd_start:max_dd_end])
+        yearly_profits = wealth_track_df.resample('Y').last().diff()
+        yearly_profits.index = yearly_profits.index.year
+    return {'total_profit': total_profit,
+            'number_of_dates': number_of_dates,
+            'max_drawdown': max_dd,
+            'length_of_max_drawdown': max_dd_length,
+            'yearly_profits': yearly_profits,
+            'number_of_trades': ctx.number_of_trades,
+            'number_winning_trades': ctx.number_winning_trades,
+            'average_trade_%_profit': ctx.profit_percent_array.mean() if ctx.number_of_trades else 0,
+            'wealth_track': wealth_track_df}
+
+
+def record_backtest(combination_row, results=None, context=None):
     """
     Called at the end of every backtest record the results in
     data.optimisation_report.
@@ -96,56 +527,61 @@ def record_backtest(combination_row):
     ----------
     combination_row : int
         The test number of the optimisation.
+    results : dict, default None
+        The results of the test returned by `backtest_results`, when it was run
+        somewhere else. The results of the backtest just run in the context
+        are worked out if None.
+    context : BacktestContext, default None
+        The backtest to record. If None, the active context is used.
 
     Returns
     -------
-    None. Stores the results of the backtest in data.optimisation_report.
-
-    """
-    total_profit = data.wealth_track[-1] - data.starting_amount
-    wealth_track_df = pd.Series(data=data.wealth_track, index=data.date_track, name=combination_row)
-    data.optimisation_wealth_tracks.append(wealth_track_df)
-    if data.length_of_backtest == 0:
-        data.length_of_backtest = len(data.wealth_track) / 252
-    profit_as_percent = 100 * (total_profit / data.starting_amount)
-    realised_rate = profit_as_percent / data.length_of_backtest
-    equity = wealth_track_df - data.starting_amount
-    drawdown = equity - equity.cummax()
-    max_dd = drawdown.min()
-    max_dd_percent = 100 * max_dd / data.starting_amount
-    max_dd_date = drawdown.idxmin()
-    max_dd_start = drawdown.where(drawdown==0, np.nan).loc[:max_dd_date].last_valid_index()
-    max_dd_end = drawdown.where(drawdown==0, np.nan).loc[max_dd_date:].first_valid_index()
-    max_dd_length = len(drawdown[max_dd_start:max_dd_end])
-
-    data.optimisation_report.loc[combination_row] = data.combination_df.iloc[combination_row]
-    data.optimisation_report.at[combination_row, 'total_profit'] = total_profit
-    data.optimisation_report.at[combination_row, 'realised_rate'] = realised_rate
-    data.optimisation_report.at[combination_row, 'number_of_trades'] = data.number_of_trades
+    None. Stores the results of the backtest in data.optimisation_report. In a
+    lean optimisation the results are taken from data.running_metrics and no
+    wealth track is kept.
+
+    """
+    ctx = context if context is not None else get_context()
+    if results is None:
+        results = backtest_results(combination_row, context=ctx)
+    total_profit = results['total_profit']
+    max_dd = results['max_drawdown']
+    number_of_trades = results['number_of_trades']
+    yearly_profits = results['yearly_profits'].copy()
+    if results['wealth_track'] is not None:
+        ctx.optimisation_wealth_tracks.append(results['wealth_track'])
+    if ctx.length_of_backtest == 0:
+        ctx.length_of_backtest = results['number_of_dates'] / 252
+    profit_as_percent = 100 * (total_profit / ctx.starting_amount)
+    realised_rate = profit_as_percent / ctx.length_of_backtest
+    max_dd_percent = 100 * max_dd / ctx.starting_amount
+
+    ctx.optimisation_report.loc[combination_row] = ctx.combination_df.loc[combination_row]
+    ctx.optimisation_report.at[combination_row, 'total_profit'] = total_profit
+    ctx.optimisation_report.at[combination_row, 'realised_rate'] = realised_rate
+    ctx.optimisation_report.at[combination_row, 'number_of_trades'] = number_of_trades
     try:
-        data.optimisation_report.at[combination_row, 'percent profitable trades'] = 100 * \
-                                                                    (data.number_winning_trades / data.number_of_trades)
-        data.optimisation_report.at[combination_row, 'average_trade_net_profit'] = total_profit / data.number_of_trades
-        data.optimisation_report.at[combination_row, 'average_trade_%_profit'] = data.profit_percent_array.mean()
+        ctx.optimisation_report.at[combination_row, 'percent profitable trades'] = 100 * \
+                                                            (results['number_winning_trades'] / number_of_trades)
+        ctx.optimisation_report.at[combination_row, 'average_trade_net_profit'] = total_profit / number_of_trades
+        ctx.optimisation_report.at[combination_row, 'average_trade_%_profit'] = results['average_trade_%_profit']
     except ZeroDivisionError:
-        data.optimisation_report.at[combination_row, 'percent profitable trades'] = 0
-        data.optimisation_report.at[combination_row, 'average_trade_net_profit'] = 0
-        data.optimisation_report.at[combination_row, 'average_trade_%_profit'] = 0
-    data.optimisation_report.at[combination_row, 'max_drawdown'] = max_dd
-    data.optimisation_report.at[combination_row, 'max_drawdown%'] = max_dd_percent
-    data.optimisation_report.at[combination_row, 'length_of_max_drawdown'] = max_dd_length
-
-    yearly_profits = wealth_track_df.resample('Y').last().diff()
-    yearly_profits.index = yearly_profits.index.year
-    yearly_profits *= 100 / data.starting_amount
+        ctx.optimisation_report.at[combination_row, 'percent profitable trades'] = 0
+        ctx.optimisation_report.at[combination_row, 'average_trade_net_profit'] = 0
+        ctx.optimisation_report.at[combination_row, 'average_trade_%_profit'] = 0
+    ctx.optimisation_report.at[combination_row, 'max_drawdown'] = max_dd
+    ctx.optimisation_report.at[combination_row, 'max_drawdown%'] = max_dd_percent
+    ctx.optimisation_report.at[combination_row, 'length_of_max_drawdown'] = results['length_of_max_drawdown']
+
+    yearly_profits *= 100 / ctx.starting_amount
     for year in yearly_profits.index:
-        data.optimisation_report.at[combination_row, year] = yearly_profits[year]
+        ctx.optimisation_report.at[combination_row, year] = yearly_profits[year]
     stddev_yearly_returns = yearly_profits.std()
-    data.optimisation_report.at[combination_row, 'Standard Dev of Yearly Returns'] = stddev_yearly_returns
-    data.optimisation_report.at[combination_row, r'Rate / StdDev'] = realised_rate / stddev_yearly_returns
+    ctx.optimisation_report.at[combination_row, 'Standard Dev of Yearly Returns'] = stddev_yearly_returns
+    ctx.optimisation_report.at[combination_row, r'Rate / StdDev'] = realised_rate / stddev_yearly_returns
 
 
-def plot_tests(test_numbers, title=None):
+def plot_tests(test_numbers, title=None, context=None):
     """
     Provide some test numbers from the optimisation just run to plot.
 
@@ -158,8 +594,13 @@ def plot_tests(test_numbers, title=None):
     ----------
     test_numbers : list
         A list of integers referring to test numbers of an optimsation report.
+        Only the tests which were run can be plotted, and none of a lean
+        optimisation, which keeps no wealth tracks.
     title : str, default None
         The title you would like to appear at the top of the plot.
+    context : BacktestContext, default None
+        The context the optimisation was run in. If None, the active context
+        is used.
 
     Returns
     -------
@@ -173,12 +614,19 @@ def plot_tests(test_numbers, title=None):
     >>>
 
     """
+    ctx = context if context is not None else get_context()
+    # Each wealth track is named by its test number, which need not be its position in the list
+    tracks = {track.name: track for track in ctx.optimisation_wealth_tracks}
+    missing = [n for n in test_numbers if n not in tracks]
+    if missing:
+        raise ValueError('There is no wealth track of test numbers {}, only of the tests run by an optimisation which '
+                         'is not lean'.format(missing))
     fig = go.Figure()
 
-    max_profit = max(max(x) for x in data.optimisation_wealth_tracks) - data.starting_amount
-    in_out_samples = pd.DataFrame(index=data.all_dates.union(data.oos_dates), columns=['IS', 'OOS'])
-    in_out_samples['IS'].loc[data.is_dates] = max_profit * 1.05
-    in_out_samples['OOS'].loc[data.oos_dates] = max_profit * 1.05
+    max_profit = max(max(x) for x in tracks.values()) - ctx.starting_amount
+    in_out_samples = pd.DataFrame(index=ctx.all_dates.union(ctx.oos_dates), columns=['IS', 'OOS'])
+    in_out_samples['IS'].loc[ctx.is_dates] = max_profit * 1.05
+    in_out_samples['OOS'].loc[ctx.oos_dates] = max_profit * 1.05
     in_out_samples.fillna(0, inplace=True)
     fig.add_trace(go.Scatter(x=in_out_samples.index, y=in_out_samples['IS'],
                              name='In Sample', marker_color='green', fill='tozeroy', line_shape='hv'))
@@ -186,7 +634,7 @@ def plot_tests(test_numbers, title=None):
                              name='Out of Sample', marker_color='red', fill='tozeroy', line_shape='hv'))
 
     for n in test_numbers:
-        profit_series = data.optimisation_wealth_tracks[n] - 100000
+        profit_series = tracks[n] - ctx.starting_amount
         final_equity = profit_series.iloc[-1]
         fig.add_trace(go.Scatter(x=profit_series.index, y=profit_series, name=str(n) + ' ' + str(final_equity)))
 
@@ -194,7 +642,7 @@ def plot_tests(test_numbers, title=None):
     plot(fig, auto_open=True)
 
 
-def average_per_parameter(results):
+def average_per_parameter(results, context=None):
     """
     Get the average profit over all optimsations for each parameter variation.
 
@@ -205,6 +653,9 @@ def average_per_parameter(results):
     ----------
     results : pandas-dataframe
         A dataframe of the results of the optimisation.
+    context : BacktestContext, default None
+        The context the optimisation was run in. If None, the active context
+        is used.
 
     Returns
     -------
@@ -218,8 +669,9 @@ def average_per_parameter(results):
     >>>
 
     """
+    ctx = context if context is not None else get_context()
     averages_df = pd.DataFrame(columns=['average'])
-    for param in data.combination_df.columns:
+    for param in ctx.combination_df.columns:
         variations = results[param].value_counts().index
         for val in variations:
             average = results[results[param] == val]['total_profit'].mean()
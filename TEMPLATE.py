@@ -32,12 +32,15 @@ def before_backtest_start(user, data):
 
 '''
 In each of the functions below, two useful variables have been provided. `d` is the timestamp for the current day of
-the backtest. `index_today` is the row number relating to this date in `data.daily_closes`. You can use `index_today`
-for creating history variables.
+the backtest. `index_today` is the row number relating to this date in `data.daily_closes`. For history variables use
+`data.history`, eg. `data.history('closes', 20, 'SPY')` for the last 20 closes of SPY. It returns a read-only NumPy view
+that only includes prices known at this point of the day, so in the open functions today's close is not included.
+Indicators calculated in `before_backtest_start` can be read the same way after adding them with
+`data.price_panels.add_panel('name', indicator_dataframe)`.
 '''
 def trade_open(user, data):
     d = data.current_date
-    index_today = data.daily_closes.index.get_loc(d)
+    index_today = data.current_index
     return
 
 
@@ -47,13 +50,13 @@ def trade_every_day_open(user, data):
     function will run after.
     '''
     d = data.current_date
-    index_today = data.daily_closes.index.get_loc(d)
+    index_today = data.current_index
     return
 
 
 def trade_close(user, data):
     d = data.current_date
-    index_today = data.daily_closes.index.get_loc(d)
+    index_today = data.current_index
     return
 
 
@@ -62,14 +65,15 @@ def trade_every_day_close(user, data):
     Similar to `trade_every_day_open` but runs after `trade_close`.
     '''
     d = data.current_date
-    index_today = data.daily_closes.index.get_loc(d)
+    index_today = data.current_index
     return
 
 
 def after_backtest_finish(user, data):
     '''
     This is run after each backtest finishes. If you are doing a single backtest, can use it to plot results or save
-    files. If optimising, be weary that this will run after each backtest in the optimisation.
+    files. If optimising, be weary that this will run after each backtest in the optimisation. The trade list of the
+    backtest is in `data.trade_df`.
     '''
     return
 
@@ -87,7 +91,7 @@ of the dictionary to be a tuple of the optimised parameters. The program will ru
 combination of the parameters.
 '''
 optimise = True
-optimise_type = 'combination'
+optimise_type = 'combination'  # 'combination', 'fixed', or with opt_budget 'random', 'latin_hypercube', 'bayesian'
 params_to_optimise = {}
 in_out_sampling = {'end_trim_percent': 10,
                    'random_month_percent': 25}
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 19:48:37 2026
+
+@author: Nick Elmer
+"""
+import functools
+import inspect
+
+from backtest_context import get_context
+
+
+# The attributes of a context which belong to one account, swapped in and out by `select_account`
+ACCOUNT_STATE = ('starting_amount', 'cash', 'wealth', 'value_invested', 'profit', 'current_positions', 'wealth_track',
+                 'date_track', 'trade_ledger', 'position_log', 'order_book', 'running_metrics', 'trade_df',
+                 'number_of_trades', 'number_winning_trades', 'profit_percent_array')
+
+
+class Account:
+    """
+    One account configuration of a batch backtest.
+
+    A batch backtest runs the callbacks once and places every order in each
+    account, sized by that account's own cash and capital. The first account
+    is the primary account: its state is what the callbacks see through
+    `data`, and it decides the signals for all the accounts. Each other
+    account keeps its state here while it is not selected.
+
+    Parameters
+    ----------
+    starting_cash : float
+        The cash the account starts with.
+    compound : bool, default None
+        Overrides the `compound` argument of every order placed in the account.
+        The argument of each order is used if None.
+    able_to_exceed : bool, default None
+        Overrides the `able_to_exceed` argument of every order placed in the
+        account. The argument of each order is used if None.
+
+    Examples
+    --------
+    >>> run(..., accounts=[dict(starting_cash=100000, compound=False),
+    ...                    dict(starting_cash=100000, compound=True),
+    ...                    dict(starting_cash=25000, able_to_exceed=False)])
+    """
+
+    def __init__(self, starting_cash, compound=None, able_to_exceed=None):
+        self.starting_cash = starting_cash
+        self.overrides = {name: value for name, value in (('compound', compound), ('able_to_exceed', able_to_exceed))
+                          if value is not None}
+        self.state = {'starting_amount': starting_cash}
+
+    def __repr__(self):
+        settings = ', '.join('{}={}'.format(name, value) for name, value in self.overrides.items())
+        return 'Account(starting_cash={}{})'.format(self.starting_cash, ', ' + settings if settings else '')
+
+
+def select_account(number, context=None):
+    """
+    Makes account `number` of data.accounts the one orders are placed in.
+
+    The state of the account selected before is stored on its Account and the
+    state of the new account is put on the context, so every function which
+    reads data.cash, data.trade_ledger and so on works on the new account.
+    """
+    ctx = context if context is not None else get_context()
+    if number == ctx.active_account:
+        return
+    ctx.accounts[ctx.active_account].state = {name: getattr(ctx, name) for name in ACCOUNT_STATE
+                                              if hasattr(ctx, name)}
+    account = ctx.accounts[number]
+    for name, value in account.state.items():
+        setattr(ctx, name, value)
+    ctx.account_overrides = account.overrides
+    ctx.active_account = number
+
+
+def _on_other_accounts(ctx, call_primary, call_other):
+    # Nested order calls only run in the account they are made in
+    ctx.account_depth += 1
+    try:
+        result = call_primary()
+        for number in range(1, len(ctx.accounts)):
+            select_account(number, ctx)
+            call_other()
+    finally:
+        select_account(0, ctx)
+        ctx.account_depth -= 1
+    return result
+
+
+def on_every_account(func):
+    """
+    Makes a function which takes a `context` argument run in every account of
+    a batch backtest, first in the primary account and then in each other
+    account. Its result in the primary account is returned.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        context = kwargs.get('context')
+        ctx = context if context is not None else get_context()
+        if ctx.accounts is None or ctx.account_depth:
+            return func(*args, **kwargs)
+        return _on_other_accounts(ctx, lambda: func(*args, **kwargs), lambda: func(*args, **kwargs))
+    return wrapper
+
+
+def on_every_account_method(method):
+    """
+    Makes a method of Orders place its order in every account of a batch
+    backtest. The other accounts are given a copy of the Orders object made in
+    that account, so it sees that account's shares and capital. A call which
+    names a `trade_number` is only made in the primary account, as trade
+    numbers are not the same in every account.
+    """
+    return _every_account_method(method, holding_only=False)
+
+
+def on_every_holding_account_method(method):
+    """
+    The same as `on_every_account_method`, but the method is only called in
+    the other accounts which hold the symbol, for checks of open positions.
+    """
+    return _every_account_method(method, holding_only=True)
+
+
+def _every_account_method(method, holding_only):
+    parameters = list(inspect.signature(method).parameters)
+    trade_number_position = parameters.index('trade_number') if 'trade_number' in parameters else None
+
+    def call_other(order, args, kwargs):
+        copy = order.copy()
+        if not holding_only or copy.current_number_of_shares != 0:
+            method(copy, *args, **kwargs)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        ctx = self.ctx
+        if ctx.accounts is None or ctx.account_depth:
+            return method(self, *args, **kwargs)
+        if trade_number_position is not None:
+            trade_number = kwargs.get('trade_number')
+            if trade_number is None and len(args) >= trade_number_position:
+                trade_number = args[trade_number_position - 1]
+            if trade_number is not None:
+                return method(self, *args, **kwargs)
+        return _on_other_accounts(ctx, lambda: method(self, *args, **kwargs),
+                                  lambda: call_other(self, args, kwargs))
+    return wrapper
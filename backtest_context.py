@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 13:40:52 2026
+
+@author: Nick Elmer
+"""
+import threading
+import types
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+class BacktestContext:
+    """
+    Holds all the state of a backtest or optimisation.
+
+    Everything that used to be stored as an attribute of the `data` and `user`
+    modules is stored on a context instead, so more than one backtest can run
+    in the same process. `run`, `Orders`, `initialise`, `update` and the
+    functions in Optimise all take a `context` argument. If it is not given,
+    the context active in the current thread is used, see `get_context`.
+
+    The `data` and `user` modules are kept for existing strategies. Reading or
+    setting an attribute of `data` reads or sets it on the active context, and
+    `user` does the same with the active context's `user`.
+
+    Parameters
+    ----------
+    user : object, default None
+        Where strategy parameters and indicators are stored. A new empty
+        namespace is created if None.
+
+    Attributes
+    ----------
+    user : object
+        The strategy parameters and indicators passed to every callback as
+        `user`.
+    daily_opens, daily_highs, daily_lows, daily_closes : pandas-dataframe
+        The price data of the backtest.
+    price_panels : PricePanels
+        The price data as NumPy arrays.
+    all_dates : pandas-datetimeindex
+        The dates the backtest steps through.
+    current_date, current_index, current_price
+        The date being traded, its row in `price_panels` and the prices at the
+        current point of the day.
+    current_phase : str
+        'open' while the open callbacks run and 'close' after.
+    trade_ledger : TradeLedger
+        Every trade of the current backtest.
+    position_log : PositionLog
+        Every change to the positions held in the current backtest.
+    order_book : OrderBook
+        The resting orders of the current backtest.
+    cash, value_invested, profit, starting_amount : float
+        The cash held, the value of open positions at entry, the realised
+        profit and the starting cash of the current backtest.
+    wealth_track, date_track : list
+        The wealth at the close of each date of the current backtest.
+    running_metrics : RunningMetrics
+        The wealth statistics of the current backtest in a lean optimisation,
+        which keeps them instead of `wealth_track` and `date_track`.
+    accounts : list
+        The Account of each account of a batch backtest, or None. The state of
+        the selected account, `active_account`, is the state on the context.
+    combination_df, optimisation_report : pandas-dataframe
+        The parameter combinations and results of an optimisation.
+
+    Examples
+    --------
+    >>> from threading import Thread
+    >>> threads = [Thread(target=run, kwargs=dict(context=BacktestContext(), **settings))
+    ...            for settings in all_settings]
+    """
+
+    def __init__(self, user=None):
+        self.user = user if user is not None else types.SimpleNamespace()
+        self.optimising = False
+        self.lean = False
+        self.accounts = None
+        self.active_account = 0
+        self.account_depth = 0
+        self.account_overrides = {}
+        self.current_positions = set()
+        self.cash = 0
+        self.value_invested = 0
+        self.profit = 0
+        self.starting_amount = 0
+        self.wealth_track = []
+        self.date_track = []
+        self.current_phase = 'close'
+
+    def history(self, field, n, symbols=None):
+        """
+        Returns the last `n` values of a price field or panel up to now.
+
+        The values are a read-only view of `price_panels`, so nothing is
+        copied. Only values which are known at the current point of the day
+        are included: during the open callbacks the window of 'closes' (or any
+        field known at the close) ends on the previous date, and the window of
+        'opens' ends today.
+
+        Parameters
+        ----------
+        field : str
+            'opens', 'highs', 'lows' or 'closes' (or 'Open', 'High', 'Low',
+            'Close'), or a panel added with `price_panels.add_panel`.
+        n : int
+            The number of dates.
+        symbols : str or list, default None
+            A single symbol returns a 1D array. A list of symbols returns a 2D
+            array, which is a copy. All symbols are returned if None.
+
+        Returns
+        -------
+        numpy-array
+            A row for each date, oldest first.
+
+        Examples
+        --------
+        >>> def trade_close(user, data):
+        ...     sma = data.history('closes', 20, 'SPY').mean()
+        """
+        panels = self.price_panels
+        if self.current_phase == 'close' or panels.when_known(field) == 'open':
+            stop = self.current_index + 1
+        else:
+            stop = self.current_index
+        if symbols is None:
+            columns = slice(None)
+        elif isinstance(symbols, (list, tuple, set, pd.Index, np.ndarray)):
+            columns = [panels.symbol_columns[symbol] for symbol in symbols]
+        else:
+            columns = panels.symbol_columns[symbols]
+        return panels.window(field, stop, n, columns)
+
+
+_local = threading.local()
+_default_context = BacktestContext()
+
+
+def get_context():
+    """
+    Returns the context active in the current thread.
+
+    This is the context of the backtest being run in this thread, or a
+    default context shared by the whole process if no backtest is running.
+    """
+    context = getattr(_local, 'context', None)
+    return context if context is not None else _default_context
+
+
+@contextmanager
+def activate(context):
+    """
+    Makes `context` the active context of the current thread until the with
+    block ends.
+
+    Examples
+    --------
+    >>> with activate(context):
+    ...     Orders('SPY').order_target_percent(0.1)
+    """
+    previous = getattr(_local, 'context', None)
+    _local.context = context
+    try:
+        yield context
+    finally:
+        _local.context = previous
+
+
+class ContextFacade(types.ModuleType):
+    """
+    A module type which forwards attribute access to an object found at the
+    time of access, used to keep the `data` and `user` modules working.
+    """
+
+    def _target(self):
+        return get_context()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._target(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._target(), name)
+
+
+class UserFacade(ContextFacade):
+
+    def _target(self):
+        return get_context().user
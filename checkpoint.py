@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 18:12:09 2026
+
+@author: Nick Elmer
+"""
+import gzip
+import os
+import pickle
+import random
+
+import numpy as np
+import pandas as pd
+
+from backtest_context import get_context
+
+
+CHECKPOINT_VERSION = 1
+
+# The attributes of a context which change as a backtest steps through its dates
+ENGINE_STATE = ('start_date', 'current_date', 'current_index', 'current_positions', 'cash', 'wealth',
+                'value_invested', 'profit', 'starting_amount', 'wealth_track', 'date_track', 'trade_ledger',
+                'position_log', 'order_book', 'running_metrics', 'accounts')
+
+OPTIMISATION_STATE = ('optimisation_report', 'optimisation_wealth_tracks', 'length_of_backtest')
+
+
+def _fingerprint(ctx, bar):
+    dates = ctx.all_dates
+    return {'first_date': dates[0], 'last_date_run': dates[bar - 1] if bar else None,
+            'symbols': tuple(ctx.price_panels.symbols)}
+
+
+def price_data(context=None):
+    """Returns the data frames loaded for a backtest, every attribute of the context starting with 'daily_'."""
+    ctx = context if context is not None else get_context()
+    return {name: value for name, value in vars(ctx).items()
+            if name.startswith('daily_') and isinstance(value, pd.DataFrame)}
+
+
+def save_checkpoint(path, bar, test_number=0, user_state=(), include_prices=False, context=None):
+    """
+    Saves the state of a backtest part way through to a file.
+
+    The state saved is everything which changes from date to date: the trade
+    ledger and its open lots, the position log, the resting orders, the cash,
+    value invested and profit, the wealth and date tracks, the state of the
+    `random` and `numpy.random` generators and the attributes of `user` named in
+    `user_state`. When optimising, the results of the tests already run are
+    saved too. The price data is only saved if `include_prices` is True,
+    otherwise `run` loads it again on resume.
+
+    The file is a gzipped pickle. It is written to a temporary file first and
+    then moved over `path`, so a crash while saving never leaves a half
+    written checkpoint.
+
+    Parameters
+    ----------
+    path : str
+        The file to save to.
+    bar : int
+        The position in data.all_dates of the next date to run.
+    test_number : int, default 0
+        The test number of data.combinations being run.
+    user_state : tuple, default ()
+        The names of the attributes of `user` which the strategy changes as it
+        runs, eg. ('days_in_trade',). Indicators calculated in
+        `before_backtest_start` do not need to be saved.
+    include_prices : bool, default False
+        Also save the data frames returned by `price_data`, so a backtest can
+        carry on from the checkpoint over new dates without loading the dates
+        already run.
+    context : BacktestContext, default None
+        The backtest to save. If None, the active context is used.
+
+    Returns
+    -------
+    None.
+
+    """
+    ctx = context if context is not None else get_context()
+    state = {'version': CHECKPOINT_VERSION,
+             'fingerprint': _fingerprint(ctx, bar),
+             'test_number': test_number,
+             'combination': ctx.combinations.combination(test_number),
+             'bar': bar,
+             'engine': {name: getattr(ctx, name) for name in ENGINE_STATE},
+             'user': {name: getattr(ctx.user, name) for name in user_state},
+             'random_state': random.getstate(),
+             'numpy_random_state': np.random.get_state()}
+    if ctx.optimising:
+        state['optimisation'] = {name: getattr(ctx, name) for name in OPTIMISATION_STATE}
+    if include_prices:
+        state['prices'] = price_data(context=ctx)
+
+    temp_path = '{}.tmp'.format(path)
+    with gzip.open(temp_path, 'wb', compresslevel=6) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint saved by `save_checkpoint`.
+
+    Parameters
+    ----------
+    path : str
+        The checkpoint file.
+
+    Returns
+    -------
+    dict
+        The saved state. 'test_number' and 'bar' are the test and the position
+        in data.all_dates to carry on from.
+
+    """
+    with gzip.open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('{} is not a checkpoint which can be resumed by this version'.format(path))
+    return state
+
+
+def restore_checkpoint(state, context=None):
+    """
+    Puts the state read by `load_checkpoint` back into a backtest.
+
+    The backtest must have been set up the same way as the one saved: the same
+    symbols, test parameters and dates up to the last date run, although it
+    can have more dates after it. Call it after `before_backtest_start` and
+    `initialise`, so the saved state replaces the fresh state.
+
+    Parameters
+    ----------
+    state : dict
+        The state returned by `load_checkpoint`.
+    context : BacktestContext, default None
+        The backtest to restore into. If None, the active context is used.
+
+    Returns
+    -------
+    None.
+
+    """
+    ctx = context if context is not None else get_context()
+    if state['bar'] > len(ctx.all_dates) or state['fingerprint'] != _fingerprint(ctx, state['bar']):
+        raise ValueError('The checkpoint was saved from a backtest with different dates or symbols')
+    if state['combination'] != ctx.combinations.combination(state['test_number']):
+        raise ValueError('The checkpoint was saved from a backtest with different parameters')
+    for name, value in state['engine'].items():
+        setattr(ctx, name, value)
+    for name, value in state.get('optimisation', {}).items():
+        setattr(ctx, name, value)
+    for name, value in state['user'].items():
+        setattr(ctx.user, name, value)
+    random.setstate(state['random_state'])
+    np.random.set_state(state['numpy_random_state'])
+    ctx.current_price = ctx.price_panels.row('closes', ctx.current_index)
+    ctx.current_phase = 'close'
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 17:20:44 2026
+
+@author: Nick Elmer
+"""
+from math import floor, ceil, isnan
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, without it the same loop runs as plain Python
+    njit = None
+
+
+EXIT_SIGNAL = 0
+STOP_LOSS = 1
+TAKE_PROFIT = 2
+END_OF_BACKTEST = 3
+
+
+def _compile(func):
+    if njit is None:
+        return func
+    return njit(cache=True, nogil=True)(func)
+
+
+def is_compiled():
+    """Returns True if Numba is installed and the bar loop runs as compiled code."""
+    return njit is not None
+
+
+@_compile
+def bar_loop(opens, highs, lows, closes, rebalance, entries, exits, sizes, exec_at_open,
+             stop_loss, tp_floor, tp_giveback, starting_amount, compound, able_to_exceed, min_to_enter,
+             capacity):
+    """
+    Runs a rule based backtest over arrays of prices and signals.
+
+    Every 2D array has a row for each date of the backtest and a column for
+    each symbol. On rebalance dates a symbol which is held is closed if its
+    exit signal is True, and a symbol which is not held is bought (or sold
+    short if its size is negative) if its entry signal is True. Each day at
+    the close every position is checked against its stop loss and then its
+    take profit, following `Orders.check_stop_loss` and
+    `Orders.check_take_profit`. A NaN `stop_loss` or `tp_floor` turns the
+    check off.
+
+    Returns
+    -------
+    tuple
+        The wealth at the close of each date, then the column, open row, open
+        price, amount, close row, close price and close reason of each trade,
+        then the number of trades. `capacity` must be at least the number of
+        True entry signals on rebalance dates, which is the most trades there
+        can be.
+
+    """
+    n_days, n_symbols = closes.shape
+    wealth = np.empty(n_days)
+    t_column = np.empty(capacity, dtype=np.int64)
+    t_open_row = np.empty(capacity, dtype=np.int64)
+    t_open_price = np.empty(capacity)
+    t_amount = np.empty(capacity)
+    t_close_row = np.full(capacity, -1, dtype=np.int64)
+    t_close_price = np.full(capacity, np.nan)
+    t_reason = np.full(capacity, -1, dtype=np.int64)
+    n_trades = 0
+
+    shares = np.zeros(n_symbols)
+    open_value = np.zeros(n_symbols)
+    trade = np.full(n_symbols, -1, dtype=np.int64)
+    max_high = np.full(n_symbols, -np.inf)
+    min_low = np.full(n_symbols, np.inf)
+    cash = starting_amount
+    value_invested = 0.0
+    realised_profit = 0.0
+    profit = 0.0
+    short_open_value = 0.0
+    open_short_lots = 0
+    use_stop = not isnan(stop_loss)
+    use_tp = not isnan(tp_floor)
+
+    for n in range(n_days):
+        if rebalance[n]:
+            if compound:
+                capital = starting_amount + profit
+            else:
+                capital = starting_amount
+            for s in range(n_symbols):
+                price = opens[n, s] if exec_at_open else closes[n, s]
+                if shares[s] != 0:
+                    if not exits[n, s]:
+                        continue
+                    reason = EXIT_SIGNAL
+                    exit_price = price
+                else:
+                    if not entries[n, s] or isnan(sizes[n, s]) or isnan(price):
+                        continue
+                    value = sizes[n, s] * capital
+                    amount = floor(value / price) if value >= 0 else ceil(value / price)
+                    if amount == 0 or abs(amount) < min_to_enter:
+                        continue
+                    value_of_order = amount * price
+                    value_space = starting_amount - value_invested
+                    if not able_to_exceed and abs(value_of_order) > value_space:
+                        amount = floor(value_space / price) if amount > 0 else ceil(-value_space / price)
+                        value_of_order = amount * price
+                    if abs(amount) < min_to_enter:
+                        continue
+                    t_column[n_trades] = s
+                    t_open_row[n_trades] = n
+                    t_open_price[n_trades] = price
+                    t_amount[n_trades] = amount
+                    trade[s] = n_trades
+                    n_trades += 1
+                    shares[s] = amount
+                    open_value[s] = value_of_order
+                    max_high[s] = -np.inf
+                    min_low[s] = np.inf
+                    cash -= abs(value_of_order)
+                    value_invested += abs(value_of_order)
+                    if amount < 0:
+                        open_short_lots += 1
+                        short_open_value += value_of_order
+                    continue
+
+                # Closing the position of symbol s at exit_price
+                profit_made = shares[s] * exit_price - open_value[s]
+                cash += profit_made + abs(open_value[s])
+                value_invested -= abs(open_value[s])
+                realised_profit += profit_made
+                if shares[s] < 0:
+                    open_short_lots -= 1
+                    short_open_value = short_open_value - open_value[s] if open_short_lots else 0.0
+                t_close_row[trade[s]] = n
+                t_close_price[trade[s]] = exit_price
+                t_reason[trade[s]] = reason
+                shares[s] = 0
+                trade[s] = -1
+
+        for s in range(n_symbols):
+            if shares[s] == 0 or not (use_stop or use_tp):
+                continue
+            long = shares[s] > 0
+            entry_value = open_value[s]
+            reason = -1
+            exit_price = np.nan
+            if use_stop:
+                if long:
+                    stop_value = (1 - stop_loss) * entry_value
+                    extreme_value = shares[s] * lows[n, s]
+                else:
+                    stop_value = (1 + stop_loss) * entry_value
+                    extreme_value = shares[s] * highs[n, s]
+                if extreme_value < stop_value:
+                    stop_price = stop_value / shares[s]
+                    if (long and opens[n, s] <= stop_price) or (not long and opens[n, s] >= stop_price):
+                        exit_price = opens[n, s]
+                    else:
+                        exit_price = stop_price
+                    if lows[n, s] <= exit_price <= highs[n, s]:
+                        reason = STOP_LOSS
+            if reason < 0 and use_tp:
+                if long:
+                    best = max_high[s] if not highs[n, s] > max_high[s] else highs[n, s]
+                    max_profit_pct = (shares[s] * best - entry_value) / entry_value
+                    todays_min_profit_pct = (shares[s] * lows[n, s] - entry_value) / entry_value
+                else:
+                    best = min_low[s] if not lows[n, s] < min_low[s] else lows[n, s]
+                    max_profit_pct = (shares[s] * best - entry_value) / abs(entry_value)
+                    todays_min_profit_pct = (shares[s] * highs[n, s] - entry_value) / abs(entry_value)
+                if max_profit_pct > tp_floor and todays_min_profit_pct <= max_profit_pct * (1 - tp_giveback):
+                    if long:
+                        exit_price = ((max_profit_pct * (1 - tp_giveback) + 1) * entry_value) / shares[s]
+                        if closes[n, s] < exit_price:
+                            exit_price = closes[n, s]
+                    else:
+                        exit_price = (1 - max_profit_pct * (1 - tp_giveback)) * entry_value / shares[s]
+                        if closes[n, s] > exit_price:
+                            exit_price = closes[n, s]
+                    if lows[n, s] <= exit_price <= highs[n, s]:
+                        reason = TAKE_PROFIT
+            if reason < 0:
+                continue
+            profit_made = shares[s] * exit_price - open_value[s]
+            cash += profit_made + abs(open_value[s])
+            value_invested -= abs(open_value[s])
+            realised_profit += profit_made
+            if shares[s] < 0:
+                open_short_lots -= 1
+                short_open_value = short_open_value - open_value[s] if open_short_lots else 0.0
+            t_close_row[trade[s]] = n
+            t_close_price[trade[s]] = exit_price
+            t_reason[trade[s]] = reason
+            shares[s] = 0
+            trade[s] = -1
+
+        position_value = 0.0
+        for s in range(n_symbols):
+            if shares[s] != 0:
+                position_value += shares[s] * closes[n, s]
+                if highs[n, s] > max_high[s]:
+                    max_high[s] = highs[n, s]
+                if lows[n, s] < min_low[s]:
+                    min_low[s] = lows[n, s]
+        wealth[n] = cash + (position_value - 2 * short_open_value)
+        profit = realised_profit
+
+    last = n_days - 1
+    for s in range(n_symbols):
+        if shares[s] != 0:
+            t_close_row[trade[s]] = last
+            t_close_price[trade[s]] = closes[last, s]
+            t_reason[trade[s]] = END_OF_BACKTEST
+    return wealth, t_column, t_open_row, t_open_price, t_amount, t_close_row, t_close_price, t_reason, n_trades
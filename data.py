@@ -5,6 +5,11 @@ Created on Fri Dec 20 11:39:51 2019
 @author: Nick Elmer
 """
 '''
-Currently this script has nothing in it. I think it might need an __init__,
-but it currently works fine without.
-'''
\ No newline at end of file
+Compatibility facade for the state of a backtest. The state now lives on a
+BacktestContext. Reading or setting any attribute of this module reads or sets
+it on the context active in the current thread, see backtest_context.
+'''
+import sys as _sys
+from backtest_context import ContextFacade as _ContextFacade
+
+_sys.modules[__name__].__class__ = _ContextFacade
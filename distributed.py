@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 21:52:18 2026
+
+@author: Nick Elmer
+"""
+import collections
+import hashlib
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import Optimise
+from backtest_context import get_context
+
+
+# Seconds between the messages a worker sends to show it is still running a test
+HEARTBEAT_INTERVAL = 5
+
+_HEADER = struct.Struct('>I')
+
+
+def _send(connection, message):
+    payload = zlib.compress(json.dumps(message).encode('utf-8'))
+    connection.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _receive_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('The connection was closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _receive(connection):
+    size, = _HEADER.unpack(_receive_exactly(connection, _HEADER.size))
+    return json.loads(zlib.decompress(_receive_exactly(connection, size)).decode('utf-8'))
+
+
+def _plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _encode_results(results):
+    # The results of `Optimise.backtest_results` as JSON, which keeps every float exactly
+    encoded = {name: _plain(value) for name, value in results.items()
+               if name not in ('yearly_profits', 'wealth_track')}
+    yearly_profits = results['yearly_profits']
+    encoded['yearly_profits'] = {'years': yearly_profits.index.tolist(), 'values': yearly_profits.tolist()}
+    wealth_track = results['wealth_track']
+    if wealth_track is not None:
+        wealth_track = {'dates': wealth_track.index.asi8.tolist(), 'values': wealth_track.tolist()}
+    encoded['wealth_track'] = wealth_track
+    return encoded
+
+
+def _decode_results(encoded, combination_row):
+    results = dict(encoded)
+    yearly_profits = encoded['yearly_profits']
+    results['yearly_profits'] = pd.Series(yearly_profits['values'], index=yearly_profits['years'], dtype=np.float64)
+    wealth_track = encoded['wealth_track']
+    if wealth_track is not None:
+        dates = pd.DatetimeIndex(np.array(wealth_track['dates'], dtype='datetime64[ns]'))
+        results['wealth_track'] = pd.Series(wealth_track['values'], index=dates, name=combination_row)
+    return results
+
+
+def optimisation_fingerprint(context=None):
+    """
+    Returns a hash of the tests, dates and symbols of an optimisation, which a
+    worker must share with its coordinator.
+    """
+    ctx = context if context is not None else get_context()
+    combinations = ctx.combinations
+    fingerprint = hashlib.sha256(repr((combinations.names, combinations.values,
+                                       combinations.optimise_type)).encode('utf-8'))
+    fingerprint.update(repr((ctx.all_dates[0], ctx.all_dates[-1], len(ctx.all_dates), list(ctx.price_panels.symbols),
+                             ctx.oos_dates.asi8.tolist(), ctx.starting_amount, ctx.lean)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class Coordinator:
+    """
+    Hands out the tests of an optimisation to workers connected over TCP and
+    collects their results.
+
+    Each worker connection is served by its own thread. A worker asks for a
+    test, runs it and sends back the results, and sends a heartbeat every
+    HEARTBEAT_INTERVAL seconds while it is running. The tests of a worker
+    which disconnects, or is not heard from for `heartbeat_timeout` seconds,
+    are queued again for the other workers. If a test is finished twice, the
+    first results are kept. The test numbers are taken from `test_numbers` as
+    they are handed out, so they can be made lazily.
+
+    Messages are zlib compressed JSON with a length prefix, so a worker can
+    never make the coordinator run code, but anyone who can connect can send
+    results: only listen on a trusted network.
+
+    Parameters
+    ----------
+    address : tuple
+        The (host, port) to listen on. Port 0 picks a free port.
+    test_numbers : iterable
+        The test numbers to hand out, in order.
+    fingerprint : str
+        The `optimisation_fingerprint` every worker must have.
+    heartbeat_timeout : float, default 60
+        The seconds without a message from a worker before it is taken as lost.
+
+    Attributes
+    ----------
+    address : tuple
+        The address listened on.
+    results : queue.Queue
+        The (test number, results) of each finished test, in the order they
+        finish.
+    """
+
+    def __init__(self, address, test_numbers, fingerprint, heartbeat_timeout=60):
+        self.test_numbers = iter(test_numbers)
+        self.fingerprint = fingerprint
+        self.heartbeat_timeout = heartbeat_timeout
+        self.pending = collections.deque()
+        self.running = {}
+        self.last_heard = {}
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self._closed = threading.Event()
+        self.server = socket.create_server(address)
+        self.server.settimeout(0.5)
+        self.address = self.server.getsockname()[:2]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            connection.settimeout(None)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        welcomed = False
+        try:
+            while True:
+                message = _receive(connection)
+                with self.lock:
+                    self.last_heard[connection] = time.monotonic()
+                    if message.get('type') == 'hello':
+                        welcomed = message.get('fingerprint') == self.fingerprint
+                        reply = {'type': 'welcome'} if welcomed else \
+                            {'type': 'reject', 'reason': 'The worker has different tests, dates or symbols'}
+                    elif welcomed:
+                        reply = self._handle(connection, message)
+                    else:
+                        reply = {'type': 'reject', 'reason': 'The worker has not said hello'}
+                if reply is not None:
+                    _send(connection, reply)
+        except (OSError, ValueError, zlib.error):
+            pass
+        finally:
+            with self.lock:
+                self.last_heard.pop(connection, None)
+                lost = sorted(test for test, owner in self.running.items() if owner is connection)
+                for test in lost:
+                    del self.running[test]
+                self.pending.extendleft(reversed(lost))
+            connection.close()
+
+    def _handle(self, connection, message):
+        # Called holding the lock. Returns the reply to the message, if any
+        kind = message.get('type')
+        if kind == 'request':
+            test = self.pending.popleft() if self.pending else next(self.test_numbers, None)
+            if test is not None:
+                self.running[test] = connection
+                return {'type': 'test', 'test_number': test}
+            if not self.running:
+                return {'type': 'done'}
+            return {'type': 'wait', 'seconds': 1}
+        if kind == 'result':
+            # Only the tests handed out and not yet finished are running or queued again
+            test = message['test_number']
+            if test in self.running or test in self.pending:
+                self.running.pop(test, None)
+                if test in self.pending:
+                    self.pending.remove(test)
+                self.results.put((test, message['results']))
+        return None
+
+    def drop_silent_workers(self):
+        """Disconnects every worker not heard from for `heartbeat_timeout` seconds, queuing its tests again."""
+        now = time.monotonic()
+        with self.lock:
+            silent = [connection for connection, heard in self.last_heard.items()
+                      if now - heard > self.heartbeat_timeout]
+        for connection in silent:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self, linger=0):
+        """Stops listening and disconnects every worker, after waiting up to `linger` seconds for them to leave."""
+        self._closed.set()
+        self.server.close()
+        deadline = time.monotonic() + linger
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.last_heard:
+                    break
+            time.sleep(0.05)
+        with self.lock:
+            connections = list(self.last_heard)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def coordinate(address, heartbeat_timeout=60, opt_results_save_loc='', context=None):
+    """
+    Runs an optimisation by handing its tests out to workers, see `Coordinator`.
+
+    The results are recorded with `Optimise.record_backtest` in test order as
+    they arrive, so the optimisation report and wealth tracks are the same as
+    running every test in this process. Returns when every test is recorded.
+
+    Parameters
+    ----------
+    address : tuple
+        The (host, port) to listen on.
+    heartbeat_timeout : float, default 60
+        The seconds without a message from a worker before its tests are
+        queued again.
+    opt_results_save_loc : str, default ''
+        The directory to save the report to as tests are recorded, as in `run`.
+    context : BacktestContext, default None
+        The optimisation, with its data loaded and data.combinations made. If
+        None, the active context is used.
+
+    Returns
+    -------
+    None. The results are stored in data.optimisation_report.
+
+    """
+    ctx = context if context is not None else get_context()
+    number_of_tests = ctx.combinations.count()
+    coordinator = Coordinator(address, ctx.combinations.test_numbers(), optimisation_fingerprint(context=ctx),
+                              heartbeat_timeout)
+    print('Coordinating {} tests at {}:{}'.format(number_of_tests, *coordinator.address))
+    arrived = {}
+    recorded = 0
+    try:
+        with tqdm(total=number_of_tests, position=0) as pbar:
+            for chunk in Optimise.combination_chunks(context=ctx):
+                Optimise.load_combinations(chunk, context=ctx)
+                for next_test in chunk:
+                    while next_test not in arrived:
+                        coordinator.drop_silent_workers()
+                        try:
+                            test, results = coordinator.results.get(timeout=1)
+                        except queue.Empty:
+                            continue
+                        arrived[test] = _decode_results(results, test)
+                    Optimise.record_backtest(combination_row=next_test, results=arrived.pop(next_test), context=ctx)
+                    if opt_results_save_loc != '':
+                        ctx.optimisation_report.to_csv('{}\\temp.csv'.format(opt_results_save_loc),
+                                                       index=True, index_label='Test_Number')
+                    recorded += 1
+                    pbar.update(1)
+    finally:
+        # Give idle workers time to be told there are no more tests
+        coordinator.close(linger=2 if recorded == number_of_tests else 0)
+
+
+def work(address, run_test, context=None):
+    """
+    Runs tests for the coordinator at `address` until it has none left.
+
+    Parameters
+    ----------
+    address : tuple
+        The (host, port) of the coordinator.
+    run_test : function
+        Runs the test number it is given and returns its
+        `Optimise.backtest_results`.
+    context : BacktestContext, default None
+        The optimisation, set up the same way as the coordinator's. If None,
+        the active context is used.
+
+    Returns
+    -------
+    list
+        The numbers of the tests run.
+
+    """
+    ctx = context if context is not None else get_context()
+    connection = socket.create_connection(address)
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with send_lock:
+            _send(connection, message)
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                send({'type': 'heartbeat'})
+            except OSError:
+                return
+
+    tests_run = []
+    try:
+        send({'type': 'hello', 'fingerprint': optimisation_fingerprint(context=ctx)})
+        reply = _receive(connection)
+        if reply['type'] == 'reject':
+            raise ValueError(reply['reason'])
+        threading.Thread(target=heartbeat, daemon=True).start()
+        while True:
+            send({'type': 'request'})
+            reply = _receive(connection)
+            if reply['type'] == 'done':
+                break
+            if reply['type'] == 'wait':
+                time.sleep(reply['seconds'])
+                continue
+            test = reply['test_number']
+            results = run_test(test)
+            send({'type': 'result', 'test_number': test, 'results': _encode_results(results)})
+            tests_run.append(test)
+    except ConnectionError:
+        print('Lost the connection to the coordinator after running {} tests'.format(len(tests_run)))
+    finally:
+        stopped.set()
+        connection.close()
+    return tests_run
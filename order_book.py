@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:05:31 2026
+
+@author: Nick Elmer
+"""
+import numpy as np
+
+
+LIMIT = 0
+STOP = 1
+STOP_LIMIT = 2
+
+_ORDER_DTYPES = {'column': np.int64,
+                 'amount': np.float64,
+                 'kind': np.int8,
+                 'limit_price': np.float64,
+                 'stop_price': np.float64,
+                 'placed_index': np.int64,
+                 'expiry_index': np.int64}
+
+
+class OrderBook:
+    """
+    The resting limit, stop and stop-limit orders of a backtest.
+
+    Orders rest in the book until they fill, expire or are cancelled. Each
+    field of the orders is held in its own NumPy array so every active order
+    can be matched against a bar's prices in one pass with `match`. An order
+    is only matched on the bars after the one it was placed on.
+
+    Fills follow the same rules as `Orders.check_stop_loss`. A buy limit fills
+    when the low reaches the limit, at the open if the price opened below the
+    limit and at the limit otherwise. A buy stop fills when the high reaches
+    the stop, at the open if the price opened above the stop and at the stop
+    otherwise. Sells are the mirror image. A stop-limit order becomes a limit
+    order once its stop is reached, and fills at the price the stop was reached
+    at if that is within the limit.
+
+    Parameters
+    ----------
+    capacity : int, default 64
+        The number of orders to allocate before the first resize.
+
+    Examples
+    --------
+    >>> book = OrderBook()
+    >>> order_id = book.place(column=0, amount=100, limit_price=99.5, placed_index=10)
+    >>> book.match(11, opens, highs, lows)
+    (array([0]), array([99.5]))
+    """
+
+    def __init__(self, capacity=64):
+        self._size = 0
+        self._capacity = max(int(capacity), 1)
+        self._columns = {col: np.zeros(self._capacity, dtype=dtype) for col, dtype in _ORDER_DTYPES.items()}
+        self.details = []
+        self.active = np.array([], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.active)
+
+    def __getitem__(self, column):
+        """Returns a view of `column` for every order placed."""
+        return self._columns[column][:self._size]
+
+    def _grow(self):
+        new_capacity = self._capacity * 2
+        for col, dtype in _ORDER_DTYPES.items():
+            new_array = np.zeros(new_capacity, dtype=dtype)
+            new_array[:self._size] = self._columns[col][:self._size]
+            self._columns[col] = new_array
+        self._capacity = new_capacity
+
+    def place(self, column, amount, placed_index, limit_price=None, stop_price=None, good_for=None, **details):
+        """
+        Adds a resting order to the book.
+
+        Parameters
+        ----------
+        column : int
+            The column of the symbol in the price data.
+        amount : float
+            The number of shares to buy (positive) or sell (negative).
+        placed_index : int
+            The row of the price data the order is placed on.
+        limit_price, stop_price : float, default None
+            Give a `limit_price` for a limit order, a `stop_price` for a stop
+            order or both for a stop-limit order.
+        good_for : int, default None
+            The number of bars after `placed_index` the order rests for. The
+            order rests until the end of the backtest if None.
+        **details
+            Anything else to keep with the order, such as the open reason.
+
+        Returns
+        -------
+        int
+            The id of the order.
+
+        """
+        if limit_price is None and stop_price is None:
+            raise ValueError('A resting order needs a limit_price, a stop_price or both')
+        if stop_price is None:
+            kind = LIMIT
+        elif limit_price is None:
+            kind = STOP
+        else:
+            kind = STOP_LIMIT
+        if self._size == self._capacity:
+            self._grow()
+        order_id = self._size
+        cols = self._columns
+        cols['column'][order_id] = column
+        cols['amount'][order_id] = amount
+        cols['kind'][order_id] = kind
+        cols['limit_price'][order_id] = np.nan if limit_price is None else limit_price
+        cols['stop_price'][order_id] = np.nan if stop_price is None else stop_price
+        cols['placed_index'][order_id] = placed_index
+        cols['expiry_index'][order_id] = np.iinfo(np.int64).max if good_for is None else placed_index + good_for
+        self.details.append(details)
+        self._size += 1
+        self.active = np.append(self.active, order_id)
+        return order_id
+
+    def cancel(self, order_ids):
+        """Removes orders from the book. Orders which are no longer resting are ignored."""
+        self.active = self.active[~np.isin(self.active, order_ids)]
+
+    def rebase(self, rows):
+        """
+        Moves the rows of the resting orders back by `rows`, for when the price
+        data the rows refer to has its first `rows` rows dropped.
+
+        Orders which are no longer resting are removed, and the resting orders
+        are renumbered from 0, oldest first.
+        """
+        cols = self._columns
+        active = self.active
+        for col in _ORDER_DTYPES:
+            cols[col][:len(active)] = cols[col][active]
+        cols['placed_index'][:len(active)] -= rows
+        unexpiring = cols['expiry_index'][:len(active)] == np.iinfo(np.int64).max
+        cols['expiry_index'][:len(active)][~unexpiring] -= rows
+        self.details = [self.details[order_id] for order_id in active]
+        self._size = len(active)
+        self.active = np.arange(len(active), dtype=np.int64)
+
+    def orders_of(self, column):
+        """Returns the ids of the resting orders of the symbol in `column`."""
+        return self.active[self._columns['column'][self.active] == column]
+
+    def match(self, day_index, opens, highs, lows):
+        """
+        Finds the resting orders which fill on a bar.
+
+        Orders which fill or have expired by the end of the bar are removed
+        from the book, and stop-limit orders whose stop is reached but do not
+        fill become limit orders.
+
+        Parameters
+        ----------
+        day_index : int
+            The row of the bar in the price data.
+        opens, highs, lows : numpy-array
+            The prices of every symbol on the bar.
+
+        Returns
+        -------
+        tuple
+            The ids of the orders which fill, oldest first, and their fill
+            prices.
+
+        """
+        ids = self.active
+        if not len(ids):
+            return ids, np.array([])
+        cols = self._columns
+        ids = ids[cols['placed_index'][ids] < day_index]
+        column = cols['column'][ids]
+        kind = cols['kind'][ids]
+        buy = cols['amount'][ids] > 0
+        limit_price = cols['limit_price'][ids]
+        stop_price = cols['stop_price'][ids]
+        bar_open, bar_high, bar_low = opens[column], highs[column], lows[column]
+
+        # Stops are reached when the price trades through them, filling at the open if it gapped through
+        stopped = np.where(buy, bar_high >= stop_price, bar_low <= stop_price)
+        stop_fill = np.where(buy, np.fmax(bar_open, stop_price), np.fmin(bar_open, stop_price))
+        # Limits fill when the price reaches them, at the open if it opened better than the limit
+        limit_hit = np.where(buy, bar_low <= limit_price, bar_high >= limit_price)
+        limit_fill = np.where(buy, np.fmin(bar_open, limit_price), np.fmax(bar_open, limit_price))
+        within_limit = np.where(buy, stop_fill <= limit_price, stop_fill >= limit_price)
+
+        filled = np.where(kind == LIMIT, limit_hit, stopped)
+        filled[kind == STOP_LIMIT] &= within_limit[kind == STOP_LIMIT]
+        fill_prices = np.where(kind == LIMIT, limit_fill, stop_fill)
+
+        triggered = ids[(kind == STOP_LIMIT) & stopped & ~filled]
+        cols['kind'][triggered] = LIMIT
+        filled_ids = ids[filled]
+        expired = self.active[cols['expiry_index'][self.active] <= day_index]
+        self.active = self.active[~np.isin(self.active, np.concatenate([filled_ids, expired]))]
+        return filled_ids, fill_prices[filled]
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 11:02:15 2026
+
+@author: Nick Elmer
+"""
+import numpy as np
+import pandas as pd
+
+
+PRICE_FIELDS = ('opens', 'highs', 'lows', 'closes')
+
+_FIELD_ALIASES = {'Open': 'opens', 'High': 'highs', 'Low': 'lows', 'Close': 'closes',
+                  'daily_opens': 'opens', 'daily_highs': 'highs', 'daily_lows': 'lows', 'daily_closes': 'closes'}
+
+
+class PricePanels:
+    """
+    The daily price data of a backtest held as contiguous NumPy arrays.
+
+    Each field is a 2D array with a row for every date and a column for every
+    symbol, in the order of the columns of `daily_closes`. Prices are looked up
+    with the integer row number of a date and the column number of a symbol
+    from `symbol_columns`, which avoids label based pandas indexing in the
+    backtest loop. The arrays are read-only.
+
+    Other panels with the same rows and columns, such as indicators, can be
+    added with `add_panel` and are read with `window` in the same way.
+
+    Parameters
+    ----------
+    daily_closes : pandas-dataframe
+        The close prices. Its index and columns define the rows and columns of
+        every array.
+    daily_opens, daily_highs, daily_lows : pandas-dataframe, default None
+        The other price fields. A field which is not given is set to None.
+
+    Examples
+    --------
+    >>> panels = PricePanels(data.daily_closes, data.daily_opens)
+    >>> panels.closes[panels.dates.get_loc(d), panels.symbol_columns['SPY']]
+    321.86
+    """
+
+    def __init__(self, daily_closes, daily_opens=None, daily_highs=None, daily_lows=None):
+        self.dates = daily_closes.index
+        self.symbols = daily_closes.columns
+        self.symbol_columns = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.known_at = {'opens': 'open', 'highs': 'close', 'lows': 'close', 'closes': 'close'}
+        frames = {'opens': daily_opens, 'highs': daily_highs, 'lows': daily_lows, 'closes': daily_closes}
+        for field, frame in frames.items():
+            if frame is not None:
+                frame = self._to_array(frame)
+            setattr(self, field, frame)
+        self.panels = {}
+
+    def _to_array(self, frame):
+        array = np.ascontiguousarray(frame.reindex(index=self.dates, columns=self.symbols).to_numpy(dtype=np.float64))
+        array.setflags(write=False)
+        return array
+
+    def add_panel(self, name, frame, known_at='close'):
+        """
+        Adds a panel of values, such as an indicator, which can be read with `window`.
+
+        Parameters
+        ----------
+        name : str
+            The name to read the panel with. A panel with the same name is
+            replaced.
+        frame : pandas-dataframe
+            The values, with dates as the index and symbols as the columns. It
+            is aligned to the price data.
+        known_at : str, default 'close'
+            When in the day the value of each date is known, either 'open' or
+            'close'. Values known at the close cannot be read until the close
+            callbacks.
+
+        """
+        self.panels[name] = self._to_array(frame)
+        self.known_at[name] = known_at
+
+    def field(self, name):
+        """Returns the array of a price field or of a panel added with `add_panel`."""
+        name = _FIELD_ALIASES.get(name, name)
+        array = self.panels[name] if name in self.panels else getattr(self, name, None)
+        if array is None:
+            raise KeyError('There is no price field or panel called {}'.format(name))
+        return array
+
+    def when_known(self, name):
+        """Returns 'open' or 'close', the point of the day at which the values of a field are known."""
+        return self.known_at.get(_FIELD_ALIASES.get(name, name), 'close')
+
+    def window(self, name, stop, n, columns=slice(None)):
+        """
+        Returns the `n` rows of a field before row `stop`.
+
+        The window is a read-only view of the panel, so no data is copied,
+        unless `columns` is a list of columns. Fewer than `n` rows are returned
+        if there are not enough before `stop`.
+
+        Parameters
+        ----------
+        name : str
+            A price field, eg. 'closes' or 'Close', or the name of a panel.
+        stop : int
+            The row after the last row of the window.
+        n : int
+            The number of rows.
+        columns : int or slice or list, default slice(None)
+            The columns to return. A single column returns a 1D array.
+
+        """
+        return self.field(name)[max(stop - n, 0):stop, columns]
+
+    def row(self, field, index):
+        """Returns the prices of `field` on row `index` as a PriceRow."""
+        return PriceRow(getattr(self, field)[index], self.symbols, self.symbol_columns)
+
+
+class PriceRow:
+    """
+    The prices of every symbol at one point in time.
+
+    A lightweight stand in for a row of a price DataFrame. Indexing with a
+    symbol returns its price without creating a pandas Series. Indexing with a
+    list of symbols returns a Series of their prices.
+
+    Parameters
+    ----------
+    values : numpy-array
+        The prices, in the same order as `symbols`.
+    symbols : pandas-index
+        The symbol of each price.
+    symbol_columns : dict
+        The position of each symbol in `symbols`.
+    """
+    __slots__ = ('values', 'index', '_symbol_columns')
+
+    def __init__(self, values, symbols, symbol_columns):
+        self.values = values
+        self.index = symbols
+        self._symbol_columns = symbol_columns
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple, set, np.ndarray, pd.Index)):
+            key = list(key)
+            return pd.Series(self.values[[self._symbol_columns[k] for k in key]], index=key)
+        return self.values[self._symbol_columns[key]]
+
+    def __contains__(self, symbol):
+        return symbol in self._symbol_columns
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def get(self, symbol, default=None):
+        column = self._symbol_columns.get(symbol)
+        return default if column is None else self.values[column]
+
+    def to_series(self):
+        """Returns the prices as a pandas Series indexed by symbol."""
+        return pd.Series(self.values, index=self.index)
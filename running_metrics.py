@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 19:03:26 2026
+
+@author: Nick Elmer
+"""
+import numpy as np
+import pandas as pd
+
+
+class RunningMetrics:
+    """
+    The wealth statistics of a backtest, kept up to date one date at a time
+    instead of storing the wealth of every date.
+
+    Gives the same total profit, maximum drawdown, length of the maximum
+    drawdown and yearly profits as `Optimise.record_backtest` works out from a
+    full wealth track, for the cost of a few numbers per backtest.
+
+    Attributes
+    ----------
+    number_of_dates : int
+        The number of dates added.
+    last_wealth : float
+        The wealth on the last date added.
+    max_drawdown : float
+        The largest fall in wealth from a previous high, as a negative number.
+    year_end_wealth : dict
+        The wealth on the last date added of each year.
+
+    Examples
+    --------
+    >>> metrics = RunningMetrics()
+    >>> metrics.add(d, 100500.0)
+    >>> metrics.add_many(dates, wealth)
+    >>> metrics.max_drawdown_length()
+    """
+
+    def __init__(self):
+        self.number_of_dates = 0
+        self.last_wealth = np.nan
+        self.peak = -np.inf
+        self.peak_index = 0
+        self.max_drawdown = 0.0
+        self.max_drawdown_start = 0
+        self.max_drawdown_end = 0
+        self.year_end_wealth = {}
+
+    def add(self, date, wealth):
+        """Adds the wealth at the close of `date`."""
+        i = self.number_of_dates
+        if wealth >= self.peak:
+            self.peak = wealth
+            self.peak_index = i
+            if self.max_drawdown_end is None:
+                self.max_drawdown_end = i
+        elif wealth - self.peak < self.max_drawdown:
+            self.max_drawdown = wealth - self.peak
+            self.max_drawdown_start = self.peak_index
+            self.max_drawdown_end = None
+        self.year_end_wealth[date.year] = wealth
+        self.last_wealth = wealth
+        self.number_of_dates += 1
+
+    def add_many(self, dates, wealth):
+        """Adds the wealth at the close of each of `dates` at once."""
+        wealth = np.asarray(wealth, dtype=np.float64)
+        if not len(wealth):
+            return
+        first = self.number_of_dates
+        peaks = np.maximum.accumulate(np.append(self.peak, wealth))[1:]
+        drawdown = wealth - peaks
+        at_peak = np.flatnonzero(drawdown == 0)
+        lowest = int(np.argmin(drawdown))
+        if drawdown[lowest] < self.max_drawdown:
+            self.max_drawdown = drawdown[lowest]
+            before = at_peak[at_peak < lowest]
+            self.max_drawdown_start = first + before[-1] if len(before) else self.peak_index
+            after = at_peak[at_peak > lowest]
+            self.max_drawdown_end = first + after[0] if len(after) else None
+        elif self.max_drawdown_end is None and len(at_peak):
+            self.max_drawdown_end = first + at_peak[0]
+        if len(at_peak):
+            self.peak_index = first + at_peak[-1]
+        self.peak = peaks[-1]
+        years = pd.DatetimeIndex(dates).year
+        year_ends = np.append(np.flatnonzero(np.diff(years)), len(years) - 1)
+        self.year_end_wealth.update(zip(years[year_ends], wealth[year_ends]))
+        self.last_wealth = wealth[-1]
+        self.number_of_dates += len(wealth)
+
+    def max_drawdown_length(self):
+        """The number of dates from the high before the maximum drawdown to the recovery, or to the last date."""
+        end = self.max_drawdown_end if self.max_drawdown_end is not None else self.number_of_dates - 1
+        return end - self.max_drawdown_start + 1
+
+    def yearly_profits(self):
+        """The change in wealth over each year after the first, as a Series indexed by year."""
+        return pd.Series(self.year_end_wealth).sort_index().diff()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 21:05:44 2026
+
+@author: Nick Elmer
+"""
+import copy
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+# The blocks this process has attached to, kept open while their arrays are in use
+_attached_blocks = []
+
+
+class SharedRef:
+    """
+    Stands in for an array or data frame published in shared memory, in the
+    copy of a context which is sent to another process.
+
+    Parameters
+    ----------
+    block_name : str
+        The name of the shared memory block holding the values.
+    shape : tuple
+        The shape of the array.
+    dtype : numpy-dtype
+        The type of the values.
+    index, columns : pandas-index, default None
+        The index and columns of a data frame. An array is stood in for if
+        None.
+    """
+    __slots__ = ('block_name', 'shape', 'dtype', 'index', 'columns')
+
+    def __init__(self, block_name, shape, dtype, index=None, columns=None):
+        self.block_name = block_name
+        self.shape = shape
+        self.dtype = dtype
+        self.index = index
+        self.columns = columns
+
+    def attach(self):
+        """Returns the read-only array or data frame, using the shared memory without copying it."""
+        block = shared_memory.SharedMemory(name=self.block_name)
+        _attached_blocks.append(block)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+        array.setflags(write=False)
+        if self.index is None:
+            return array
+        return pd.DataFrame(array, index=self.index, columns=self.columns, copy=False)
+
+
+def _can_share(value):
+    if isinstance(value, pd.DataFrame):
+        dtypes = set(value.dtypes)
+        if len(dtypes) != 1:
+            return False
+        dtype = dtypes.pop()
+        return isinstance(dtype, np.dtype) and dtype.kind in 'biuf' and value.size > 0
+    return isinstance(value, np.ndarray) and value.dtype.kind in 'biuf' and value.size > 0
+
+
+def _release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+    blocks.clear()
+
+
+class SharedData:
+    """
+    Publishes the data of a context once in named shared memory, so the
+    processes of an optimisation can read it without each being sent a copy.
+
+    Every data frame of a single numeric type and every numeric array found
+    on the context, on its `user` and in its `price_panels` is copied into a
+    shared memory block. `context` is a copy of the context with each of them
+    replaced by a SharedRef, which is small to send to another process, where
+    `attach_context` puts the shared values back without copying them. The
+    same object is only published once, however many attributes hold it.
+
+    The blocks are freed by `close`, at the end of a with block or, if they
+    were never closed, when the SharedData is garbage collected or the
+    interpreter exits. The values seen by the other processes are read-only.
+
+    Parameters
+    ----------
+    context : BacktestContext
+        The context to publish the data of.
+
+    Attributes
+    ----------
+    context : BacktestContext
+        The copy of the context to send to the other processes.
+    blocks : list
+        The shared memory blocks.
+
+    Examples
+    --------
+    >>> with SharedData(data) as shared:
+    ...     pool = ProcessPoolExecutor(initializer=start, initargs=(shared.context,))
+    ...
+    >>> def start(context):
+    ...     context = attach_context(context)
+    """
+
+    def __init__(self, context):
+        self.blocks = []
+        self._finalizer = weakref.finalize(self, _release, self.blocks)
+        self._published = {}
+        self.context = self._share_attributes(context)
+        self.context.user = self._share_attributes(context.user)
+        if getattr(context, 'price_panels', None) is not None:
+            price_panels = self._share_attributes(context.price_panels)
+            price_panels.panels = {name: self._share(value) for name, value in price_panels.panels.items()}
+            self.context.price_panels = price_panels
+        self._published.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Frees the shared memory. Other processes must have finished with it."""
+        self._finalizer()
+
+    def _share_attributes(self, obj):
+        if not hasattr(obj, '__dict__'):
+            return obj
+        shared = copy.copy(obj)
+        for name, value in vars(obj).items():
+            setattr(shared, name, self._share(value))
+        return shared
+
+    def _share(self, value):
+        if not _can_share(value):
+            return value
+        if id(value) not in self._published:
+            values = value.to_numpy() if isinstance(value, pd.DataFrame) else value
+            block = shared_memory.SharedMemory(create=True, size=values.nbytes)
+            self.blocks.append(block)
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+            if isinstance(value, pd.DataFrame):
+                self._published[id(value)] = SharedRef(block.name, values.shape, values.dtype, value.index,
+                                                       value.columns)
+            else:
+                self._published[id(value)] = SharedRef(block.name, values.shape, values.dtype)
+        return self._published[id(value)]
+
+
+def attach_context(context):
+    """
+    Puts the shared arrays and data frames back into a copy of a context made
+    by SharedData, in place of each SharedRef.
+
+    Parameters
+    ----------
+    context : BacktestContext
+        The `context` of a SharedData, received by another process.
+
+    Returns
+    -------
+    BacktestContext
+        The same context, using the shared memory for its data.
+
+    """
+    attached = {}
+
+    def attach(value):
+        if not isinstance(value, SharedRef):
+            return value
+        if value.block_name not in attached:
+            attached[value.block_name] = value.attach()
+        return attached[value.block_name]
+
+    owners = [context, context.user]
+    if getattr(context, 'price_panels', None) is not None:
+        owners.append(context.price_panels)
+        context.price_panels.panels = {name: attach(value) for name, value in context.price_panels.panels.items()}
+    for owner in owners:
+        if hasattr(owner, '__dict__'):
+            for name, value in list(vars(owner).items()):
+                setattr(owner, name, attach(value))
+    return context
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 23:41:07 2026
+
+@author: Nick Elmer
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import Optimise
+from backtest_context import BacktestContext
+
+
+def sampled_optimisation(optimise_type):
+    # An optimisation of a search whose wealth tracks are recorded in a different order to their test numbers
+    ctx = BacktestContext()
+    ctx.starting_amount = 100000
+    ctx.all_dates = pd.bdate_range('2020-01-01', periods=20)
+    ctx.is_dates = ctx.all_dates
+    ctx.oos_dates = pd.DatetimeIndex([])
+    Optimise.create_variable_combinations_dict({'n': range(10), 'm': range(10)}, optimise_type, budget=6, seed=1,
+                                               context=ctx)
+    test_numbers = list(ctx.combinations.test_numbers())
+    for test in reversed(test_numbers):
+        wealth = ctx.starting_amount + test * np.arange(len(ctx.all_dates), dtype=np.float64)
+        ctx.optimisation_wealth_tracks.append(pd.Series(wealth, index=ctx.all_dates, name=test))
+    return ctx, test_numbers
+
+
+@pytest.mark.parametrize('optimise_type', ['random', 'latin_hypercube'])
+def test_plot_tests_of_sampled_search(optimise_type, monkeypatch):
+    figures = []
+    monkeypatch.setattr(Optimise, 'plot', lambda fig, auto_open=True: figures.append(fig))
+    ctx, test_numbers = sampled_optimisation(optimise_type)
+    test = max(test_numbers)
+    assert test >= len(test_numbers)
+
+    Optimise.plot_tests([test], context=ctx)
+
+    trace = figures[0].data[-1]
+    assert trace.name.split()[0] == str(test)
+    np.testing.assert_array_equal(trace.y, test * np.arange(len(ctx.all_dates)))
+
+
+def test_plot_tests_of_test_not_run(monkeypatch):
+    monkeypatch.setattr(Optimise, 'plot', lambda fig, auto_open=True: None)
+    ctx, test_numbers = sampled_optimisation('random')
+    not_run = min(set(range(100)) - set(test_numbers))
+    with pytest.raises(ValueError, match=str(not_run)):
+        Optimise.plot_tests([not_run], context=ctx)
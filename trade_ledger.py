@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:12:40 2026
+
+@author: Nick Elmer
+"""
+import numpy as np
+import pandas as pd
+from array import array
+from collections import deque
+from itertools import chain
+
+
+TRADE_COLUMNS = ['long_or_short', 'symbol', 'open_date', 'open_price', 'amount',
+                 'open_value', 'open_reason', 'close_date', 'close_price',
+                 'close_value', 'close_reason', 'profit', 'profit%', 'entry_timing', 'exit_timing']
+
+_COLUMN_DTYPES = {'long_or_short': object,
+                  'symbol': object,
+                  'open_date': 'datetime64[ns]',
+                  'open_price': np.float64,
+                  'amount': np.float64,
+                  'open_value': np.float64,
+                  'open_reason': object,
+                  'close_date': 'datetime64[ns]',
+                  'close_price': np.float64,
+                  'close_value': np.float64,
+                  'close_reason': object,
+                  'profit': np.float64,
+                  'profit%': np.float64,
+                  'entry_timing': object,
+                  'exit_timing': object,
+                  'max_high': np.float64,
+                  'min_low': np.float64}
+
+
+def _empty_column(dtype, length):
+    if dtype == object:
+        return np.full(length, None, dtype=object)
+    elif dtype == 'datetime64[ns]':
+        return np.full(length, np.datetime64('NaT'), dtype=dtype)
+    return np.full(length, np.nan, dtype=dtype)
+
+
+class OpenLots:
+    """
+    The open trades (lots) of a single symbol, oldest first.
+
+    Attributes
+    ----------
+    trade_numbers : deque
+        The trade numbers of the open lots in the order they will be closed.
+    shares : float
+        The number of shares held over all open lots. Negative if short.
+    open_value : float
+        The sum of the open values of all open lots.
+    """
+    __slots__ = ('trade_numbers', 'shares', 'open_value')
+
+    def __init__(self):
+        self.trade_numbers = deque()
+        self.shares = 0
+        self.open_value = 0
+
+    def __len__(self):
+        return len(self.trade_numbers)
+
+
+class TradeLedger:
+    """
+    A growable, column based store of every trade made in a backtest.
+
+    Each column of the trade list is held in its own typed NumPy array which
+    doubles in size when full, so adding a trade does not copy the whole trade
+    list as DataFrame.append does. Trades are closed by writing in to their
+    row. The row number of a trade is its trade number, which is also the
+    index of the DataFrame returned by `to_dataframe`.
+
+    The open trades of each symbol are also kept in `open_lots`, a dictionary
+    of symbol to OpenLots, so the open position of a symbol can be found
+    without searching the whole ledger.
+
+    Running totals are kept as trades open and close. `realised_profit` is the
+    profit of all closed trades, `net_shares` and `net_open_value` are the
+    number of shares held and their open value for each symbol, in the column
+    order of `symbols`, and `short_open_value` is
+    the open value of all open short trades. Together they value the open
+    positions with `open_position_value` without looking at any trade rows.
+
+    The highest high and lowest low of each open trade since it was opened are
+    kept in the 'max_high' and 'min_low' columns, which are not part of the
+    trade list. They are brought up to date once per bar by
+    `update_extremes`, so they cover every completed bar but not the bar
+    being traded.
+
+    Parameters
+    ----------
+    symbols : list-like, default ()
+        Every symbol that could be traded, in the column order of the price
+        data which will be passed to `open_position_value`.
+    capacity : int, default 1024
+        The number of rows to allocate before the first resize.
+
+    Examples
+    --------
+    >>> ledger = TradeLedger()
+    >>> n = ledger.append(long_or_short='long', symbol='SPY', open_date=d,
+    ...                   open_price=300.0, amount=10, open_value=3000.0)
+    >>> ledger.close_row(n, close_date=d, close_price=310.0)
+    100.0
+    """
+
+    def __init__(self, symbols=(), capacity=1024):
+        self._size = 0
+        self._capacity = max(int(capacity), 1)
+        self._columns = {col: _empty_column(dtype, self._capacity) for col, dtype in _COLUMN_DTYPES.items()}
+        self.open_lots = {}
+        self.symbol_columns = {symbol: i for i, symbol in enumerate(symbols)}
+        self.net_shares = np.zeros(len(self.symbol_columns))
+        self.net_open_value = np.zeros(len(self.symbol_columns))
+        self.short_open_value = 0
+        self._open_short_lots = 0
+        self.realised_profit = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, column):
+        """Returns a view of the filled part of `column`."""
+        return self._columns[column][:self._size]
+
+    def __getstate__(self):
+        # Only the filled rows are pickled, the ledger grows again when more trades are added
+        state = self.__dict__.copy()
+        state['_capacity'] = max(self._size, 1)
+        state['_columns'] = {col: array[:state['_capacity']].copy() for col, array in self._columns.items()}
+        return state
+
+    def _grow(self):
+        new_capacity = self._capacity * 2
+        for col, dtype in _COLUMN_DTYPES.items():
+            new_array = _empty_column(dtype, new_capacity)
+            new_array[:self._size] = self._columns[col][:self._size]
+            self._columns[col] = new_array
+        self._capacity = new_capacity
+
+    def append(self, lot_position=None, **values):
+        """
+        Adds a new open trade to the ledger.
+
+        Parameters
+        ----------
+        lot_position : int, default None
+            Where to put the trade in the symbol's open lots. The trade is
+            added to the back, to be closed last, if None.
+        **values
+            Column name and value pairs. Any column not given is left empty.
+
+        Returns
+        -------
+        int
+            The trade number of the new row.
+
+        """
+        if self._size == self._capacity:
+            self._grow()
+        row = self._size
+        for col, value in values.items():
+            self._columns[col][row] = value
+        self._size += 1
+
+        symbol = self._columns['symbol'][row]
+        lots = self.open_lots.get(symbol)
+        if lots is None:
+            lots = self.open_lots[symbol] = OpenLots()
+        if lot_position is None:
+            lots.trade_numbers.append(row)
+        else:
+            lots.trade_numbers.insert(lot_position, row)
+        lots.shares += self._columns['amount'][row]
+        lots.open_value += self._columns['open_value'][row]
+        self.net_shares[self.symbol_columns[symbol]] += self._columns['amount'][row]
+        self.net_open_value[self.symbol_columns[symbol]] += self._columns['open_value'][row]
+        if self._columns['long_or_short'][row] == 'short':
+            self._open_short_lots += 1
+            self.short_open_value += self._columns['open_value'][row]
+        return row
+
+    def extend(self, **values):
+        """
+        Adds many new open trades to the ledger at once.
+
+        Parameters
+        ----------
+        **values
+            Column name and value pairs. A value is either an array with an
+            entry for each new trade or a single value shared by all of them.
+            'symbol', 'long_or_short', 'amount' and 'open_value' must be given.
+
+        Returns
+        -------
+        numpy-array
+            The trade numbers of the new rows, in the order given.
+
+        """
+        n = len(values['symbol'])
+        while self._size + n > self._capacity:
+            self._grow()
+        rows = np.arange(self._size, self._size + n)
+        for col, value in values.items():
+            self._columns[col][rows] = value
+        self._size += n
+
+        symbols = self._columns['symbol'][rows]
+        amounts = self._columns['amount'][rows]
+        open_values = self._columns['open_value'][rows]
+        for row, symbol, amount, open_value in zip(rows.tolist(), symbols, amounts, open_values):
+            lots = self.open_lots.get(symbol)
+            if lots is None:
+                lots = self.open_lots[symbol] = OpenLots()
+            lots.trade_numbers.append(row)
+            lots.shares += amount
+            lots.open_value += open_value
+        columns = [self.symbol_columns[symbol] for symbol in symbols]
+        np.add.at(self.net_shares, columns, amounts)
+        np.add.at(self.net_open_value, columns, open_values)
+        shorts = self._columns['long_or_short'][rows] == 'short'
+        self._open_short_lots += int(shorts.sum())
+        self.short_open_value += open_values[shorts].sum()
+        return rows
+
+    def lots(self, symbol):
+        """Returns the OpenLots of `symbol`, which are empty if there is no open position."""
+        lots = self.open_lots.get(symbol)
+        return lots if lots is not None else OpenLots()
+
+    def _remove_from_lots(self, trade_number):
+        symbol = self._columns['symbol'][trade_number]
+        lots = self.open_lots[symbol]
+        lots.trade_numbers.remove(trade_number)
+        if lots.trade_numbers:
+            lots.shares -= self._columns['amount'][trade_number]
+            lots.open_value -= self._columns['open_value'][trade_number]
+            self.net_shares[self.symbol_columns[symbol]] -= self._columns['amount'][trade_number]
+            self.net_open_value[self.symbol_columns[symbol]] -= self._columns['open_value'][trade_number]
+        else:
+            del self.open_lots[symbol]
+            self.net_shares[self.symbol_columns[symbol]] = 0
+            self.net_open_value[self.symbol_columns[symbol]] = 0
+        if self._columns['long_or_short'][trade_number] == 'short':
+            self._open_short_lots -= 1
+            if self._open_short_lots:
+                self.short_open_value -= self._columns['open_value'][trade_number]
+            else:
+                self.short_open_value = 0
+
+    def row(self, trade_number):
+        """Returns a dictionary of the values in a single trade."""
+        return {col: self._columns[col][trade_number] for col in TRADE_COLUMNS}
+
+    def close_row(self, trade_number, close_date, close_price, close_reason=None, exit_timing=None):
+        """
+        Closes all shares of a trade at `close_price`.
+
+        Returns
+        -------
+        float
+            The profit made on the trade.
+
+        """
+        self._remove_from_lots(trade_number)
+        return self._write_close(trade_number, close_date, close_price, close_reason, exit_timing)
+
+    def close_rows(self, trade_numbers, close_date, close_prices, close_reason=None, exit_timing=None):
+        """
+        Closes all shares of many trades at once.
+
+        Parameters
+        ----------
+        trade_numbers : array-like
+            The trades to close.
+        close_date : datetime
+            The date the trades are closed on.
+        close_prices : array-like or float
+            The close price of each trade.
+
+        Returns
+        -------
+        numpy-array
+            The profit made on each trade.
+
+        """
+        trade_numbers = np.asarray(trade_numbers, dtype=np.int64)
+        for trade_number in trade_numbers.tolist():
+            self._remove_from_lots(trade_number)
+        cols = self._columns
+        open_values = cols['open_value'][trade_numbers]
+        close_values = cols['amount'][trade_numbers] * close_prices
+        profits = close_values - open_values
+        cols['close_date'][trade_numbers] = close_date
+        cols['close_price'][trade_numbers] = close_prices
+        cols['close_value'][trade_numbers] = close_values
+        cols['close_reason'][trade_numbers] = close_reason
+        cols['profit'][trade_numbers] = profits
+        cols['profit%'][trade_numbers] = (profits / open_values) * 100
+        cols['exit_timing'][trade_numbers] = exit_timing
+        self.realised_profit += profits.sum()
+        return profits
+
+    def _write_close(self, trade_number, close_date, close_price, close_reason, exit_timing):
+        cols = self._columns
+        open_value = cols['open_value'][trade_number]
+        close_value = cols['amount'][trade_number] * close_price
+        profit = close_value - open_value
+        cols['close_date'][trade_number] = close_date
+        cols['close_price'][trade_number] = close_price
+        cols['close_value'][trade_number] = close_value
+        cols['close_reason'][trade_number] = close_reason
+        cols['profit'][trade_number] = profit
+        cols['profit%'][trade_number] = (profit / open_value) * 100
+        cols['exit_timing'][trade_number] = exit_timing
+        self.realised_profit += profit
+        return profit
+
+    def part_close_row(self, trade_number, amount_to_close, close_date, close_price, close_reason=None,
+                       exit_timing=None):
+        """
+        Closes `amount_to_close` shares of a trade.
+
+        The row is reduced to the closed shares and closed, and a new open row
+        is added for the shares which remain. The new row takes the place of
+        the old one in the symbol's open lots.
+
+        Returns
+        -------
+        tuple
+            The profit made on the closed shares and the trade number of the
+            new row holding the remaining shares.
+
+        """
+        cols = self._columns
+        open_price = cols['open_price'][trade_number]
+        amount_remaining = cols['amount'][trade_number] - amount_to_close
+        lot_position = self.open_lots[cols['symbol'][trade_number]].trade_numbers.index(trade_number)
+        self._remove_from_lots(trade_number)
+        cols['amount'][trade_number] = amount_to_close
+        cols['open_value'][trade_number] = open_price * amount_to_close
+        profit = self._write_close(trade_number, close_date, close_price, close_reason, exit_timing)
+        new_row = self.append(lot_position=lot_position,
+                              long_or_short=cols['long_or_short'][trade_number],
+                              symbol=cols['symbol'][trade_number],
+                              open_date=cols['open_date'][trade_number],
+                              open_price=open_price,
+                              amount=amount_remaining,
+                              open_value=open_price * amount_remaining,
+                              open_reason=cols['open_reason'][trade_number],
+                              entry_timing=cols['entry_timing'][trade_number],
+                              max_high=cols['max_high'][trade_number],
+                              min_low=cols['min_low'][trade_number])
+        return profit, new_row
+
+    def open_mask(self):
+        return np.isnan(self['close_price'])
+
+    def open_rows(self, symbol=None):
+        """Returns the trade numbers of all open trades, optionally only those of `symbol`."""
+        if symbol is not None:
+            return np.fromiter(self.lots(symbol).trade_numbers, dtype=np.int64)
+        return np.sort(np.fromiter(chain.from_iterable(lots.trade_numbers for lots in self.open_lots.values()),
+                                   dtype=np.int64))
+
+    def closed_rows(self):
+        return np.flatnonzero(~self.open_mask())
+
+    def remove_closed(self):
+        """
+        Takes every closed trade out of the ledger, so a long backtest can
+        write its trades out as it goes instead of keeping them all.
+
+        The open trades are renumbered from 0, oldest first, so trade numbers
+        held from before the call no longer refer to the same trades.
+        `realised_profit` still includes the profit of the removed trades.
+
+        Returns
+        -------
+        pandas-dataframe
+            The closed trades, as returned by `to_dataframe`.
+
+        """
+        closed = self.to_dataframe(self.closed_rows())
+        keep = self.open_rows()
+        for col, dtype in _COLUMN_DTYPES.items():
+            column = self._columns[col]
+            column[:len(keep)] = column[keep]
+            column[len(keep):self._size] = _empty_column(dtype, self._size - len(keep))
+        new_numbers = dict(zip(keep.tolist(), range(len(keep))))
+        for lots in self.open_lots.values():
+            lots.trade_numbers = deque(new_numbers[trade_number] for trade_number in lots.trade_numbers)
+        self._size = len(keep)
+        return closed
+
+    def update_extremes(self, highs, lows):
+        """
+        Folds a bar's prices in to the highest high and lowest low of every
+        open trade.
+
+        Parameters
+        ----------
+        highs, lows : numpy-array
+            The high and low of every symbol on the bar, in the column order
+            of `symbols`.
+
+        """
+        if not self.open_lots:
+            return
+        counts = np.fromiter((len(lots) for lots in self.open_lots.values()), dtype=np.int64,
+                             count=len(self.open_lots))
+        rows = np.fromiter(chain.from_iterable(lots.trade_numbers for lots in self.open_lots.values()),
+                           dtype=np.int64, count=counts.sum())
+        columns = np.repeat(self.held_columns(), counts)
+        cols = self._columns
+        cols['max_high'][rows] = np.fmax(cols['max_high'][rows], highs[columns])
+        cols['min_low'][rows] = np.fmin(cols['min_low'][rows], lows[columns])
+
+    def held_columns(self):
+        """Returns the column numbers of every symbol with an open position."""
+        return np.fromiter((self.symbol_columns[symbol] for symbol in self.open_lots), dtype=np.int64,
+                           count=len(self.open_lots))
+
+    def open_position_value(self, prices):
+        """
+        Values all open positions.
+
+        Long positions are worth their shares at `prices`. Short positions are
+        worth what they would return to cash if closed, which is their open
+        value plus their profit.
+
+        Parameters
+        ----------
+        prices : numpy-array
+            The price of every symbol, in the column order of `symbols`.
+
+        Returns
+        -------
+        float
+            The value of all open positions.
+
+        """
+        held = self.held_columns()
+        return self.net_shares[held] @ prices[held] - 2 * self.short_open_value
+
+    def to_dataframe(self, trade_numbers=None):
+        """
+        Builds the trade list as a DataFrame.
+
+        Parameters
+        ----------
+        trade_numbers : array-like, default None
+            The trades to include. All trades are included if None.
+
+        Returns
+        -------
+        pandas-dataframe
+            The trade list indexed by trade number.
+
+        """
+        if trade_numbers is None:
+            trade_numbers = np.arange(self._size)
+        else:
+            trade_numbers = np.asarray(trade_numbers, dtype=np.int64)
+        return pd.DataFrame({col: self._columns[col][trade_numbers] for col in TRADE_COLUMNS},
+                            index=trade_numbers)
+
+
+class PositionLog:
+    """
+    A sparse log of every change to the number of shares held of a symbol.
+
+    Each time a position changes the day, symbol column and new number of
+    shares are appended to three flat arrays. Nothing is stored for days on
+    which a position does not change, so the size of the log depends on the
+    number of trades rather than the number of dates times the number of
+    symbols in the universe. The positions on every date are only built when
+    `positions` is called, and only for symbols which were held.
+
+    Examples
+    --------
+    >>> log = PositionLog()
+    >>> log.record(day_index=3, column=0, amount=100)
+    >>> log.record(day_index=7, column=0, amount=0)
+    >>> days, columns, track = log.positions(n_days=10)
+    >>> track[:, 0]
+    array([100., 100., 100., 100.,   0.,   0.,   0.])
+    """
+
+    def __init__(self):
+        self.day_indices = array('q')
+        self.columns = array('q')
+        self.amounts = array('d')
+
+    def __len__(self):
+        return len(self.day_indices)
+
+    def record(self, day_index, column, amount):
+        """Records that `amount` shares of symbol `column` are held after a trade on row `day_index`."""
+        self.day_indices.append(day_index)
+        self.columns.append(column)
+        self.amounts.append(amount)
+
+    def record_many(self, day_index, columns, amounts):
+        """Records the shares held of many symbol `columns` after trades on row `day_index`."""
+        self.day_indices.extend([day_index] * len(columns))
+        self.columns.extend(np.asarray(columns, dtype=np.int64).tolist())
+        self.amounts.extend(np.asarray(amounts, dtype=np.float64).tolist())
+
+    def positions(self, n_days):
+        """
+        Builds the number of shares held of each symbol on each day.
+
+        Parameters
+        ----------
+        n_days : int
+            The number of rows in the price data. Positions are carried
+            forward to the last row.
+
+        Returns
+        -------
+        tuple
+            The day indices from the first recorded change to `n_days`, the
+            columns of the symbols which were ever held, and a 2D array of the
+            shares held with a row for each day and a column for each symbol.
+            A symbol which has not yet been held on a day is NaN.
+
+        """
+        day_indices = np.frombuffer(self.day_indices, dtype=np.int64)
+        columns = np.frombuffer(self.columns, dtype=np.int64)
+        amounts = np.frombuffer(self.amounts, dtype=np.float64)
+        if len(day_indices) == 0:
+            return np.arange(0), np.arange(0), np.empty((0, 0))
+        held_columns, held_positions = np.unique(columns, return_inverse=True)
+        first_day = day_indices.min()
+        days = np.arange(first_day, n_days)
+        # Only the last change of a symbol on a day is kept
+        keys = (day_indices - first_day) * len(held_columns) + held_positions
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        changes = np.full((len(days), len(held_columns)), np.nan)
+        changes[day_indices[last] - first_day, held_positions[last]] = amounts[last]
+        filled = np.where(np.isnan(changes), 0, np.arange(len(days))[:, None])
+        np.maximum.accumulate(filled, axis=0, out=filled)
+        track = changes[filled, np.arange(len(held_columns))]
+        return days, held_columns, track
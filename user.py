@@ -7,5 +7,12 @@ Created on Fri Feb 28 11:13:13 2020
 
 """
 User storage
+
+Compatibility facade for the strategy parameters of a backtest. Reading or
+setting any attribute of this module reads or sets it on the `user` of the
+context active in the current thread, see backtest_context.
 """
+import sys as _sys
+from backtest_context import UserFacade as _UserFacade
 
+_sys.modules[__name__].__class__ = _UserFacade